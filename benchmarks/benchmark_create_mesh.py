@@ -0,0 +1,65 @@
+"""
+Compare the vectorized tube builder used by Neuron.create_mesh with the
+previous approach that created one vedo Tube per section and merged them.
+
+Run from the repository root:
+    python benchmarks/benchmark_create_mesh.py [swc files...]
+"""
+
+import sys
+import time
+
+from vedo import merge
+from vedo.shapes import Tube
+
+from morphapi.morphology.meshing import tube_mesh
+from morphapi.morphology.morphology import Neuron
+from morphapi.utils.data_io import listdir
+
+NEURITE_RADIUS = 2
+
+
+def per_section_tubes(neuron):
+    meshes = {}
+    for ntype in neuron._neurite_types:
+        points, offsets = neuron.sections[ntype]
+        actors = [
+            Tube(points[start:end, :3], r=NEURITE_RADIUS)
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        meshes[ntype] = merge(actors).compute_normals() if actors else None
+    return meshes
+
+
+def single_pass_tubes(neuron):
+    meshes = {}
+    for ntype in neuron._neurite_types:
+        points, offsets = neuron.sections[ntype]
+        mesh = tube_mesh(points[:, :3], offsets, NEURITE_RADIUS)
+        meshes[ntype] = mesh.compute_normals() if mesh is not None else None
+    return meshes
+
+
+def timeit(func, *args, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    files = sys.argv[1:] or sorted(listdir("tests/data"))
+
+    print(f"{'file':<30}{'sections':>10}{'per section':>14}{'single':>10}")
+    for fp in files:
+        neuron = Neuron(fp)
+        n_sections = sum(len(o) - 1 for _, o in neuron.sections.values())
+
+        old = timeit(per_section_tubes, neuron)
+        new = timeit(single_pass_tubes, neuron)
+        print(
+            f"{neuron.neuron_name:<30}{n_sections:>10}"
+            f"{old:>13.3f}s{new:>9.3f}s  ({old / new:.1f}x)"
+        )
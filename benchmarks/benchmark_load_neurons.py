@@ -0,0 +1,52 @@
+"""
+Measure how morphapi.morphology.load_neurons scales with the number of
+worker processes.
+
+Run from the repository root:
+    python benchmarks/benchmark_load_neurons.py [n_files] [n_nodes]
+
+n_files copies (default: 256) of a synthetic neuron with n_nodes nodes
+(default: 20,000) are loaded with 1, 2, 4, ... workers, up to the number
+of CPUs.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmark_swc_reader import write_synthetic_swc
+
+from morphapi.morphology import load_neurons
+
+if __name__ == "__main__":
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    n_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template = Path(tmpdir) / "template.swc"
+        write_synthetic_swc(template, n_nodes)
+        folder = Path(tmpdir) / "neurons"
+        folder.mkdir()
+        for i in range(n_files):
+            shutil.copy(template, folder / f"neuron_{i}.swc")
+
+        workers = [1]
+        while workers[-1] * 2 <= (os.cpu_count() or 1):
+            workers.append(workers[-1] * 2)
+
+        print(f"{'workers':>8}{'time':>10}{'neurons/s':>12}{'speedup':>10}")
+        reference = None
+        for n_workers in workers:
+            start = time.perf_counter()
+            neurons = load_neurons(folder, workers=n_workers)
+            elapsed = time.perf_counter() - start
+            assert all(neuron is not None for neuron in neurons)
+
+            reference = reference or elapsed
+            print(
+                f"{n_workers:>8}{elapsed:>9.2f}s{n_files / elapsed:>12.1f}"
+                f"{reference / elapsed:>9.1f}x"
+            )
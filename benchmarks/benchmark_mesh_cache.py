@@ -0,0 +1,64 @@
+"""
+Compare the time needed to load cached meshes from the mesh files
+written by NeuronCache (with and without the compact encoding) and from
+the OBJ files written by previous versions.
+
+Run from the repository root:
+    python benchmarks/benchmark_mesh_cache.py
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+from vedo import Mesh, load, write
+
+from morphapi.morphology.mesh_file import load_mesh_file, write_mesh_file
+from morphapi.morphology.morphology import Neuron
+from morphapi.utils.data_io import listdir
+
+
+def best_time(function, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parts = ["soma", "axon", "apical_dendrites", "basal_dendrites"]
+
+    max_error = 0.1
+    print(
+        f"{'file':<16}{'OBJ':>10}{'mesh file':>11}{'encoded':>10}"
+        f"{'OBJ size':>12}{'mesh file':>11}{'encoded':>10}"
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fp in sorted(listdir("tests/data")):
+            neuron = Neuron(fp)
+            neurites, whole = neuron.create_mesh(use_cache=False)
+            meshes = dict(neurites, whole_neuron=whole)
+
+            obj_files = []
+            for part in parts + ["whole_neuron"]:
+                obj_file = Path(tmpdir) / f"{Path(fp).stem}_{part}.obj"
+                mesh = meshes.get(part)
+                write(mesh if mesh is not None else Mesh(), str(obj_file))
+                obj_files.append(obj_file)
+            mesh_file = Path(tmpdir) / f"{Path(fp).stem}.mesh"
+            write_mesh_file(mesh_file, meshes)
+            encoded_file = Path(tmpdir) / f"{Path(fp).stem}_encoded.mesh"
+            write_mesh_file(encoded_file, meshes, max_error=max_error)
+
+            obj_time = best_time(lambda: [load(str(f)) for f in obj_files])
+            mesh_time = best_time(lambda: load_mesh_file(mesh_file))
+            encoded_time = best_time(lambda: load_mesh_file(encoded_file))
+            obj_size = sum(f.stat().st_size for f in obj_files)
+            print(
+                f"{Path(fp).name:<16}{obj_time:>9.3f}s{mesh_time:>10.3f}s"
+                f"{encoded_time:>9.3f}s{obj_size / 1e6:>10.1f}MB"
+                f"{mesh_file.stat().st_size / 1e6:>9.1f}MB"
+                f"{encoded_file.stat().st_size / 1e6:>8.2f}MB"
+            )
@@ -0,0 +1,70 @@
+"""
+Compare the time needed to compute morphometrics of a population of
+neurons with morphapi.morphology.population_morphometrics and with a
+loop of NeuroM calls over each neuron.
+
+Run from the repository root:
+    python benchmarks/benchmark_morphometrics.py [n_neurons ...]
+
+Populations (default: 1,000 and 10,000 neurons) are made by repeating
+the neurons in tests/data. Loading the neurons is not timed.
+"""
+
+import sys
+import time
+
+import neurom as nm
+from neurom.geom import bounding_box
+
+from morphapi.morphology import population_morphometrics
+from morphapi.morphology.morphology import Neuron
+from morphapi.utils.data_io import listdir
+
+
+def neurom_morphometrics(neurons):
+    rows = []
+    for neuron in neurons:
+        morphology = neuron.morphology
+        row = dict(bounding_box=bounding_box(morphology))
+        for ntype, nclass in Neuron._neurite_types.items():
+            row.update(
+                {
+                    f"{ntype}_{feature}": nm.get(
+                        feature, morphology, neurite_type=nclass
+                    )
+                    for feature in (
+                        "total_length",
+                        "number_of_sections",
+                        "number_of_forking_points",
+                        "number_of_leaves",
+                        "terminal_path_lengths",
+                    )
+                }
+            )
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [1_000, 10_000]
+
+    templates = [Neuron(fp) for fp in sorted(listdir("tests/data"))]
+    for neuron in templates:
+        # Build the NeuroM morphologies before timing
+        neuron.morphology
+
+    print(f"{'neurons':>8}{'NeuroM':>10}{'NumPy':>10}")
+    for n_neurons in sizes:
+        neurons = [templates[i % len(templates)] for i in range(n_neurons)]
+
+        start = time.perf_counter()
+        neurom_morphometrics(neurons)
+        slow = time.perf_counter() - start
+
+        start = time.perf_counter()
+        population_morphometrics(neurons)
+        fast = time.perf_counter() - start
+
+        print(
+            f"{n_neurons:>8}{slow:>9.2f}s{fast:>9.2f}s  ({slow / fast:.0f}x)"
+        )
@@ -0,0 +1,74 @@
+"""
+Compare the time needed to load SWC files with the NumPy reader used by
+default in Neuron.load_from_swc and with NeuroM.
+
+Run from the repository root:
+    python benchmarks/benchmark_swc_reader.py [n_nodes]
+
+A synthetic neuron with n_nodes nodes (default: 1,000,000) is added to
+the files in tests/data.
+"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from morphapi.morphology.morphology import Neuron
+from morphapi.utils.data_io import listdir
+
+
+def write_synthetic_swc(file_path, n_nodes, branch_every=50, seed=0):
+    """
+    Write a random tree with a soma and one axon branching every
+    branch_every nodes.
+    """
+    rng = np.random.default_rng(seed)
+    parents = np.arange(n_nodes) - 1
+    branches = np.arange(2 * branch_every, n_nodes, branch_every)
+    parents[branches] = rng.integers(1, branches)
+
+    types = np.full(n_nodes, 2)
+    types[0] = 1
+    coords = np.cumsum(rng.normal(size=(n_nodes, 3)), axis=0)
+
+    data = np.column_stack(
+        [
+            np.arange(1, n_nodes + 1),
+            types,
+            coords,
+            np.ones(n_nodes),
+            np.where(parents < 0, -1, parents + 1),
+        ]
+    )
+    np.savetxt(file_path, data, fmt="%d %d %.4f %.4f %.4f %.3f %d")
+
+
+def timeit(file_path, fast, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        neuron = Neuron(file_path, load_file=False)
+        start = time.perf_counter()
+        neuron.load_from_swc(fast=fast)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        synthetic = Path(tmpdir) / f"synthetic_{n_nodes}.swc"
+        write_synthetic_swc(synthetic, n_nodes)
+        files = sorted(listdir("tests/data")) + [str(synthetic)]
+
+        print(f"{'file':<30}{'NeuroM':>10}{'NumPy':>10}")
+        for fp in files:
+            slow = timeit(fp, fast=False)
+            fast = timeit(fp, fast=True)
+            print(
+                f"{Path(fp).name:<30}{slow:>9.3f}s{fast:>9.3f}s"
+                f"  ({slow / fast:.1f}x)"
+            )
@@ -10,6 +10,7 @@ import requests
 from morphapi.morphology.morphology import Neuron
 from morphapi.paths_manager import Paths
 from morphapi.utils.data_io import connected_to_internet
+from morphapi.utils.webqueries import session_manager
 
 logger = logging.getLogger(__name__)
 
@@ -98,7 +99,7 @@ class AllenMorphology(Paths):
         query = "https://api.brain-map.org/api/v2/data/query.json?criteria=model::ApiCellTypesSpecimenDetail,rma::options[num_rows$eqall]"
 
         try:
-            r = requests.get(query)
+            r = session_manager.get(query)
             with open(cells_path, "w") as f:
                 json.dump(r.json()["msg"], f, indent=4)
         except requests.exceptions.RequestException as e:
@@ -123,7 +124,7 @@ class AllenMorphology(Paths):
 
         cells = pd.read_json(cells_path)
         try:
-            r = requests.get(query)
+            r = session_manager.get(query)
         except requests.exceptions.RequestException as e:
             logger.error(
                 "Could not check for metadata validity for the following "
@@ -211,7 +212,7 @@ class AllenMorphology(Paths):
         """
         query_for_file_path = f"https://api.brain-map.org/api/v2/data/query.json?criteria=model::NeuronReconstruction,rma::criteria,[specimen_id$eq{neuron_id}],rma::include,well_known_files"
 
-        r = requests.get(query_for_file_path)
+        r = session_manager.get(query_for_file_path)
         file_paths = r.json()["msg"][0]["well_known_files"]
         file_path = None
         for file in file_paths:
@@ -228,6 +229,6 @@ class AllenMorphology(Paths):
             )
 
         query_file = f"https://api.brain-map.org{file_path}"
-        r = requests.get(query_file)
+        r = session_manager.get(query_file)
         with open(file_name, "wb") as f:
             f.write(r.content)
@@ -4,13 +4,15 @@ from pathlib import Path
 
 import pandas as pd
 from brainglobe_atlasapi import BrainGlobeAtlas
-from brainglobe_atlasapi.utils import retrieve_over_http
 from brainglobe_space import SpaceConvention
 from rich.progress import track
 
+from morphapi.morphology.batch import load_neurons
 from morphapi.morphology.morphology import Neuron
+from morphapi.morphology.soma_index import SomaIndex
 from morphapi.paths_manager import Paths
 from morphapi.utils.data_io import connected_to_internet
+from morphapi.utils.webqueries import download_file
 
 
 def soma_coords_from_file(file_path):
@@ -74,28 +76,24 @@ class MpinMorphologyAPI(Paths):
     def neurons_df(self):
         """Table with all neurons positions and soma regions."""
         if self._neurons_df is None:
-            # Generate table with soma position to query by region:
-            atlas = BrainGlobeAtlas("mpin_zfish_1um", print_authors=False)
-
-            neurons_dict = dict()
-            for f in self.data_path.glob("*.swc"):
-                coords = soma_coords_from_file(f)  # compute coordinates
-
-                # Calculate anatomical structure the neuron belongs to:
-                try:
-                    region = atlas.structure_from_coords(coords)
-                except IndexError:
-                    region = 0
-
-                neurons_dict[f.stem] = dict(
-                    filename=f.name,
-                    pos_ap=coords[0],
-                    pos_si=coords[1],
-                    pos_lr=coords[2],
-                    region=region,
-                )
-
-            self._neurons_df = pd.DataFrame(neurons_dict).T
+            # Soma position and region of each neuron, only the files
+            # added since the index was saved are read
+            soma_index = SomaIndex(
+                Path(self.mpin_morphology) / "soma_index.npz"
+            )
+            soma_index.update(self.data_path, atlas="mpin_zfish_1um")
+
+            table = soma_index.table.set_index("name")
+            self._neurons_df = pd.DataFrame(
+                dict(
+                    filename=[Path(f).name for f in table["file"]],
+                    pos_ap=table["x"],
+                    pos_si=table["y"],
+                    pos_lr=table["z"],
+                    region=table["region"].clip(lower=0),
+                ),
+                index=table.index,
+            )
 
         return self._neurons_df
 
@@ -106,12 +104,17 @@ class MpinMorphologyAPI(Paths):
             self.neurons_df.loc[self.neurons_df.region.isin(IDs)].index
         )
 
-    def load_neurons(self, neuron_id, **kwargs):
+    def load_neurons(self, neuron_id, workers=1, **kwargs):
         """
         Load individual neurons given their IDs
+
+        :param workers: int, number of processes used to parse the files
+            (see morphapi.morphology.load_neurons). If 1 the neurons are
+            loaded in this process.
         """
         if not isinstance(neuron_id, list):
             neuron_id = [neuron_id]
+        load_file = kwargs.pop("load_file", True)
 
         to_return = []
         for nid in neuron_id:
@@ -124,10 +127,14 @@ class MpinMorphologyAPI(Paths):
                 Neuron(
                     filepath,
                     neuron_name="mpin_" + str(nid),
+                    load_file=load_file and workers == 1,
                     **kwargs,
                 )
             )
 
+        if load_file and workers != 1:
+            to_return = load_neurons(to_return, workers=workers)
+
         return to_return
 
     def download_dataset(self):
@@ -145,7 +152,7 @@ class MpinMorphologyAPI(Paths):
 
         # # Download folder with all data:
         download_zip_path = Path(self.mpin_morphology) / "data.zip"
-        retrieve_over_http(REMOTE_URL, download_zip_path)
+        download_file(REMOTE_URL, download_zip_path)
 
         # Uncompress and delete compressed:
         with zipfile.ZipFile(download_zip_path, "r") as zip_ref:
@@ -0,0 +1,210 @@
+"""
+Command line interface, e.g. to mesh all the neurons downloaded from
+MouseLight before rendering them:
+
+    morphapi cache build mouselight_cache --radius 2 --workers 16
+"""
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from morphapi.morphology.batch import warm_cache
+from morphapi.morphology.cache import NeuronCache
+from morphapi.morphology.morphology import Neuron
+from morphapi.paths_manager import Paths, default_paths
+
+# Cache folders of the APIs creating their neurons with invert_dims=True
+_inverted_folders = ("mouselight_cache",)
+
+
+def _format_bytes(n_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n_bytes < 1000:
+            break
+        n_bytes /= 1000
+    else:
+        unit = "TB"
+    return f"{n_bytes:.1f} {unit}"
+
+
+def _resolve_folder(folder, base_dir=None):
+    """
+    Get the path of a folder given as a path or as the name of one of the
+    folders of Paths (e.g. mouselight_cache).
+    """
+    if folder in default_paths and not Path(folder).is_dir():
+        return Path(getattr(Paths(base_dir=base_dir), folder))
+    return Path(folder)
+
+
+def _cache_build(args):
+    folder = _resolve_folder(args.folder, args.base_dir)
+    if not folder.is_dir():
+        print(f"{folder} is not a folder", file=sys.stderr)
+        return 1
+
+    invert_dims = args.invert_dims
+    if invert_dims is None:
+        invert_dims = folder.resolve() in [
+            Path(getattr(Paths(base_dir=args.base_dir), name)).resolve()
+            for name in _inverted_folders
+        ]
+    neurons = [
+        Neuron(
+            data_file,
+            invert_dims=invert_dims,
+            load_file=False,
+            base_dir=args.base_dir,
+            max_cache_size=args.max_size,
+            cache_max_error=args.max_error,
+        )
+        for data_file in sorted(folder.glob("*.swc"))
+    ]
+    if not neurons:
+        print(f"No .swc files found in {folder}", file=sys.stderr)
+        return 1
+
+    report = warm_cache(
+        neurons,
+        workers=args.workers,
+        neurite_radius=args.radius,
+        soma_radius=args.soma_radius,
+        mode=args.mode,
+        lod=args.lod,
+        simplify_tolerance=args.simplify_tolerance,
+    )
+
+    seconds = max(report.seconds, 1e-9)
+    print(
+        f"Meshed {report.n_meshed} of {report.n_neurons} neurons in "
+        f"{report.seconds:.1f} s ({report.n_cached} already cached, "
+        f"{report.n_failed} failed)"
+    )
+    print(
+        f"{report.n_meshed / seconds:.2f} neurons/s, "
+        f"{report.n_triangles / seconds:,.0f} triangles/s, "
+        f"{_format_bytes(report.n_bytes)} written "
+        f"({_format_bytes(report.n_bytes / seconds)}/s)"
+    )
+    return 1 if report.n_failed else 0
+
+
+def _cache_stats(args):
+    stats = NeuronCache(base_dir=args.base_dir).stats()
+    print(
+        f"{stats.n_files} files for {stats.n_neurons} neurons, "
+        f"{_format_bytes(stats.size)}"
+    )
+    return 0
+
+
+def _cache_prune(args):
+    freed = NeuronCache(base_dir=args.base_dir).prune(
+        max_size=args.max_size, max_age=args.max_age
+    )
+    print(f"Freed {_format_bytes(freed)}")
+    return 0
+
+
+def _cache_rebuild(args):
+    n_meshes = NeuronCache(base_dir=args.base_dir).rebuild_manifest()
+    print(f"Rebuilt the cache manifest with {n_meshes} meshes")
+    return 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog="morphapi")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cache = commands.add_parser("cache", help="manage the meshes cache")
+    cache_commands = cache.add_subparsers(dest="cache_command", required=True)
+
+    base_dir = argparse.ArgumentParser(add_help=False)
+    base_dir.add_argument(
+        "--base-dir",
+        help="morphapi data folder (default: ~/.brainglobe/morphapi)",
+    )
+
+    build = cache_commands.add_parser(
+        "build",
+        parents=[base_dir],
+        help="mesh all the neurons of a folder and cache their meshes",
+    )
+    build.add_argument(
+        "folder",
+        help="folder with .swc files, or name of a morphapi cache folder "
+        f"({', '.join(k for k in default_paths if k.endswith('_cache'))})",
+    )
+    build.add_argument("--radius", type=float, default=2)
+    build.add_argument("--soma-radius", type=float, default=4)
+    build.add_argument("--mode", choices=Neuron._mesh_modes, default="tubes")
+    build.add_argument("--lod", type=int, default=0)
+    build.add_argument("--simplify-tolerance", type=float)
+    build.add_argument(
+        "--invert-dims",
+        action=argparse.BooleanOptionalAction,
+        help="swap the x and z coordinates (default: only for "
+        "mouselight_cache, like MouseLightAPI)",
+    )
+    build.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes (default: one per CPU)",
+    )
+    build.add_argument(
+        "--max-error",
+        type=float,
+        help="write the meshes with the compact encoding, with at most "
+        "this error on vertex positions in microns",
+    )
+    build.add_argument(
+        "--max-size",
+        type=int,
+        help="maximum size of the meshes cache in bytes",
+    )
+    build.set_defaults(function=_cache_build)
+
+    stats = cache_commands.add_parser(
+        "stats", parents=[base_dir], help="show the size of the cache"
+    )
+    stats.set_defaults(function=_cache_stats)
+
+    prune = cache_commands.add_parser(
+        "prune",
+        parents=[base_dir],
+        help="delete the least recently used meshes",
+    )
+    prune.add_argument(
+        "--max-size", type=int, help="size in bytes to reduce the cache to"
+    )
+    prune.add_argument(
+        "--max-age",
+        type=float,
+        help="delete the meshes not used for this many seconds",
+    )
+    prune.set_defaults(function=_cache_prune)
+
+    rebuild = cache_commands.add_parser(
+        "rebuild",
+        parents=[base_dir],
+        help="recreate the cache manifest from the cached files",
+    )
+    rebuild.set_defaults(function=_cache_rebuild)
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the morphapi command.
+
+    :param argv: list of arguments (defaults to sys.argv[1:])
+    :returns: int, exit status
+    """
+    logging.basicConfig(level=logging.WARNING)
+    args = _parser().parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import importlib
+
+# Functions and classes of the submodules, imported when they're first
+# accessed so that importing a submodule (e.g. to create a Neuron) doesn't
+# import all of their dependencies
+_exports = {
+    "cache_parsed_swcs": "batch",
+    "create_meshes": "batch",
+    "load_neurons": "batch",
+    "warm_cache": "batch",
+    "DensityGrid": "density",
+    "rasterize": "density",
+    "population_morphometrics": "morphometrics",
+    "merge_population": "population",
+    "projection_matrix": "projection",
+    "MorphologyStore": "store",
+    "SomaIndex": "soma_index",
+    "SpatialIndex": "spatial",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(f"{__name__}.{_exports[name]}")
+    return getattr(module, name)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
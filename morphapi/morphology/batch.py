@@ -0,0 +1,423 @@
+"""
+Functions to process many neurons at once across a pool of processes.
+"""
+
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from rich.progress import track
+
+from morphapi.morphology.cache import flush_manifests
+from morphapi.morphology.compact import (
+    load_swc,
+    save_parsed_swc,
+)
+from morphapi.morphology.meshing import arrays_to_mesh, mesh_to_arrays
+from morphapi.morphology.morphology import Neuron
+
+logger = logging.getLogger(__name__)
+
+# Summary of warm_cache: number of neurons that were already cached, that
+# were meshed and that failed, and triangles and bytes written
+warm_cache_report = namedtuple(
+    "warm_cache_report",
+    "n_neurons n_cached n_meshed n_failed n_triangles n_bytes seconds",
+)
+
+
+def _neuron_spec(neuron):
+    """
+    Get the arguments needed to re-create a neuron in a worker process,
+    so that only paths (and not parsed morphologies) are pickled.
+
+    :param neuron: Neuron instance or path to a .swc file
+    """
+    if isinstance(neuron, Neuron):
+        return dict(
+            data_file=str(neuron.data_file),
+            neuron_name=neuron.neuron_name,
+            invert_dims=neuron.invert_dims,
+            base_dir=str(neuron.base_dir),
+            meshes_cache=neuron.meshes_cache,
+            max_cache_size=neuron.max_cache_size,
+            cache_max_error=neuron.cache_max_error,
+        )
+    return dict(data_file=str(neuron))
+
+
+def _mesh_worker(spec, mesh_kwargs):
+    """
+    Load a neuron, create its mesh (writing it to the cache) and return
+    the raw buffers of each component.
+
+    :returns: tuple with a dictionary of mesh buffers (or None) and an
+        error message (or None)
+    """
+    try:
+        neuron = Neuron(**spec)
+        meshes = neuron.create_mesh(**mesh_kwargs)
+        if meshes is None:
+            raise ValueError("No data could be loaded")
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
+    finally:
+        # Record the cache hits, workers exit without running atexit
+        flush_manifests()
+
+    neurites, whole_neuron = meshes
+    buffers = {
+        key: mesh_to_arrays(mesh) if mesh is not None else None
+        for key, mesh in neurites.items()
+    }
+    buffers["whole_neuron"] = mesh_to_arrays(whole_neuron)
+    return buffers, None
+
+
+def _rebuild_meshes(buffers, colors):
+    """
+    Rebuild and color the meshes of a neuron from the buffers returned
+    by a worker.
+    """
+    neurites = {
+        key: arrays_to_mesh(*arrays) if arrays is not None else None
+        for key, arrays in buffers.items()
+    }
+    whole_neuron = neurites.pop("whole_neuron")
+    for ntype in Neuron._neurite_types:
+        neurites.setdefault(ntype, None)
+
+    Neuron._color_meshes(neurites, whole_neuron, *colors)
+    return neurites, whole_neuron
+
+
+def create_meshes(neurons, workers=None, **mesh_kwargs):
+    """
+    Create the meshes of many neurons in parallel.
+
+    Each worker loads a neuron from its file, creates its mesh with
+    Neuron.create_mesh (which also writes it to the meshes cache) and
+    sends back the vertices and faces as NumPy arrays.
+
+    :param neurons: list of Neuron instances or paths to .swc files
+    :param workers: int, number of processes to use. If None, one per
+        CPU is used; if 1 all neurons are processed in this process.
+    :param mesh_kwargs: keyword arguments passed to Neuron.create_mesh
+        (e.g. neurite_radius, use_cache, colors)
+    :returns: list with a (neurites, whole_neuron) tuple for each neuron,
+        in the same order as neurons. None is returned for the neurons
+        that could not be meshed.
+    """
+    if not isinstance(neurons, (list, tuple)):
+        neurons = [neurons]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Colors are applied here, only mesh parameters are sent to workers
+    *colors, mesh_kwargs = Neuron._parse_mesh_kwargs(**mesh_kwargs)
+
+    specs = [_neuron_spec(neuron) for neuron in neurons]
+    if workers == 1 or len(specs) <= 1:
+        results = [_mesh_worker(spec, mesh_kwargs) for spec in specs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(_mesh_worker, specs, [mesh_kwargs] * len(specs))
+            )
+
+    meshes = []
+    for spec, (buffers, error) in zip(specs, results):
+        if buffers is None:
+            logger.error(
+                "Could not create the mesh of %s for the following "
+                "reason: %s",
+                spec["data_file"],
+                error,
+            )
+            meshes.append(None)
+        else:
+            meshes.append(_rebuild_meshes(buffers, colors))
+
+    return meshes
+
+
+def _warm_cache_worker(spec, mesh_kwargs):
+    """
+    Create the mesh of a neuron and write it to the cache, unless it's
+    already cached.
+
+    :returns: tuple with the status ("cached", "meshed" or "failed"), the
+        number of triangles and bytes written and an error message
+        (or None)
+    """
+    try:
+        neuron = Neuron(**spec, load_file=False)
+        _params = neuron._mesh_params(**mesh_kwargs)
+        if neuron._check_neuron_mesh_cached(neuron.neuron_name, _params):
+            # Warmed meshes are in use, keep them from being pruned
+            neuron.manifest.touch(neuron.cache_key(_params))
+            return "cached", 0, 0, None
+
+        neuron.load_from_file()
+        meshes = neuron.create_mesh(**mesh_kwargs)
+        if meshes is None:
+            raise ValueError("No data could be loaded")
+    except Exception as exc:
+        return "failed", 0, 0, f"{type(exc).__name__}: {exc}"
+    finally:
+        # Record the cache hits, workers exit without running atexit
+        flush_manifests()
+
+    # Count the full resolution meshes and the levels of detail written
+    # along with them
+    n_triangles, n_bytes = 0, 0
+    levels = range(len(neuron.lod_triangle_budgets) + 1)
+    for lod in levels if _params["lod"] else [0]:
+        entry = neuron.manifest.lookup(
+            neuron.cache_key(dict(_params, lod=lod)), neuron.neuron_name
+        )
+        if entry is not None:
+            n_bytes += entry.size
+            n_triangles += sum(
+                spec["shape"][0]
+                for name, spec in entry.header["arrays"].items()
+                if name.endswith("/faces") and spec["shape"][-1] == 3
+            )
+    return "meshed", n_triangles, n_bytes, None
+
+
+def warm_cache(
+    neurons,
+    workers=None,
+    neurite_radius=2,
+    soma_radius=4,
+    mode="tubes",
+    lod=0,
+    simplify_tolerance=None,
+):
+    """
+    Create the meshes of many neurons in parallel and write them to the
+    meshes cache, skipping the neurons that are already cached with the
+    same parameters. Unlike create_meshes, the meshes are not sent back.
+
+    Cached meshes are found by the content of the neurons' data files, so
+    the meshes written are used whatever the name of the neurons (e.g.
+    when they are downloaded again by one of the APIs).
+
+    :param neurons: path to a folder with .swc files (e.g. one of the
+        cache folders of morphapi.paths_manager.Paths), or list of paths
+        to .swc files and/or Neuron instances
+    :param workers: int, number of processes to use. If None, one per
+        CPU is used.
+    :param neurite_radius: float, radius of the neurites' tubes
+    :param soma_radius: float, radius of the soma
+    :param mode: str, "tubes" or "lines"
+    :param lod: int, level of detail (see Neuron.create_mesh)
+    :param simplify_tolerance: float, see Neuron.create_mesh
+    :returns: warm_cache_report
+    """
+    if isinstance(neurons, (str, Path)) and Path(neurons).is_dir():
+        neurons = sorted(Path(neurons).glob("*.swc"))
+    elif not isinstance(neurons, (list, tuple)):
+        neurons = [neurons]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    mesh_kwargs = dict(
+        neurite_radius=neurite_radius,
+        soma_radius=soma_radius,
+        mode=mode,
+        lod=lod,
+        simplify_tolerance=simplify_tolerance,
+    )
+    specs = [_neuron_spec(neuron) for neuron in neurons]
+    description = "Meshing neurons"
+    start = time.perf_counter()
+    if workers == 1 or len(specs) <= 1:
+        results = [
+            _warm_cache_worker(spec, mesh_kwargs)
+            for spec in track(specs, description=description)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                track(
+                    executor.map(
+                        _warm_cache_worker,
+                        specs,
+                        [mesh_kwargs] * len(specs),
+                    ),
+                    total=len(specs),
+                    description=description,
+                )
+            )
+
+    for spec, (status, _, _, error) in zip(specs, results):
+        if status == "failed":
+            logger.error(
+                "Could not create the mesh of %s: %s",
+                spec["data_file"],
+                error,
+            )
+
+    statuses = [status for status, *_ in results]
+    return warm_cache_report(
+        n_neurons=len(specs),
+        n_cached=statuses.count("cached"),
+        n_meshed=statuses.count("meshed"),
+        n_failed=statuses.count("failed"),
+        n_triangles=sum(n_triangles for _, n_triangles, _, _ in results),
+        n_bytes=sum(n_bytes for _, _, n_bytes, _ in results),
+        seconds=time.perf_counter() - start,
+    )
+
+
+def _save_parsed_worker(swc_path, overwrite):
+    try:
+        return save_parsed_swc(swc_path, overwrite=overwrite), None
+    except Exception as exc:
+        return False, f"{type(exc).__name__}: {exc}"
+
+
+def cache_parsed_swcs(folder, workers=None, overwrite=False):
+    """
+    Parse all .swc files in a folder (e.g. one of the cache folders in
+    morphapi.paths_manager.Paths) and save them to binary files next to
+    them, which Neuron.load_from_file then loads instead of the text.
+
+    :param folder: path to a folder with .swc files
+    :param workers: int, number of processes to use. If None, one per
+        CPU is used.
+    :param overwrite: bool, if False files with an up to date binary cache
+        are skipped
+    :returns: int, number of files written
+    """
+    files = sorted(Path(folder).glob("*.swc"))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    description = f"Caching parsed morphologies in {folder}"
+    if workers == 1 or len(files) <= 1:
+        results = [
+            _save_parsed_worker(swc_path, overwrite)
+            for swc_path in track(files, description=description)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                track(
+                    executor.map(
+                        _save_parsed_worker,
+                        files,
+                        [overwrite] * len(files),
+                        chunksize=max(1, len(files) // (workers * 4)),
+                    ),
+                    total=len(files),
+                    description=description,
+                )
+            )
+
+    for swc_path, (_, error) in zip(files, results):
+        if error is not None:
+            logger.error("Could not parse %s: %s", swc_path, error)
+
+    return sum(written for written, _ in results)
+
+
+def _load_compact(spec):
+    """
+    Load the compact morphology of a neuron with the fast reader, or with
+    NeuroM for the files it rejects, as Neuron.load_from_swc does.
+    """
+    try:
+        return load_swc(spec["data_file"])
+    except ValueError as exc:
+        logger.debug(
+            "Could not read %s with the fast reader, using NeuroM: %s",
+            spec["data_file"],
+            exc,
+        )
+    neuron = Neuron(**spec, load_file=False)
+    neuron.load_from_swc(fast=False)
+    return neuron.compact
+
+
+def _load_worker(spec):
+    """
+    Load the compact morphology of a neuron, whose arrays are pickled to
+    be sent to the parent process.
+
+    :returns: tuple with the CompactMorphology (or None) and an error
+        message (or None)
+    """
+    try:
+        return _load_compact(spec), None
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
+
+
+def load_neurons(neurons, workers=None, lazy=False, chunksize=None):
+    """
+    Load many neurons from their .swc files across a pool of processes.
+
+    Workers parse the files (or load their binary cache, see
+    cache_parsed_swcs), falling back to NeuroM like Neuron.load_from_swc,
+    and send back the arrays of a CompactMorphology; Neuron instances are
+    then rebuilt from them with Neuron.from_compact in this process.
+
+    :param neurons: path to a folder with .swc files, or list of paths to
+        .swc files and/or Neuron instances (e.g. created with
+        load_file=False), whose name and options are kept
+    :param workers: int, number of processes to use. If None, one per
+        CPU is used; if 1 all neurons are loaded in this process.
+    :param lazy: bool, if True an iterator yielding the neurons as they
+        are loaded is returned instead of a list
+    :param chunksize: int, number of files sent to a worker at once. By
+        default the files are split in about four chunks per worker.
+    :returns: list (or iterator) with a Neuron for each neuron, in the
+        same order as neurons. None is returned for the neurons that
+        could not be loaded.
+    """
+    if isinstance(neurons, (str, Path)) and Path(neurons).is_dir():
+        neurons = sorted(Path(neurons).glob("*.swc"))
+    elif not isinstance(neurons, (list, tuple)):
+        neurons = [neurons]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(neurons) // (workers * 4))
+
+    specs = [_neuron_spec(neuron) for neuron in neurons]
+    loaded = _iter_loaded(specs, workers, chunksize)
+    return loaded if lazy else list(loaded)
+
+
+def _iter_loaded(specs, workers, chunksize):
+    if workers == 1 or len(specs) <= 1:
+        yield from _rebuild_loaded(specs, map(_load_worker, specs))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_load_worker, specs, chunksize=chunksize)
+        yield from _rebuild_loaded(specs, results)
+
+
+def _rebuild_loaded(specs, results):
+    """
+    Create the neurons from the compact morphologies loaded by
+    _load_worker, as they come.
+    """
+    for spec, (compact, error) in track(
+        zip(specs, results),
+        total=len(specs),
+        description=f"Loading {len(specs)} neurons",
+    ):
+        if compact is None:
+            logger.error("Could not load %s: %s", spec["data_file"], error)
+            yield None
+        else:
+            spec = dict(spec)
+            yield Neuron.from_compact(compact, spec.pop("data_file"), **spec)
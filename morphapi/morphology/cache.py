@@ -1,12 +1,154 @@
+import atexit
+import hashlib
+import json
+import logging
 import os
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from pathlib import Path
 
-from vedo import Mesh, load, merge, write
+import numpy as np
+from vedo import Mesh, merge
 
+from morphapi.morphology.manifest import CacheManifest
+from morphapi.morphology.mesh_file import load_mesh_file, write_mesh_file
 from morphapi.paths_manager import Paths
-from morphapi.utils.data_io import load_yaml, save_yaml
+
+logger = logging.getLogger(__name__)
+
+# Summary of the content of a meshes cache, sizes are in bytes
+cache_stats = namedtuple("cache_stats", "n_neurons n_files size max_size")
+
+# Manifest of each meshes cache folder, shared by all NeuronCache instances
+_manifests: dict[str, CacheManifest] = {}
+
+
+def _process_exists(pid):
+    # Signal 0 only checks the process, but os.kill terminates processes
+    # on Windows, where they are assumed to exist
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@atexit.register
+def flush_manifests():
+    """
+    Write the accesses to cached meshes recorded by this process to the
+    manifests. This is done at exit, but processes that don't run atexit
+    handlers (e.g. the workers of a ProcessPoolExecutor) must call it.
+    """
+    for manifest in _manifests.values():
+        manifest.flush()
+
+
+class MeshMemoryCache:
+    """
+    In-memory LRU cache of the meshes of neurons, in front of the files
+    of NeuronCache. Its size is bounded by the total size of the meshes'
+    vertices.
+
+    Meshes are stored and returned as shallow copies, which share their
+    vertices and faces but not their properties (e.g. color), so that
+    callers coloring the meshes don't affect each other. Meshes should
+    not be modified in place (e.g. by moving their vertices), use
+    mesh.clone() first.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        :param max_bytes: int, maximum total size of the cached vertices
+            in bytes. 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return (
+            f"MeshMemoryCache({len(self)} entries, {self.size} bytes, "
+            f"{self.hits} hits, {self.misses} misses)"
+        )
+
+    @staticmethod
+    def _copy(meshes):
+        return {
+            key: mesh.clone(deep=False) if mesh is not None else None
+            for key, mesh in meshes.items()
+        }
+
+    @staticmethod
+    def _nbytes(meshes):
+        return sum(
+            mesh.vertices.nbytes
+            for mesh in meshes.values()
+            if mesh is not None
+        )
+
+    def get(self, key):
+        """
+        Get copies of the meshes cached under a key.
+
+        :param key: hashable key, e.g. a cache folder and cache_key
+        :returns: dictionary of meshes, or None if they are not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._copy(entry[0])
+
+    def put(self, key, meshes):
+        """
+        Cache copies of some meshes, evicting the least recently used
+        ones if the cache gets larger than max_bytes.
+
+        :param key: hashable key
+        :param meshes: dictionary of vedo Mesh (or None)
+        """
+        nbytes = self._nbytes(meshes)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (self._copy(meshes), nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        """
+        Remove all the meshes and reset the hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
 
 
 class NeuronCache(Paths):
+    # Components of the cached meshes, and parts of the names of the OBJ
+    # files written by previous versions (see remove_obj_cache)
     cache_filenames_parts = [
         "_soma",
         "_axon",
@@ -15,17 +157,82 @@ class NeuronCache(Paths):
         "whole_neuron",
     ]
 
-    def __init__(self, **kwargs):
+    # Meshes loaded or written by any instance in this process
+    memory_cache = MeshMemoryCache()
+
+    # Locks are refreshed by their holder every lock_refresh_interval
+    # seconds. Locks not refreshed for lock_timeout seconds, or held by a
+    # process of this host that doesn't exist anymore, were abandoned
+    # (e.g. by a process that crashed while building a mesh) and are
+    # broken.
+    lock_timeout = 600
+    lock_refresh_interval = 60
+    lock_poll_interval = 0.05
+
+    # When a write exceeds the budget, the cache is pruned to this
+    # fraction of it so that the next writes don't trigger a prune again
+    prune_fraction = 0.9
+
+    def __init__(self, max_cache_size=None, cache_max_error=None, **kwargs):
         """
         Initialise API interaction and fetch metadata of neurons
         in the Allen Database.
+
+        :param max_cache_size: int, maximum size of the meshes cache in
+            bytes, shared by all the processes writing to the cache. When
+            writing a mesh makes the cache larger, the least recently
+            used files are deleted. If None the size of the cache is not
+            bounded.
+        :param cache_max_error: float, if given meshes are written to the
+            cache with a compact encoding (about 10 times smaller), where
+            vertex positions are quantized with at most this error in
+            microns (see morphapi.morphology.mesh_file.write_mesh_file)
         """
         super().__init__(**kwargs)  # path to data caches
 
+        if max_cache_size is not None and not max_cache_size > 0:
+            raise ValueError(
+                "Invalid value for parameter max_cache_size, "
+                "should be a number of bytes > 0"
+            )
+        self.max_cache_size = max_cache_size
+
+        if cache_max_error is not None and not cache_max_error > 0:
+            raise ValueError(
+                "Invalid value for parameter cache_max_error, "
+                "should be a float > 0"
+            )
+        self.cache_max_error = cache_max_error
+
+    @staticmethod
+    def cache_key(_params):
+        """
+        Get the key of the cached meshes created with some parameters,
+        a hash of the parameters (which include a hash of the neuron's
+        data file, see Neuron._mesh_params).
+
+        :param _params: dictionary of JSON serializable parameters
+        :returns: str, 16 hexadecimal characters
+        """
+        return hashlib.blake2b(
+            json.dumps(_params, sort_keys=True).encode("utf-8"),
+            digest_size=8,
+        ).hexdigest()
+
+    def get_cache_filename(self, neuron_name, _params):
+        """
+        Get the path of the mesh file (see morphapi.morphology.mesh_file)
+        caching the meshes of a neuron created with some parameters.
+        Meshes created with different parameters are cached side by side
+        in the neuron's folder.
+        """
+        fld = os.path.join(self.meshes_cache, str(neuron_name))
+        os.makedirs(fld, exist_ok=True)
+        return os.path.join(fld, self.cache_key(_params) + ".mesh")
+
     def get_cache_filenames(self, neuron_name):
         fld = os.path.join(self.meshes_cache, str(neuron_name))
-        if not os.path.isdir(fld):
-            os.mkdir(fld)
+        os.makedirs(fld, exist_ok=True)
         return [
             os.path.join(fld, str(neuron_name) + part + ".obj")
             for part in self.cache_filenames_parts
@@ -33,96 +240,396 @@ class NeuronCache(Paths):
 
     def get_cache_params_filename(self, neuron_name):
         fld = os.path.join(self.meshes_cache, str(neuron_name))
-        if not os.path.isdir(fld):
-            os.mkdir(fld)
+        os.makedirs(fld, exist_ok=True)
 
         return os.path.join(fld, str(neuron_name) + "_params.yml")
 
-    def _check_neuron_mesh_cached(self, neuron_name):
-        # If any of the files doesn't exist, the neuron wasn't cached
-        for fn in self.get_cache_filenames(neuron_name):
-            if not os.path.isfile(fn):
-                return False
-        return True
+    def _check_neuron_mesh_cached(self, neuron_name, _params):
+        entry = self.manifest.lookup(self.cache_key(_params), neuron_name)
+        return (
+            entry is not None
+            and not self._params_changed(entry.params, _params)
+            and os.path.isfile(os.path.join(self.meshes_cache, entry.file))
+        )
+
+    @staticmethod
+    def _params_changed(cached_params, _params):
+        if len(cached_params) != len(_params):
+            return True
+        return any(v != cached_params.get(k) for k, v in _params.items())
+
+    @contextmanager
+    def cache_lock(self, neuron_name, _params):
+        """
+        Lock the cache entry of the meshes of a neuron created with some
+        parameters, so that only one process or thread builds them.
+
+        The lock is a file next to the cached meshes, created atomically
+        and touched every lock_refresh_interval seconds while it's held.
+        Waiting processes poll it until it's removed or abandoned (see
+        lock_timeout).
+
+        :param neuron_name: str, name of the neuron
+        :param _params: dictionary with the parameters of the meshes
+        :returns: context manager yielding True if the lock was held by
+            someone else (who probably cached the meshes meanwhile)
+        """
+        file_name = self.get_cache_filename(neuron_name, _params)
+        lock_file = os.path.join(
+            os.path.dirname(file_name), f".{self.cache_key(_params)}.lock"
+        )
+
+        waited = False
+        while True:
+            try:
+                fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                waited = True
+            else:
+                holder = f"{os.getpid()} {socket.gethostname()}"
+                os.write(fd, holder.encode("utf-8"))
+                os.close(fd)
+                break
+
+            if self._lock_abandoned(lock_file):
+                logger.warning("Breaking abandoned cache lock %s", lock_file)
+                try:
+                    os.remove(lock_file)
+                except FileNotFoundError:
+                    pass
+            else:
+                time.sleep(self.lock_poll_interval)
+
+        # Touch the lock while the meshes are built, so that it isn't
+        # taken for abandoned however long it takes
+        released = threading.Event()
+
+        def refresh():
+            while not released.wait(self.lock_refresh_interval):
+                try:
+                    os.utime(lock_file)
+                except OSError:
+                    return
+
+        refresher = threading.Thread(target=refresh, daemon=True)
+        refresher.start()
+        try:
+            yield waited
+        finally:
+            released.set()
+            refresher.join()
+            try:
+                os.remove(lock_file)
+            except FileNotFoundError:
+                pass
+
+    def _lock_abandoned(self, lock_file):
+        try:
+            age = time.time() - os.path.getmtime(lock_file)
+            with open(lock_file) as f:
+                holder = f.read().split()
+        except FileNotFoundError:
+            return False
+        if age > self.lock_timeout:
+            return True
+
+        # The lock may not be written yet
+        if len(holder) != 2 or not holder[0].isdigit():
+            return False
+        pid, host = int(holder[0]), holder[1]
+        return host == socket.gethostname() and not _process_exists(pid)
+
+    @property
+    def manifest(self):
+        """
+        CacheManifest of the meshes cache, made from the cached files
+        the first time it's used.
+        """
+        manifest = _manifests.get(self.meshes_cache)
+        if manifest is None:
+            file_path = os.path.join(self.meshes_cache, "manifest.sqlite")
+            exists = os.path.isfile(file_path)
+            manifest = CacheManifest(file_path)
+            if not exists:
+                manifest.rebuild(self.meshes_cache, self.cache_key)
+            _manifests[self.meshes_cache] = manifest
+        return manifest
+
+    def rebuild_manifest(self):
+        """
+        Recreate the manifest of the meshes cache from the cached files,
+        e.g. after files were deleted or copied by hand.
+
+        :returns: int, number of cached meshes
+        """
+        self.memory_cache.clear()
+        return self.manifest.rebuild(self.meshes_cache, self.cache_key)
 
     def load_cached_neuron(self, neuron_name, _params):
-        if not self._check_neuron_mesh_cached(neuron_name):
+        key = self.cache_key(_params)
+        memory_key = (self.meshes_cache, key)
+        loaded = self.memory_cache.get(memory_key)
+        if loaded is not None:
+            self.manifest.touch(key)
+            return loaded
+
+        entry = self.manifest.lookup(key, neuron_name)
+        # Guard against hash collisions
+        if entry is None or self._params_changed(entry.params, _params):
             return None
 
-        # Check if params are the same as when cached
-        cached_params = load_yaml(self.get_cache_params_filename(neuron_name))
-        if len(cached_params) != len(_params):
-            changed = cached_params.values()
-        else:
-            changed = {v for k, v in _params.items() if v != cached_params[k]}
-        if changed:
+        try:
+            loaded, _ = load_mesh_file(
+                os.path.join(self.meshes_cache, entry.file),
+                header=entry.header,
+                data_start=entry.data_start,
+            )
+        except FileNotFoundError:
+            # Deleted by other means than prune
+            self.manifest.remove([(entry.neuron, key)])
             return None
+        self.manifest.touch(key)
+        self.memory_cache.put(memory_key, loaded)
+        return loaded
 
-        # Load neurites
-        neurites = [
-            "soma",
-            "axon",
-            "apical_dendrites",
-            "basal_dendrites",
-            "whole_neuron",
-        ]
-        loaded = {
-            nn: load(fp)
-            for nn, fp in zip(neurites, self.get_cache_filenames(neuron_name))
-        }
+    def _cache_files(self):
+        """
+        Get the path, neuron, size and access time of all the files in
+        the meshes cache, except the temporary files being written.
+        """
+        # Imported here to keep importing Neuron fast
+        import pandas as pd
 
-        for nn, act in loaded.items():
-            if len(act.vertices) == 0:
-                loaded[nn] = None
+        rows = []
+        with os.scandir(self.meshes_cache) as folders:
+            for folder in folders:
+                if not folder.is_dir():
+                    continue
+                with os.scandir(folder.path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                        rows.append(
+                            (
+                                entry.path,
+                                folder.name,
+                                stat.st_size,
+                                stat.st_atime_ns,
+                            )
+                        )
+        files = pd.DataFrame(
+            rows, columns=["file", "neuron", "size", "atime_ns"]
+        ).astype(dict(size=np.int64, atime_ns=np.int64))
 
-        return loaded
+        # Accesses are recorded in the manifest, file access times are
+        # not reliably updated by reads
+        entries = self.manifest.entries()
+        accessed = dict(
+            zip(
+                [os.path.join(self.meshes_cache, f) for f in entries["file"]],
+                entries["accessed_ns"],
+            )
+        )
+        files["atime_ns"] = np.maximum(
+            files["atime_ns"],
+            files["file"].map(accessed).fillna(0).astype(np.int64),
+        )
+        return files
 
-    def write_neuron_to_cache(self, neuron_name, neuron, _params):
-        # Write params to file
-        save_yaml(self.get_cache_params_filename(neuron_name), _params)
+    def stats(self):
+        """
+        Get the number of neurons and files in the meshes cache and its
+        size.
+
+        :returns: cache_stats
+        """
+        files = self._cache_files()
+        size = int(files["size"].sum())
+        return cache_stats(
+            n_neurons=files["neuron"].nunique(),
+            n_files=len(files),
+            size=size,
+            max_size=self.max_cache_size,
+        )
+
+    def prune(self, max_size=None, max_age=None, keep=()):
+        """
+        Delete the least recently used files of the meshes cache.
+
+        :param max_size: int, size in bytes the cache is reduced to.
+            Defaults to max_cache_size, if both are None the size of the
+            cache is not reduced.
+        :param max_age: float, if given the files that were not used for
+            more than max_age seconds are deleted too
+        :param keep: list of paths of files that are never deleted
+        :returns: int, number of bytes freed
+        """
+        if max_size is None:
+            max_size = self.max_cache_size
 
-        # Write neurons to file
-        file_names = self.get_cache_filenames(neuron_name)
+        files = self._cache_files().sort_values("atime_ns")
+        remove = np.zeros(len(files), dtype=bool)
+        if max_age is not None:
+            remove |= files["atime_ns"].to_numpy() < (
+                time.time_ns() - max_age * 1e9
+            )
+        if max_size is not None:
+            # Size of each file plus all the more recently used ones
+            newer_size = files["size"].to_numpy()[::-1].cumsum()[::-1]
+            remove |= newer_size > max_size
+        remove &= ~files["file"].isin([str(f) for f in keep]).to_numpy()
+
+        freed, removed = 0, []
+        for file_name, neuron, size in zip(
+            files["file"][remove],
+            files["neuron"][remove],
+            files["size"][remove],
+        ):
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                # Removed by another process
+                pass
+            except OSError as exc:
+                # e.g. still memory-mapped on Windows
+                logger.debug("Could not remove %s: %s", file_name, exc)
+                continue
+            else:
+                freed += size
+            removed.append((file_name, neuron))
+
+        self.manifest.remove(
+            [
+                (neuron, Path(file_name).stem)
+                for file_name, neuron in removed
+                if file_name.endswith(".mesh")
+            ]
+        )
+        for folder in {os.path.dirname(file_name) for file_name, _ in removed}:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # Not empty
+                pass
+
+        if freed:
+            logger.info(
+                "Removed %s files (%s bytes) from the meshes cache",
+                len(removed),
+                freed,
+            )
+        return int(freed)
+
+    def _account_write(self, file_name):
+        """
+        Prune the cache if it exceeds max_cache_size after a file was
+        written. The size is read from the manifest, which is shared with
+        the other processes writing to the cache.
+        """
+        if self.max_cache_size is None:
+            return
+
+        if self.manifest.total_size() > self.max_cache_size:
+            self.prune(
+                self.max_cache_size * self.prune_fraction, keep=[file_name]
+            )
+
+    def cached_variants(self, neuron_name):
+        """
+        Get the parameters of all the meshes cached for a neuron.
+
+        :param neuron_name: str, name of the neuron
+        :returns: list of parameter dictionaries
+        """
+        entries = self.manifest.entries(neuron_name)
+        return [json.loads(params) for params in entries["params"]]
+
+    def remove_obj_cache(self):
+        """
+        Delete the meshes cached in OBJ files by previous versions, which
+        are not used anymore. Otherwise they are deleted by prune once
+        they are the least recently used files.
+
+        :returns: int, number of bytes freed
+        """
+        freed = 0
+        for params_file in Path(self.meshes_cache).glob("*/*_params.yml"):
+            neuron_name = params_file.parent.name
+            if params_file.name != f"{neuron_name}_params.yml":
+                continue
+            for file_name in self.get_cache_filenames(neuron_name) + [
+                str(params_file)
+            ]:
+                try:
+                    size = os.path.getsize(file_name)
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    continue
+                freed += size
+        return freed
+
+    def _publish(self, neuron_name, file_name, meshes, _params):
+        # Write a mesh file and add it to the manifest
+        header, data_start = write_mesh_file(
+            file_name, meshes, _params, max_error=self.cache_max_error
+        )
+        self.manifest.add(
+            self.cache_key(_params),
+            neuron_name,
+            os.path.relpath(file_name, self.meshes_cache),
+            header,
+            data_start,
+            os.path.getsize(file_name),
+        )
+        self._account_write(file_name)
+
+    def write_neuron_to_cache(self, neuron_name, neuron, _params):
+        file_name = self.get_cache_filename(neuron_name, _params)
 
         if isinstance(neuron, Mesh):
-            write(neuron, [f for f in file_names if f.endswith("soma.obj")][0])
-        else:
-            if not isinstance(neuron, dict):
+            self._publish(neuron_name, file_name, dict(soma=neuron), _params)
+            return
+
+        if not isinstance(neuron, dict):
+            raise ValueError(
+                f"Invalid neuron argument passed while caching: {neuron}"
+            )
+
+        meshes = {}
+        for key, actor in neuron.items():
+            if key == "whole_neuron":
+                # The whole neuron is made from the components when loading
+                continue
+
+            # Get a single actor for each neuron component.
+            if not isinstance(actor, Mesh):
+                if isinstance(actor, (list, tuple)):
+                    if len(actor) == 1:
+                        actor = actor[0]
+                    elif not actor or actor is None:
+                        actor = None
+                    else:
+                        try:
+                            actor = merge(actor)
+                        except:  # noqa: E722
+                            raise ValueError(
+                                f"{key} actor should be a mesh or a "
+                                f"list of 1 mesh not {actor}"
+                            )
+
+            if f"_{key}" not in self.cache_filenames_parts:
                 raise ValueError(
-                    f"Invalid neuron argument passed while caching: {neuron}"
+                    f"No filename found for {key}. "
+                    f"Components {self.cache_filenames_parts}"
                 )
-            for key, actor in neuron.items():
-                if key == "whole_neuron":
-                    fname = [f for f in file_names if f.endswith(f"{key}.obj")]
-                    write(actor, fname[0])
-                else:
-                    # Get a single actor for each neuron component.
-                    # If there's no data for the component
-                    # create an empty actor
-                    if not isinstance(actor, Mesh):
-                        if isinstance(actor, (list, tuple)):
-                            if len(actor) == 1:
-                                actor = actor[0]
-                            elif not actor or actor is None:
-                                actor = Mesh()
-                            else:
-                                try:
-                                    actor = merge(actor)
-                                except:  # noqa: E722
-                                    raise ValueError(
-                                        f"{key} actor should be a mesh or a "
-                                        f"list of 1 mesh not {actor}"
-                                    )
-
-                    if actor is None:
-                        actor = Mesh()
-
-                    # Save to file
-                    fname = [f for f in file_names if f.endswith(f"{key}.obj")]
-                    if fname:
-                        write(actor, fname[0])
-                    else:
-                        raise ValueError(
-                            f"No filename found for {key}. "
-                            f"Filenames {file_names}"
-                        )
+            meshes[key] = actor
+
+        self._publish(neuron_name, file_name, meshes, _params)
+
+        if isinstance(neuron.get("whole_neuron"), Mesh):
+            meshes["whole_neuron"] = neuron["whole_neuron"]
+            self.memory_cache.put(
+                (self.meshes_cache, self.cache_key(_params)),
+                meshes,
+            )
@@ -0,0 +1,337 @@
+"""
+Compact, array-backed representation of a neuron's morphology.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+from morphapi.morphology.swc import SOMA_TYPE, build_sections, read_swc
+
+
+class CompactMorphology:
+    """
+    Morphology of a neuron stored in a few flat arrays (CSR style):
+
+    - nodes: (N, 4) float32 array with x, y, z and radius of each node.
+      Soma nodes come first, followed by the nodes of each section.
+    - parents: (N,) int32 index of each node's parent node (-1 for none)
+    - types: (N,) int8 SWC structure identifier of each node
+    - section_offsets: (S + 1,) int32, section i is made of the nodes
+      section_offsets[i]:section_offsets[i + 1]
+    - section_types: (S,) int8 SWC structure identifier of each section
+    - section_parents: (S,) int32 index of each section's parent section
+      (-1 for sections starting from the soma)
+
+    Unlike the polylines in Neuron.sections, branching nodes are stored
+    only once: the polyline of a section starts from the last node of its
+    parent section (see section_points).
+    """
+
+    # Version of the arrays saved to .npz files
+    _format_version = 1
+
+    __slots__ = (
+        "name",
+        "nodes",
+        "parents",
+        "types",
+        "section_offsets",
+        "section_types",
+        "section_parents",
+    )
+
+    def __init__(
+        self,
+        nodes,
+        parents,
+        types,
+        section_offsets,
+        section_types,
+        section_parents,
+        name=None,
+    ):
+        self.name = name
+        self.nodes = nodes
+        self.parents = parents
+        self.types = types
+        self.section_offsets = section_offsets
+        self.section_types = section_types
+        self.section_parents = section_parents
+
+    def __repr__(self):
+        return (
+            f"CompactMorphology({self.name!r}, {self.n_nodes} nodes, "
+            f"{self.n_sections} sections)"
+        )
+
+    @classmethod
+    def from_sections(
+        cls,
+        points,
+        offsets,
+        section_types,
+        section_parents,
+        soma_points=None,
+        name=None,
+    ):
+        """
+        Create from section polylines in which each section that doesn't
+        start from the soma begins with a copy of its parent's last point,
+        like in morphio or in morphapi.morphology.swc.build_sections.
+
+        :param points: (M, 4) array with x, y, z, radius of all points
+        :param offsets: (S + 1,) array of section offsets into points
+        :param section_types: (S,) array of section types
+        :param section_parents: (S,) array of parent sections (or -1)
+        :param soma_points: optional (K, 4) array with the soma points
+        :param name: str, name of the neuron
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        section_parents = np.asarray(section_parents, dtype=np.int64)
+        if soma_points is None:
+            soma_points = np.zeros((0, 4))
+        n_soma = len(soma_points)
+
+        # Remove the copies of the parent points
+        has_parent = section_parents >= 0
+        keep = np.ones(len(points), dtype=bool)
+        keep[offsets[:-1][has_parent]] = False
+        lengths = np.diff(offsets) - has_parent
+
+        section_offsets = np.full(len(lengths) + 1, n_soma, dtype=np.int64)
+        section_offsets[1:] += np.cumsum(lengths)
+
+        nodes = np.concatenate([soma_points, points[keep]]).astype(np.float32)
+        types = np.concatenate(
+            [
+                np.full(n_soma, SOMA_TYPE),
+                np.repeat(section_types, lengths),
+            ]
+        ).astype(np.int8)
+
+        # Within a section each node is the child of the previous one,
+        # the first node is the child of the parent's last node or of the
+        # first soma node
+        parents = np.arange(len(nodes), dtype=np.int64) - 1
+        parents[1:n_soma] = 0
+        first = section_offsets[:-1]
+        parents[first] = np.where(
+            has_parent,
+            section_offsets[1:][section_parents] - 1,
+            0 if n_soma else -1,
+        )
+
+        return cls(
+            nodes=nodes,
+            parents=parents.astype(np.int32),
+            types=types,
+            section_offsets=section_offsets.astype(np.int32),
+            section_types=np.asarray(section_types, dtype=np.int8),
+            section_parents=section_parents.astype(np.int32),
+            name=name,
+        )
+
+    @classmethod
+    def from_swc(cls, file_path, name=None):
+        """
+        Read a .swc file with morphapi.morphology.swc.read_swc.
+
+        :param file_path: path to a .swc file
+        :param name: str, name of the neuron
+        """
+        nodes = read_swc(file_path)
+        sections = build_sections(nodes)
+        return cls.from_sections(
+            nodes.points[sections.nodes],
+            sections.offsets,
+            sections.types,
+            sections.parents,
+            soma_points=nodes.points[nodes.types == SOMA_TYPE],
+            name=name,
+        )
+
+    @property
+    def n_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def n_sections(self):
+        return len(self.section_types)
+
+    @property
+    def nbytes(self):
+        """
+        Total size of the arrays in bytes.
+        """
+        return sum(
+            getattr(self, attr).nbytes
+            for attr in self.__slots__
+            if attr != "name"
+        )
+
+    @property
+    def soma(self):
+        """
+        x, y, z, radius of the first soma node, or None without soma.
+        """
+        if self.n_nodes and self.types[0] == SOMA_TYPE:
+            return self.nodes[0]
+        return None
+
+    def section_points(self, mask=None):
+        """
+        Get the polylines of (a subset of) the sections, each starting
+        with the last node of its parent section.
+
+        :param mask: optional (S,) boolean array to select sections
+        :returns: tuple with the (M, 4) points of the sections and their
+            (S + 1,) offsets
+        """
+        if mask is None:
+            mask = np.ones(self.n_sections, dtype=bool)
+
+        starts = self.section_offsets[:-1][mask].astype(np.int64)
+        ends = self.section_offsets[1:][mask].astype(np.int64)
+        section_parents = self.section_parents[mask]
+        has_parent = section_parents >= 0
+
+        lengths = ends - starts + has_parent
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        index = np.arange(offsets[-1]) + np.repeat(
+            starts - has_parent - offsets[:-1], lengths
+        )
+        index[offsets[:-1][has_parent]] = (
+            self.section_offsets[1:][section_parents[has_parent]] - 1
+        )
+        return self.nodes[index], offsets
+
+    def neurite_sections(self, section_type):
+        """
+        Get the polylines of all sections of a given type.
+
+        :param section_type: int, SWC structure identifier
+        :returns: tuple with points and offsets, see section_points
+        """
+        return self.section_points(self.section_types == section_type)
+
+    def save(self, file_path, source=None):
+        """
+        Save the arrays to a .npz file.
+
+        :param file_path: path to the .npz file
+        :param source: optional path to the file the morphology was read
+            from. Its size and modification time are saved, so that load
+            can detect when the .npz file is out of date.
+        """
+        stat = os.stat(source) if source is not None else None
+        np.savez(
+            file_path,
+            format_version=self._format_version,
+            source_size=stat.st_size if stat else -1,
+            source_mtime_ns=stat.st_mtime_ns if stat else -1,
+            **{
+                attr: getattr(self, attr)
+                for attr in self.__slots__
+                if attr != "name"
+            },
+        )
+
+    @classmethod
+    def load(cls, file_path, source=None, name=None):
+        """
+        Load the arrays saved with save.
+
+        :param file_path: path to the .npz file
+        :param source: optional path to the file the morphology was read
+            from. If it changed since the .npz file was saved, None is
+            returned.
+        :param name: str, name of the neuron
+        :returns: CompactMorphology or None
+        """
+        with np.load(file_path) as data:
+            if int(data["format_version"]) != cls._format_version:
+                return None
+
+            if source is not None:
+                stat = os.stat(source)
+                if (
+                    int(data["source_size"]) != stat.st_size
+                    or int(data["source_mtime_ns"]) != stat.st_mtime_ns
+                ):
+                    return None
+
+            return cls(
+                name=name,
+                **{
+                    attr: data[attr]
+                    for attr in cls.__slots__
+                    if attr != "name"
+                },
+            )
+
+
+def parsed_cache_path(swc_path):
+    """
+    Get the path of the binary file caching a parsed .swc file.
+    """
+    return Path(swc_path).with_suffix(".npz")
+
+
+def load_parsed_swc(swc_path, name=None):
+    """
+    Load the binary cache of a .swc file, if it exists and is up to date.
+
+    :param swc_path: path to the .swc file
+    :param name: str, name of the neuron
+    :returns: CompactMorphology or None
+    """
+    cache_path = parsed_cache_path(swc_path)
+    if not cache_path.exists():
+        return None
+
+    try:
+        return CompactMorphology.load(cache_path, source=swc_path, name=name)
+    except (OSError, ValueError, KeyError):
+        # Corrupted or incomplete file
+        return None
+
+
+def load_swc(swc_path, name=None):
+    """
+    Load the compact morphology of a .swc file from its binary cache if
+    it's up to date, otherwise parse the file.
+
+    :param swc_path: path to the .swc file
+    :param name: str, name of the neuron
+    :returns: CompactMorphology
+    """
+    compact = load_parsed_swc(swc_path, name=name)
+    if compact is None:
+        compact = CompactMorphology.from_swc(swc_path, name=name)
+    return compact
+
+
+def save_parsed_swc(swc_path, overwrite=False):
+    """
+    Parse a .swc file and save it to its binary cache.
+
+    :param swc_path: path to the .swc file
+    :param overwrite: bool, if False up to date caches are not rewritten
+    :returns: bool, True if the cache was written
+    """
+    if not overwrite and load_parsed_swc(swc_path) is not None:
+        return False
+
+    compact = CompactMorphology.from_swc(swc_path)
+
+    # Write to a temporary file first so that readers never see a
+    # partially written cache
+    cache_path = parsed_cache_path(swc_path)
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp.npz")
+    compact.save(tmp_path, source=swc_path)
+    os.replace(tmp_path, cache_path)
+    return True
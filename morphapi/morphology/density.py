@@ -0,0 +1,241 @@
+"""
+Rasterize populations of neurons into voxel density volumes, e.g. in the
+space of a brain atlas.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from morphapi.morphology.batch import _neuron_spec
+from morphapi.morphology.morphology import Neuron
+from morphapi.morphology.projection import _sample_segments
+
+logger = logging.getLogger(__name__)
+
+# Neurite types accumulated in each grid by default
+default_components = dict(
+    axon=["axon"], dendrites=["basal_dendrites", "apical_dendrites"]
+)
+
+
+class DensityGrid:
+    """
+    One 3D grid per component (group of neurite types), accumulating
+    the length of the neurites or the number of nodes in each voxel.
+
+    Neurons are added one at a time with add, so memory usage only
+    depends on the size of the grids. Grids computed separately (e.g. in
+    different processes) can be combined with merge.
+    """
+
+    _measures = ("length", "nodes")
+
+    def __init__(
+        self,
+        shape,
+        resolution,
+        components=None,
+        measure="length",
+        step=None,
+        dtype=np.float32,
+    ):
+        """
+        :param shape: tuple, number of voxels along each axis
+        :param resolution: float or tuple, size of the voxels in microns
+        :param components: dict mapping the name of each grid to a list
+            of neurite types (see default_components), or list of neurite
+            types to make one grid per type
+        :param measure: "length" to sum the length of neurite segments
+            in each voxel, or "nodes" to count nodes
+        :param step: float, segments are split in pieces no longer than
+            step before being rasterized. Defaults to half of the
+            smallest voxel size.
+        :param dtype: data type of the grids
+        """
+        if measure not in self._measures:
+            raise ValueError(
+                f"measure should be one of {self._measures}, not {measure}"
+            )
+        if components is None:
+            components = default_components
+        elif not isinstance(components, dict):
+            components = {ntype: [ntype] for ntype in components}
+        for ntypes in components.values():
+            for ntype in ntypes:
+                if ntype not in Neuron._neurite_types:
+                    raise ValueError(
+                        f"Invalid neurite type {ntype}, should be one of "
+                        f"{list(Neuron._neurite_types)}"
+                    )
+
+        self.shape = tuple(int(n) for n in shape)
+        self.resolution = np.broadcast_to(
+            np.asarray(resolution, dtype=float), (3,)
+        )
+        self.components = components
+        self.measure = measure
+        self.step = self.resolution.min() / 2 if step is None else step
+        self.n_neurons = 0
+        self.grids = {
+            name: np.zeros(self.shape, dtype=dtype) for name in components
+        }
+
+    @classmethod
+    def from_atlas(cls, atlas, **kwargs):
+        """
+        Create grids matching the annotation volume of an atlas.
+
+        :param atlas: brainglobe_atlasapi.BrainGlobeAtlas
+        :param kwargs: keyword arguments passed to DensityGrid
+        """
+        return cls(atlas.shape, atlas.resolution, **kwargs)
+
+    def _accumulate(self, grid, coords, weights=None):
+        voxels = np.floor(coords / self.resolution).astype(np.int64)
+        inside = np.all((voxels >= 0) & (voxels < self.shape), axis=1)
+        flat = np.ravel_multi_index(tuple(voxels[inside].T), self.shape)
+
+        # Sum the values of each voxel before adding them to the grid
+        voxel, index = np.unique(flat, return_inverse=True)
+        values = np.bincount(
+            index,
+            weights=None if weights is None else weights[inside],
+            minlength=len(voxel),
+        )
+        grid.reshape(-1)[voxel] += values.astype(grid.dtype)
+
+    def add(self, neuron):
+        """
+        Rasterize a neuron. Its points are in the same space as its mesh
+        (i.e. after invert_dims) and in microns.
+
+        :param neuron: Neuron instance
+        """
+        for name, ntypes in self.components.items():
+            for ntype in ntypes:
+                if self.measure == "length":
+                    points, offsets = neuron.sections[ntype]
+                    coords, weights = _sample_segments(
+                        points[:, :3].astype(float), offsets, self.step
+                    )
+                else:
+                    value = Neuron._neurite_types[ntype].value
+                    coords = neuron.compact.nodes[
+                        neuron.compact.types == value, :3
+                    ].astype(float)
+                    weights = None
+
+                if neuron.invert_dims:
+                    coords = coords[:, [2, 1, 0]]
+                self._accumulate(self.grids[name], coords, weights)
+        self.n_neurons += 1
+
+    def merge(self, other):
+        """
+        Add the grids of another DensityGrid with the same shape,
+        resolution, components and measure.
+
+        :param other: DensityGrid
+        :returns: self
+        """
+        if (
+            other.shape != self.shape
+            or not np.array_equal(other.resolution, self.resolution)
+            or other.components != self.components
+            or other.measure != self.measure
+        ):
+            raise ValueError("Only identical density grids can be merged")
+
+        for name, grid in self.grids.items():
+            grid += other.grids[name]
+        self.n_neurons += other.n_neurons
+        return self
+
+
+def _load_neuron(neuron):
+    """
+    Load a neuron given as a Neuron instance or a path to a .swc file,
+    returning None (and logging the error) if it can't be loaded.
+    """
+    data_file = getattr(neuron, "data_file", neuron)
+    try:
+        if not isinstance(neuron, Neuron):
+            neuron = Neuron(**_neuron_spec(neuron))
+        elif neuron.compact is None:
+            neuron.load_from_file()
+        if neuron.compact is None:
+            raise ValueError("No data could be loaded")
+    except Exception as exc:
+        logger.error("Could not load %s: %s", data_file, exc)
+        return None
+    return neuron
+
+
+def _rasterize_worker(specs, grid_kwargs):
+    # Rasterize some neurons into a new DensityGrid, and only send back
+    # the flat indices and values of the non-empty voxels of each grid
+    density = DensityGrid(**grid_kwargs)
+    for spec in specs:
+        neuron = _load_neuron(Neuron(**spec, load_file=False))
+        if neuron is not None:
+            density.add(neuron)
+
+    voxels = {}
+    for name, grid in density.grids.items():
+        index = np.flatnonzero(grid)
+        voxels[name] = (index, grid.reshape(-1)[index])
+    return voxels, density.n_neurons
+
+
+def rasterize(neurons, atlas, workers=1, **grid_kwargs):
+    """
+    Rasterize many neurons into the space of an atlas.
+
+    :param neurons: path to a folder with .swc files (e.g. one of the
+        cache folders of morphapi.paths_manager.Paths), or list of paths
+        to .swc files and/or Neuron instances
+    :param atlas: brainglobe_atlasapi.BrainGlobeAtlas
+    :param workers: int, number of processes to use. If None, one per
+        CPU is used. Each process rasterizes some of the neurons into its
+        own grids, whose non-empty voxels are added to the result as
+        soon as it's done.
+    :param grid_kwargs: keyword arguments passed to DensityGrid
+    :returns: DensityGrid
+    """
+    if isinstance(neurons, (str, Path)) and Path(neurons).is_dir():
+        neurons = sorted(Path(neurons).glob("*.swc"))
+    elif not isinstance(neurons, (list, tuple)):
+        neurons = [neurons]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    grid_kwargs.update(shape=atlas.shape, resolution=atlas.resolution)
+    density = DensityGrid(**grid_kwargs)
+    if workers == 1 or len(neurons) <= 1:
+        for neuron in map(_load_neuron, neurons):
+            if neuron is not None:
+                density.add(neuron)
+        return density
+
+    # Results are summed as they come, so that only one grid of each
+    # component is kept in this process
+    specs = [_neuron_spec(neuron) for neuron in neurons]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = as_completed(
+            [
+                executor.submit(
+                    _rasterize_worker, specs[i::workers], grid_kwargs
+                )
+                for i in range(workers)
+            ]
+        )
+        for future in futures:
+            voxels, n_neurons = future.result()
+            for name, (index, values) in voxels.items():
+                density.grids[name].reshape(-1)[index] += values
+            density.n_neurons += n_neurons
+    return density
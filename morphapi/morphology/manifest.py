@@ -0,0 +1,269 @@
+"""
+SQLite manifest of the meshes cache, listing the mesh files (see
+morphapi.morphology.mesh_file) of all cached neurons with their
+parameters, the position of their arrays, size and timestamps. Looking up
+a cached mesh is one indexed query instead of probing the file system.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from morphapi.morphology.mesh_file import read_mesh_header
+
+logger = logging.getLogger(__name__)
+
+# Row of the manifest. file is relative to the meshes cache folder, header
+# is the header of the mesh file and data_start the position of its arrays
+manifest_entry = namedtuple(
+    "manifest_entry",
+    "key neuron file params header data_start size created_ns accessed_ns",
+)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meshes (
+    key TEXT NOT NULL,
+    neuron TEXT NOT NULL,
+    file TEXT NOT NULL,
+    params TEXT NOT NULL,
+    header TEXT NOT NULL,
+    data_start INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created_ns INTEGER NOT NULL,
+    accessed_ns INTEGER NOT NULL,
+    PRIMARY KEY (neuron, key)
+);
+CREATE INDEX IF NOT EXISTS meshes_key ON meshes (key);
+"""
+
+
+class CacheManifest:
+    """
+    Table of the mesh files in a meshes cache folder, keyed by neuron and
+    cache key (see NeuronCache.cache_key).
+
+    The manifest can go out of sync with the files if they are modified
+    by other means (e.g. deleted by hand or written by older versions),
+    in which case lookups of missing files are misses and rebuild
+    recreates the manifest from the files.
+    """
+
+    flush_interval = 10
+
+    def __init__(self, file_path):
+        """
+        :param file_path: path to the SQLite database, created if it
+            doesn't exist
+        """
+        self.file_path = Path(file_path)
+        self._local = threading.local()
+
+        # Access times are recorded in batches, to avoid writing to the
+        # database each time a mesh is used
+        self._accessed = {}
+        self._last_flush = time.monotonic()
+
+    def __repr__(self):
+        return f"CacheManifest({str(self.file_path)!r})"
+
+    @property
+    def _connection(self):
+        # SQLite connections can't be shared between threads or processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.file_path, timeout=60, isolation_level=None
+            )
+            connection.executescript(_schema)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM meshes"
+        ).fetchone()[0]
+
+    def total_size(self):
+        """
+        Get the total size of the mesh files in the manifest.
+
+        :returns: int, size in bytes
+        """
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM meshes"
+        ).fetchone()[0]
+
+    def lookup(self, key, neuron=None):
+        """
+        Get the entry of a cached mesh. Keys depend on the content of the
+        neurons' data files and not on their names, so the meshes cached
+        for a neuron are found under any other name.
+
+        :param key: str, cache key
+        :param neuron: str, name of the neuron whose entry is preferred
+            if several neurons have the same key
+        :returns: manifest_entry, or None if the mesh is not in the
+            manifest
+        """
+        row = self._connection.execute(
+            "SELECT * FROM meshes WHERE key = ? ORDER BY neuron = ? DESC "
+            "LIMIT 1",
+            (key, str(neuron)),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = manifest_entry(*row)
+        return entry._replace(
+            params=json.loads(entry.params), header=json.loads(entry.header)
+        )
+
+    def touch(self, key):
+        """
+        Record an access to a cached mesh. Accesses are written to the
+        database by flush, called every flush_interval seconds.
+
+        :param key: str, cache key
+        """
+        self._accessed[key] = time.time_ns()
+        if time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the recorded accesses to the database.
+        """
+        accessed, self._accessed = self._accessed, {}
+        self._last_flush = time.monotonic()
+        if not accessed:
+            return
+        try:
+            self._connection.executemany(
+                "UPDATE meshes SET accessed_ns = MAX(accessed_ns, ?) "
+                "WHERE key = ?",
+                [(ns, key) for key, ns in accessed.items()],
+            )
+        except sqlite3.OperationalError as exc:
+            # Access times are a hint for eviction, don't fail on a busy
+            # database
+            logger.debug("Could not record accesses to the cache: %s", exc)
+
+    def add(self, key, neuron, file, header, data_start, size):
+        """
+        Add (or replace) the entry of a cached mesh.
+
+        :param key: str, cache key
+        :param neuron: str, name of the neuron
+        :param file: str, path of the mesh file relative to the meshes
+            cache folder
+        :param header: dictionary, header of the mesh file
+        :param data_start: int, position of the arrays in the file
+        :param size: int, size of the file in bytes
+        """
+        now = time.time_ns()
+        self._connection.execute(
+            "INSERT OR REPLACE INTO meshes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                str(neuron),
+                str(file),
+                json.dumps(header["params"], sort_keys=True),
+                json.dumps(header),
+                data_start,
+                size,
+                now,
+                now,
+            ),
+        )
+
+    def remove(self, entries):
+        """
+        Remove the entries of some cached meshes.
+
+        :param entries: list of (neuron, key) tuples
+        """
+        self._connection.executemany(
+            "DELETE FROM meshes WHERE neuron = ? AND key = ?",
+            [(str(neuron), key) for neuron, key in entries],
+        )
+
+    def entries(self, neuron=None):
+        """
+        Get the entries of all cached meshes, or of those of a neuron.
+
+        :param neuron: str, name of a neuron
+        :returns: pandas DataFrame with the columns of manifest_entry,
+            params and header are JSON strings
+        """
+        # Imported here to keep importing Neuron fast
+        import pandas as pd
+
+        self.flush()
+        query, args = "SELECT * FROM meshes", ()
+        if neuron is not None:
+            query, args = query + " WHERE neuron = ?", (str(neuron),)
+        return pd.DataFrame(
+            self._connection.execute(query, args).fetchall(),
+            columns=manifest_entry._fields,
+        )
+
+    def rebuild(self, meshes_cache, cache_key):
+        """
+        Recreate the manifest from the mesh files in a meshes cache folder,
+        e.g. after files were deleted or copied by hand.
+
+        :param meshes_cache: path to the meshes cache folder
+        :param cache_key: function computing the cache key of a mesh file
+            from its parameters (see NeuronCache.cache_key). Files whose
+            name is not their key (e.g. renamed by hand) are
+            skipped.
+        :returns: int, number of mesh files in the manifest
+        """
+        rows = []
+        for file_name in sorted(Path(meshes_cache).glob("*/*.mesh")):
+            try:
+                header, data_start = read_mesh_header(file_name)
+                stat = file_name.stat()
+            except (OSError, ValueError) as exc:
+                logger.warning("Could not read %s: %s", file_name, exc)
+                continue
+            if file_name.stem != cache_key(header["params"]):
+                continue
+            rows.append(
+                (
+                    file_name.stem,
+                    file_name.parent.name,
+                    str(file_name.relative_to(meshes_cache)),
+                    json.dumps(header["params"], sort_keys=True),
+                    json.dumps(header),
+                    data_start,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    max(stat.st_atime_ns, stat.st_mtime_ns),
+                )
+            )
+
+        # Reconnect in case the database was deleted
+        if getattr(self._local, "connection", None) is not None:
+            self._local.connection.close()
+            self._local.connection = None
+        self._accessed = {}
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM meshes")
+            connection.executemany(
+                "INSERT OR REPLACE INTO meshes "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return len(rows)
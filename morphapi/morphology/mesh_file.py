@@ -0,0 +1,391 @@
+"""
+Single-file binary container for the meshes of a neuron's components.
+
+A file starts with a magic string and the size of a JSON header, followed
+by the header and by the arrays, each aligned to 64 bytes so that they
+can be memory-mapped. The header holds the parameters the meshes were
+created with and the dtype, shape and offset (from the end of the
+header) of the vertices, faces and normals of each component.
+
+Files can also be written with a compact encoding (see write_mesh_file),
+in which case the arrays are decoded when they are read instead of being
+memory-mapped: vertices are quantized relative to the bounding box of
+their component, faces are delta encoded and compressed, and normals are
+stored with 2 bytes each using an octahedral mapping.
+"""
+
+import functools
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+from vedo import Mesh
+
+from morphapi.morphology.meshing import (
+    arrays_to_mesh,
+    build_polydata,
+    mesh_to_arrays,
+)
+
+MAGIC = b"MORPHAPI-MESH\x00\x00\x00"
+ALIGNMENT = 64
+# Version 2 is only used by files with encoded arrays
+_format_versions = (1, 2)
+
+# Components stored in the files, the whole neuron is made by
+# concatenating them when loading
+components = ("soma", "axon", "apical_dendrites", "basal_dendrites")
+
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def _zigzag(values):
+    # Map signed integers (stored in unsigned arrays) to unsigned ones
+    # such that small magnitudes give small values
+    signed = values.view(values.dtype.str.replace("u", "i"))
+    return ((signed << 1) ^ (signed >> (8 * values.itemsize - 1))).view(
+        values.dtype
+    )
+
+
+def _unzigzag(values):
+    return (values >> 1) ^ np.negative(values & 1)
+
+
+def _shuffle(array):
+    # Group the bytes of the same significance of all the values, which
+    # compresses better
+    flat = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    return np.ascontiguousarray(flat.reshape(-1, array.itemsize).T)
+
+
+def _unshuffle(buffer, dtype, count):
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(buffer, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(count)
+
+
+def _encode_vertices(vertices, max_error):
+    # Quantize the coordinates to the smallest integer type whose steps
+    # over the bounding box are within twice max_error
+    origin = vertices.min(axis=0).astype(float)
+    extent = vertices.max(axis=0) - origin
+    for dtype in (np.uint16, np.uint32):
+        scale = extent / np.iinfo(dtype).max
+        if np.all(scale / 2 <= max_error):
+            break
+    scale[scale == 0] = 1
+    quantized = np.rint((vertices - origin) / scale).astype(dtype)
+
+    # Differences between consecutive vertices (modulo the range of dtype)
+    # along each axis are small for tubes
+    planes = np.ascontiguousarray(quantized.T)
+    deltas = np.diff(planes, axis=1, prepend=np.zeros((3, 1), dtype=dtype))
+    buffer = zlib.compress(_shuffle(_zigzag(deltas)).tobytes())
+    return buffer, dict(
+        encoding="quantized",
+        dtype=np.dtype(dtype).str,
+        shape=vertices.shape,
+        origin=origin.tolist(),
+        scale=scale.tolist(),
+    )
+
+
+def _decode_vertices(buffer, spec):
+    n_vertices = spec["shape"][0]
+    deltas = _unzigzag(
+        _unshuffle(zlib.decompress(buffer), spec["dtype"], 3 * n_vertices)
+    ).reshape(3, n_vertices)
+    # Integer overflows wrap around, undoing the modular differences
+    quantized = np.cumsum(deltas, axis=1, dtype=spec["dtype"])
+    vertices = quantized.T.astype(np.float32)
+    vertices *= np.array(spec["scale"], dtype=np.float32)
+    vertices += np.array(spec["origin"], dtype=np.float32)
+    return vertices
+
+
+def _encode_faces(faces, max_error=None):
+    deltas = _zigzag(np.diff(faces.astype(np.int64).ravel(), prepend=0))
+    deltas = deltas.view(np.uint64)
+    dtype = np.min_scalar_type(int(deltas.max()))
+    buffer = zlib.compress(_shuffle(deltas.astype(dtype)).tobytes())
+    return buffer, dict(
+        encoding="delta", dtype=np.dtype(dtype).str, shape=faces.shape
+    )
+
+
+def _decode_faces(buffer, spec):
+    count = int(np.prod(spec["shape"]))
+    deltas = _unshuffle(zlib.decompress(buffer), spec["dtype"], count)
+    # Zigzag values of dtype decode to the signed integers of its width
+    deltas = _unzigzag(deltas).view(deltas.dtype.str.replace("u", "i"))
+    return np.cumsum(deltas, dtype=np.int64).reshape(spec["shape"])
+
+
+def _encode_normals(normals, max_error=None):
+    # Project the unit sphere on an octahedron, unfolded onto a square
+    normals = normals.astype(float)
+    normals /= np.maximum(np.abs(normals).sum(axis=1, keepdims=True), 1e-12)
+    x, y, z = normals.T
+    folded = z < 0
+    x, y = (
+        np.where(folded, (1 - np.abs(y)) * np.where(x >= 0, 1, -1), x),
+        np.where(folded, (1 - np.abs(x)) * np.where(y >= 0, 1, -1), y),
+    )
+    encoded = np.rint(np.stack([x, y], axis=1) * 127).astype(np.int8)
+    return encoded.tobytes(), dict(
+        encoding="oct", dtype=encoded.dtype.str, shape=normals.shape
+    )
+
+
+@functools.cache
+def _oct_table():
+    # Normal of each of the 65536 pairs of int8 octahedral coordinates,
+    # indexed by the pair viewed as an uint16
+    encoded = np.arange(2**16, dtype=np.uint16).view(np.int8).reshape(-1, 2)
+    x, y = encoded.T / 127
+    z = 1 - np.abs(x) - np.abs(y)
+    unfold = np.clip(-z, 0, None)
+    x = x - np.where(x >= 0, unfold, -unfold)
+    y = y - np.where(y >= 0, unfold, -unfold)
+    normals = np.stack([x, y, z], axis=1)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals.astype(np.float32)
+
+
+def _decode_normals(buffer, spec):
+    return _oct_table()[np.frombuffer(buffer, dtype=np.uint16)]
+
+
+_encoders = dict(
+    vertices=_encode_vertices, faces=_encode_faces, normals=_encode_normals
+)
+_decoders = dict(
+    quantized=_decode_vertices, delta=_decode_faces, oct=_decode_normals
+)
+
+
+def write_mesh_file(file_path, meshes, params=None, max_error=None):
+    """
+    Write the meshes of a neuron's components to a file.
+
+    :param file_path: path to the file
+    :param meshes: dictionary with a vedo Mesh (or None) for some of the
+        components. Other keys (e.g. whole_neuron) are ignored.
+    :param params: dictionary with the parameters used to create the
+        meshes, stored in the header
+    :param max_error: float, if given the arrays are encoded to take much
+        less space: vertices are quantized with at most this error (in
+        the units of the vertices, usually microns), faces are compressed
+        without loss and normals are encoded with an error below one
+        degree
+    :returns: tuple with the header dictionary and the position of the
+        arrays in the file
+    """
+    arrays = {}
+    for component in components:
+        mesh = meshes.get(component)
+        if mesh is None or not mesh.npoints:
+            continue
+        vertices, faces, normals = mesh_to_arrays(mesh)
+        arrays[f"{component}/vertices"] = vertices.astype(np.float32)
+        arrays[f"{component}/faces"] = faces.astype(np.int32)
+        arrays[f"{component}/normals"] = normals.astype(np.float32)
+
+    buffers, specs, position = {}, {}, 0
+    for name, array in arrays.items():
+        if max_error is not None and array.size:
+            buffer, spec = _encoders[name.split("/")[1]](array, max_error)
+            spec["nbytes"] = len(buffer)
+        else:
+            buffer = np.ascontiguousarray(array)
+            spec = dict(dtype=array.dtype.str, shape=array.shape)
+        buffers[name] = buffer
+        specs[name] = dict(spec, offset=position)
+        position = _aligned(position + memoryview(buffer).nbytes)
+
+    header = dict(
+        version=1 if max_error is None else 2,
+        params=params or {},
+        arrays=specs,
+    )
+    encoded = json.dumps(header).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    # Write to a temporary file first so that readers never see a
+    # partially written file
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(
+        f".{file_path.name}.{os.getpid()}.{threading.get_ident()}"
+    )
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(encoded)).tobytes())
+            f.write(encoded)
+            for name, buffer in buffers.items():
+                f.write(
+                    b"\0" * (data_start + specs[name]["offset"] - f.tell())
+                )
+                f.write(buffer)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return header, data_start
+
+
+def read_mesh_header(file_path):
+    """
+    Read the header of a mesh file, without reading its arrays.
+
+    :param file_path: path to the file
+    :returns: tuple with the header dictionary and the position of the
+        arrays in the file
+    """
+    with open(file_path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_path} is not a mesh file")
+        header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_size).decode("utf-8"))
+
+    if header["version"] not in _format_versions:
+        raise ValueError(
+            f"Unsupported version of the mesh file format in {file_path}"
+        )
+    return header, _aligned(len(MAGIC) + 8 + header_size)
+
+
+def read_mesh_arrays(file_path, mmap=True, header=None, data_start=None):
+    """
+    Read the arrays of a mesh file.
+
+    :param file_path: path to the file
+    :param mmap: bool, if True the arrays are memory-mapped instead of
+        being read (except encoded arrays, which are decoded)
+    :param header: dictionary, the header of the file if already known
+        (e.g. from the cache manifest) along with data_start, in which
+        case it's not read again
+    :param data_start: int, position of the arrays in the file
+    :returns: tuple with a dictionary of (vertices, faces, normals) arrays
+        (or None) for each component and the parameters of the meshes
+    """
+    file_path = os.fspath(file_path)
+    if header is None:
+        header, data_start = read_mesh_header(file_path)
+
+    def read(name):
+        spec = header["arrays"][name]
+        shape = tuple(spec["shape"])
+        offset = data_start + spec["offset"]
+        if "encoding" in spec:
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                return _decoders[spec["encoding"]](
+                    f.read(spec["nbytes"]), spec
+                )
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=spec["dtype"])
+        if mmap:
+            return np.memmap(
+                file_path,
+                dtype=spec["dtype"],
+                mode="r",
+                offset=offset,
+                shape=shape,
+            )
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            return np.fromfile(
+                f, dtype=spec["dtype"], count=int(np.prod(shape))
+            ).reshape(shape)
+
+    arrays = {}
+    for component in components:
+        if f"{component}/vertices" not in header["arrays"]:
+            arrays[component] = None
+        else:
+            arrays[component] = tuple(
+                read(f"{component}/{kind}")
+                for kind in ("vertices", "faces", "normals")
+            )
+    return arrays, header["params"]
+
+
+def concatenate_arrays(arrays):
+    """
+    Concatenate the buffers of several meshes into one vtkPolyData.
+
+    :param arrays: list of (vertices, faces, normals) tuples, where faces
+        are triangles or line segments
+    :returns: vtkPolyData
+    """
+    vertices, normals = [], []
+    cells = {2: [], 3: []}
+    n_vertices = 0
+    for mesh_vertices, faces, mesh_normals in arrays:
+        vertices.append(mesh_vertices)
+        normals.append(mesh_normals)
+        cells[faces.shape[1]].append(faces.astype(np.int64) + n_vertices)
+        n_vertices += len(mesh_vertices)
+
+    def concatenate(parts, shape):
+        return np.concatenate(parts) if parts else np.zeros(shape)
+
+    return build_polydata(
+        concatenate(vertices, (0, 3)),
+        triangles=concatenate(cells[3], (0, 3)),
+        lines=concatenate(cells[2], (0, 2)),
+        normals=concatenate(normals, (0, 3)),
+    )
+
+
+def whole_neuron_mesh(arrays):
+    """
+    Make the mesh of a whole neuron from the buffers of its components,
+    concatenated in the order of components, so that it's the same
+    whether they were just built or loaded from the cache.
+
+    :param arrays: dictionary with a (vertices, faces, normals) tuple
+        (or None) for each component
+    :returns: vedo Mesh, or None if there is no component
+    """
+    present = [
+        arrays[component]
+        for component in components
+        if arrays.get(component) is not None
+    ]
+    if not present:
+        return None
+    return Mesh(concatenate_arrays(present)).phong()
+
+
+def load_mesh_file(file_path, mmap=True, header=None, data_start=None):
+    """
+    Load the meshes of a neuron from a mesh file.
+
+    :param file_path: path to the file
+    :param mmap: bool, if False the arrays are read instead of being
+        memory-mapped, e.g. to delete the file afterwards
+    :param header: dictionary, the header of the file if already known,
+        see read_mesh_arrays
+    :param data_start: int, position of the arrays in the file
+    :returns: tuple with a dictionary with a vedo Mesh (or None) for each
+        component and for the whole neuron, and the parameters of the
+        meshes
+    """
+    arrays, params = read_mesh_arrays(
+        file_path, mmap=mmap, header=header, data_start=data_start
+    )
+    meshes = {
+        component: arrays_to_mesh(*buffers) if buffers is not None else None
+        for component, buffers in arrays.items()
+    }
+
+    meshes["whole_neuron"] = whole_neuron_mesh(arrays)
+    return meshes, params
@@ -0,0 +1,342 @@
+"""
+Functions to build neuron meshes directly from NumPy arrays.
+
+Sections are described by a single (N, 3) array of coordinates and an
+array of offsets (CSR style): section ``i`` spans the rows
+``coords[offsets[i]:offsets[i + 1]]``. All sections of a neurite type are
+written into a single vtkPolyData and tessellated with one tube filter,
+so no Python or VTK object is created per section.
+"""
+
+import numpy as np
+from vedo import Mesh
+from vtkmodules.util.numpy_support import (
+    numpy_to_vtk,
+    numpy_to_vtkIdTypeArray,
+    vtk_to_numpy,
+)
+from vtkmodules.vtkCommonCore import vtkPoints
+from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+from vtkmodules.vtkFiltersCore import vtkTubeFilter
+
+
+def select_sections(points, offsets, mask):
+    """
+    Extract a subset of sections from CSR arrays.
+
+    :param points: (N, ...) array with the points of all sections
+    :param offsets: (S + 1,) array of section offsets into points
+    :param mask: (S,) boolean array, True for the sections to keep
+    :returns: tuple with the points and offsets of the selected sections
+    """
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1][mask]
+    lengths = offsets[1:][mask] - starts
+
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    # Index of each point: start of its section + position in the section
+    index = np.arange(new_offsets[-1]) + np.repeat(
+        starts - new_offsets[:-1], lengths
+    )
+    return points[index], new_offsets
+
+
+def _group_argmax(values, group_offsets):
+    """
+    Get the maximum value and the index of its first occurrence in each
+    group of consecutive values (all groups must be non-empty).
+    """
+    group_max = np.maximum.reduceat(values, group_offsets)
+    group = np.repeat(
+        np.arange(len(group_offsets)),
+        np.diff(np.append(group_offsets, len(values))),
+    )
+    is_max = np.flatnonzero(values == group_max[group])
+    _, first = np.unique(group[is_max], return_index=True)
+    return group_max, is_max[first]
+
+
+def simplify_sections(points, offsets, tolerance):
+    """
+    Simplify the polyline of each section with the Ramer-Douglas-Peucker
+    algorithm, processing all sections at once.
+
+    The first and last point of each section (i.e. branch points and
+    terminations) are always kept.
+
+    :param points: (N, 3+) array with the points of all sections, the
+        first three columns are the coordinates
+    :param offsets: (S + 1,) array of section offsets into points
+    :param tolerance: float, maximum distance between a removed point and
+        the simplified polyline
+    :returns: tuple with the points and offsets of the simplified sections
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    coords = np.asarray(points[:, :3], dtype=np.float64)
+
+    keep = np.zeros(len(points), dtype=bool)
+    non_empty = np.diff(offsets) > 0
+    keep[offsets[:-1][non_empty]] = True
+    keep[offsets[1:][non_empty] - 1] = True
+
+    # Intervals still to simplify, identified by their first and last point
+    starts = offsets[:-1][non_empty]
+    ends = offsets[1:][non_empty] - 1
+    while True:
+        inner = ends - starts - 1
+        todo = inner > 0
+        starts, ends, inner = starts[todo], ends[todo], inner[todo]
+        if not len(starts):
+            break
+
+        # Distance of each interior point from its interval's chord
+        group_offsets = np.zeros(len(inner), dtype=np.int64)
+        np.cumsum(inner[:-1], out=group_offsets[1:])
+        interval = np.repeat(np.arange(len(inner)), inner)
+        index = np.arange(inner.sum()) + np.repeat(
+            starts + 1 - group_offsets, inner
+        )
+
+        a, b = coords[starts[interval]], coords[ends[interval]]
+        chord = b - a
+        chord_length2 = np.einsum("ij,ij->i", chord, chord)
+        t = np.einsum("ij,ij->i", coords[index] - a, chord)
+        not_degenerate = chord_length2 > 0
+        t[not_degenerate] /= chord_length2[not_degenerate]
+        t[~not_degenerate] = 0
+        t = np.clip(t, 0, 1)
+        distance = np.linalg.norm(
+            coords[index] - (a + t[:, None] * chord), axis=1
+        )
+
+        # Split the intervals whose farthest point is beyond tolerance
+        max_distance, farthest = _group_argmax(distance, group_offsets)
+        split = max_distance > tolerance
+        split_at = index[farthest[split]]
+        keep[split_at] = True
+
+        starts = np.concatenate([starts[split], split_at])
+        ends = np.concatenate([split_at, ends[split]])
+
+    counts = np.concatenate([[0], np.cumsum(keep)])
+    return points[keep], counts[offsets]
+
+
+def sections_to_polydata(coords, offsets):
+    """
+    Create a vtkPolyData with one polyline per section.
+
+    :param coords: (N, 3) array with the coordinates of all sections
+    :param offsets: (S + 1,) array of section offsets into coords
+    :returns: vtkPolyData
+    """
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+
+    points = vtkPoints()
+    points.SetData(numpy_to_vtk(coords, deep=True))
+
+    lines = vtkCellArray()
+    lines.SetData(
+        numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_to_vtkIdTypeArray(
+            np.arange(len(coords), dtype=np.int64), deep=True
+        ),
+    )
+
+    polydata = vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(lines)
+    return polydata
+
+
+def tube_mesh(coords, offsets, radius, res=12, cap=True):
+    """
+    Create a single tube mesh around all sections with one tube filter.
+
+    :param coords: (N, 3) array with the coordinates of all sections
+    :param offsets: (S + 1,) array of section offsets into coords
+    :param radius: float, radius of the tubes
+    :param res: int, number of sides of each tube
+    :param cap: bool, if True the ends of each tube are closed
+    :returns: vedo Mesh or None if there are no sections
+    """
+    if len(offsets) < 2:
+        return None
+
+    tubes = vtkTubeFilter()
+    tubes.SetInputData(sections_to_polydata(coords, offsets))
+    tubes.SetRadius(radius)
+    tubes.SetNumberOfSides(res)
+    tubes.SetCapping(cap)
+    tubes.Update()
+
+    return Mesh(tubes.GetOutput()).phong()
+
+
+def lines_mesh(coords, offsets):
+    """
+    Create a mesh with one polyline per section, without tessellation.
+
+    :param coords: (N, 3) array with the coordinates of all sections
+    :param offsets: (S + 1,) array of section offsets into coords
+    :returns: vedo Mesh or None if there are no sections
+    """
+    # Sections with a single point can't be drawn as lines
+    coords, offsets = select_sections(coords, offsets, np.diff(offsets) > 1)
+    if len(offsets) < 2:
+        return None
+    return Mesh(sections_to_polydata(coords, offsets))
+
+
+def decimate_mesh(mesh, fraction):
+    """
+    Reduce the number of triangles of a mesh.
+
+    :param mesh: vedo Mesh
+    :param fraction: float in (0, 1], fraction of triangles to keep
+    :returns: new vedo Mesh
+    """
+    mesh = mesh.clone()
+    if fraction >= 1 or mesh.ncells == 0:
+        return mesh
+    return mesh.triangulate().decimate(fraction=fraction).compute_normals()
+
+
+def mesh_to_arrays(mesh):
+    """
+    Extract the raw buffers of a mesh.
+
+    :param mesh: vedo Mesh
+    :returns: tuple with (N, 3) float32 vertices, (M, 3) int64 triangles
+        and (N, 3) float32 vertex normals. For meshes made only of lines
+        (see lines_mesh) the faces are (M, 2) line segments.
+    """
+    polydata = mesh.dataset
+    is_lines = polydata.GetNumberOfLines() and not (
+        polydata.GetNumberOfPolys() or polydata.GetNumberOfStrips()
+    )
+    if not is_lines:
+        polydata = mesh.clone().triangulate().dataset
+    vertices = _polydata_points(polydata)
+
+    if is_lines:
+        faces = _polylines_to_segments(polydata.GetLines())
+    else:
+        faces = vtk_to_numpy(polydata.GetPolys().GetConnectivityArray())
+        faces = faces.reshape(-1, 3).astype(np.int64, copy=False)
+
+    normals = polydata.GetPointData().GetNormals()
+    if normals is None:
+        normals = np.zeros_like(vertices)
+    else:
+        normals = vtk_to_numpy(normals).astype(np.float32)
+
+    return vertices, faces, normals
+
+
+def _polydata_points(polydata):
+    """
+    Get the vertices of a vtkPolyData as a (N, 3) float32 array.
+    """
+    if polydata.GetPoints() is None:
+        return np.zeros((0, 3), dtype=np.float32)
+    return vtk_to_numpy(polydata.GetPoints().GetData()).astype(np.float32)
+
+
+def _polylines_to_segments(lines):
+    """
+    Split the polylines of a vtkCellArray into (M, 2) line segments.
+    """
+    offsets = vtk_to_numpy(lines.GetOffsetsArray())
+    connectivity = vtk_to_numpy(lines.GetConnectivityArray())
+    if len(connectivity) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    # Drop the segments that would join the end of a polyline to the
+    # start of the next one
+    keep = np.ones(len(connectivity) - 1, dtype=bool)
+    keep[offsets[1:-1] - 1] = False
+    return np.column_stack(
+        [connectivity[:-1][keep], connectivity[1:][keep]]
+    ).astype(np.int64)
+
+
+def _vtk_points(vertices):
+    """
+    Create vtkPoints from a (N, 3) array.
+    """
+    points = vtkPoints()
+    points.SetData(
+        numpy_to_vtk(
+            np.ascontiguousarray(vertices, dtype=np.float32), deep=True
+        )
+    )
+    return points
+
+
+def _vtk_cells(cells):
+    """
+    Create a vtkCellArray from a (M, k) array of cells with k vertices.
+    """
+    cells = np.ascontiguousarray(cells, dtype=np.int64)
+    n_cells, cell_size = cells.shape
+    cell_array = vtkCellArray()
+    cell_array.SetData(
+        numpy_to_vtkIdTypeArray(
+            np.arange(0, n_cells * cell_size + 1, cell_size, dtype=np.int64),
+            deep=True,
+        ),
+        numpy_to_vtkIdTypeArray(cells.reshape(-1), deep=True),
+    )
+    return cell_array
+
+
+def build_polydata(vertices, triangles=None, lines=None, normals=None):
+    """
+    Create a vtkPolyData from raw buffers, without Python loops.
+
+    :param vertices: (N, 3) array of vertex coordinates
+    :param triangles: optional (M, 3) array of vertex indices
+    :param lines: optional (L, 2) array of line segments
+    :param normals: optional (N, 3) array of vertex normals
+    :returns: vtkPolyData. Following VTK's ordering, the cells of the
+        lines come before the cells of the triangles.
+    """
+    polydata = vtkPolyData()
+    polydata.SetPoints(_vtk_points(vertices))
+    if lines is not None and len(lines):
+        polydata.SetLines(_vtk_cells(lines))
+    if triangles is not None and len(triangles):
+        polydata.SetPolys(_vtk_cells(triangles))
+
+    if normals is not None and len(normals) == len(vertices):
+        vtk_normals = numpy_to_vtk(
+            np.ascontiguousarray(normals, dtype=np.float32), deep=True
+        )
+        vtk_normals.SetName("Normals")
+        polydata.GetPointData().SetNormals(vtk_normals)
+    return polydata
+
+
+def arrays_to_mesh(vertices, faces, normals=None):
+    """
+    Create a mesh from the buffers returned by mesh_to_arrays.
+
+    :param vertices: (N, 3) array of vertex coordinates
+    :param faces: (M, 3) array of vertex indices, or (M, 2) array of
+        line segments
+    :param normals: optional (N, 3) array of vertex normals
+    :returns: vedo Mesh
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    if faces.ndim != 2:
+        faces = faces.reshape(-1, 3)
+
+    if faces.shape[1] == 2:
+        polydata = build_polydata(vertices, lines=faces, normals=normals)
+    else:
+        polydata = build_polydata(vertices, triangles=faces, normals=normals)
+    return Mesh(polydata).phong()
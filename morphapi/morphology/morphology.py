@@ -1,27 +1,27 @@
+import hashlib
 import logging
 from collections import namedtuple
+from contextlib import nullcontext
 from pathlib import Path
 
 import neurom as nm
+import numpy as np
 from morphio import Morphology as MorphioMorphology
 from morphio import Option
-from neurom.core.dataformat import COLS
-from vedo import merge
 from vedo.colors import color_map
-from vedo.shapes import Sphere, Tube
-
-try:
-    # For NeuroM >= 3
-    from neurom.core.morphology import iter_sections
-except ImportError:
-    # For NeuroM < 2
-    try:
-        from neurom.core import iter_sections
-    except ImportError:
-        # For NeuroM >= 2, < 3
-        from neurom import iter_sections
+from vedo.shapes import Sphere
 
 from morphapi.morphology.cache import NeuronCache
+from morphapi.morphology.compact import CompactMorphology, load_swc
+from morphapi.morphology.mesh_file import whole_neuron_mesh
+from morphapi.morphology.meshing import (
+    decimate_mesh,
+    lines_mesh,
+    mesh_to_arrays,
+    simplify_sections,
+    tube_mesh,
+)
+from morphapi.morphology.swc import section_roots
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +49,10 @@ class Neuron(NeuronCache):
 
         self.invert_dims = invert_dims
         self.neuron_name = neuron_name
+        self.compact = None
+        self._morphology = None
+        self._points = None
+        self._sections = None
 
         self.data_file = Path(data_file)
         self.data_file_type = self.data_file.suffix[1:]
@@ -61,10 +65,55 @@ class Neuron(NeuronCache):
 
         if load_file:
             self.load_from_file()
-        else:
-            self.points = None
 
-    def load_from_file(self):
+    @property
+    def morphology(self):
+        """
+        NeuroM morphology of the neuron. When the file was loaded with
+        the fast reader it is only built the first time it's accessed.
+        """
+        if self._morphology is None and self.compact is not None:
+            self._morphology = nm.load_morphology(self._load_morphio())
+        return self._morphology
+
+    @morphology.setter
+    def morphology(self, morphology):
+        self._morphology = morphology
+
+    @property
+    def points(self):
+        """
+        Dictionary with the soma and a list of components for each
+        neurite type. When the neuron was loaded from its compact
+        morphology it is only built the first time it's accessed.
+        """
+        if self._points is None and self.compact is not None:
+            self._points = self._compact_points(self.compact)
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+
+    @property
+    def sections(self):
+        """
+        Polylines of all sections of each neurite type, as (x, y, z,
+        radius) rows and the offsets of each section. Built the first
+        time it's accessed.
+        """
+        if self._sections is None and self.compact is not None:
+            self._sections = {
+                ntype: self.compact.neurite_sections(nclass.value)
+                for ntype, nclass in self._neurite_types.items()
+            }
+        return self._sections
+
+    @sections.setter
+    def sections(self, sections):
+        self._sections = sections
+
+    def load_from_file(self, fast=True):
         if not self.data_file.exists():
             raise ValueError("The specified path does not exist!")
 
@@ -73,16 +122,41 @@ class Neuron(NeuronCache):
         elif self.data_file_type == "json":
             raise NotImplementedError
         else:
-            self.load_from_swc()
+            self.load_from_swc(fast=fast)
 
-    def load_from_swc(self):
-        if self.neuron_name is None:
-            self.neuron_name = self.data_file.name
-
-        morphio_input = MorphioMorphology(
+    def _load_morphio(self):
+        return MorphioMorphology(
             str(self.data_file),
             options=Option.allow_unifurcated_section_change,
         )
+
+    def load_from_swc(self, fast=True):
+        """
+        Load the neuron's points from a .swc file.
+
+        :param fast: bool, if True the file is parsed with NumPy (or loaded
+            from its binary cache, see save_parsed_swc) and the NeuroM
+            morphology is only built when self.morphology is accessed.
+            Otherwise (or if the fast reader fails) the file is loaded with
+            NeuroM and each neurite in self.points keeps a reference to its
+            NeuroM neurite.
+        """
+        if self.neuron_name is None:
+            self.neuron_name = self.data_file.name
+
+        if fast:
+            try:
+                compact = load_swc(self.data_file, name=self.neuron_name)
+                self._load_from_compact(compact)
+                return
+            except ValueError as exc:
+                logger.debug(
+                    "Could not read %s with the fast reader, using NeuroM: %s",
+                    self.data_file,
+                    exc,
+                )
+
+        morphio_input = self._load_morphio()
         nrn = nm.load_morphology(morphio_input)
         self.morphology = nrn
 
@@ -103,10 +177,7 @@ class Neuron(NeuronCache):
                 ),
             )
         except IndexError:
-            logger.warning(
-                f"Neuron {self.neuron_name} has no soma, "
-                "only neurites will be loaded"
-            )
+            self._warn_no_soma()
             self.points = dict(soma=None)
 
         for ntype, nclass in self._neurite_types.items():
@@ -123,7 +194,100 @@ class Neuron(NeuronCache):
                 if n.type == nclass
             ]
 
-    def _parse_mesh_kwargs(self, **kwargs):
+        # Store the morphology as flat arrays
+        section_parents = [
+            -1 if section.is_root else section.parent.id
+            for section in morphio_input.sections
+        ]
+        soma = morphio_input.soma
+        self.compact = CompactMorphology.from_sections(
+            np.column_stack(
+                [morphio_input.points, morphio_input.diameters / 2]
+            ),
+            morphio_input.section_offsets,
+            morphio_input.section_types,
+            section_parents,
+            soma_points=np.column_stack([soma.points, soma.diameters / 2]),
+            name=self.neuron_name,
+        )
+        self._sections = None
+
+    @classmethod
+    def from_compact(cls, compact, data_file, neuron_name=None, **kwargs):
+        """
+        Create a neuron from a CompactMorphology, e.g. one read from a
+        MorphologyStore, without reading data_file. The compact arrays
+        are used as they are, without copies.
+
+        :param compact: CompactMorphology
+        :param data_file: path to the .swc file the morphology comes from,
+            only read if the NeuroM morphology is accessed
+        :param neuron_name: str, name of the neuron (defaults to the
+            compact morphology's name)
+        :param kwargs: keyword arguments passed to Neuron
+        """
+        if neuron_name is None:
+            neuron_name = compact.name
+        neuron = cls(
+            data_file, neuron_name=neuron_name, load_file=False, **kwargs
+        )
+        neuron._load_from_compact(compact)
+        return neuron
+
+    def _load_from_compact(self, compact):
+        # points and sections are built from the compact arrays when
+        # they're first accessed
+        self.compact = compact
+        self._morphology = None
+        self._points = None
+        self._sections = None
+        if compact.soma is None:
+            self._warn_no_soma()
+
+    def _compact_points(self, compact):
+        soma = compact.soma
+        if soma is not None:
+            points = dict(
+                soma=component(
+                    soma[0], soma[1], soma[2], soma[:3], soma[3], None
+                ),
+            )
+        else:
+            points = dict(soma=None)
+
+        # Group the nodes of each neurite
+        n_soma = compact.section_offsets[0]
+        node_root = np.repeat(
+            section_roots(compact.section_parents),
+            np.diff(compact.section_offsets),
+        )
+        order = np.argsort(node_root, kind="stable")
+        roots, starts = np.unique(node_root[order], return_index=True)
+        neurites = np.split(compact.nodes[n_soma:][order], starts[1:])
+
+        for ntype, nclass in self._neurite_types.items():
+            points[ntype] = [
+                component(
+                    neurite[:, 0],
+                    neurite[:, 1],
+                    neurite[:, 2],
+                    neurite[:, :3],
+                    neurite[:, 3],
+                    None,
+                )
+                for root, neurite in zip(roots, neurites)
+                if compact.section_types[root] == nclass.value
+            ]
+        return points
+
+    def _warn_no_soma(self):
+        logger.warning(
+            f"Neuron {self.neuron_name} has no soma, "
+            "only neurites will be loaded"
+        )
+
+    @staticmethod
+    def _parse_mesh_kwargs(**kwargs):
         # To give the entire neuron the same color
         neuron_color = kwargs.pop("neuron_color", None)
 
@@ -171,10 +335,46 @@ class Neuron(NeuronCache):
             kwargs,
         )
 
+    _mesh_modes = ("tubes", "lines")
+
+    # Maximum number of triangles of each level of detail (level 0 is the
+    # full resolution mesh)
+    lod_triangle_budgets = (100_000, 25_000, 5_000)
+
     def create_mesh(
-        self, neurite_radius=2, soma_radius=4, use_cache=True, **kwargs
+        self,
+        neurite_radius=2,
+        soma_radius=4,
+        use_cache=True,
+        mode="tubes",
+        lod=0,
+        simplify_tolerance=None,
+        **kwargs,
     ):
-        if self.points is None:
+        """
+        Create the meshes of the neuron's soma and neurites.
+
+        :param neurite_radius: float, radius of the neurites tubes
+        :param soma_radius: float, radius of the soma relative to the
+            radius stored in the data file
+        :param use_cache: bool, if True cached meshes are used when
+            available
+        :param mode: "tubes" to tessellate neurites as tubes or "lines" to
+            represent them as polylines (much lighter, useful to render
+            large populations)
+        :param lod: int, level of detail. 0 is the full resolution mesh,
+            higher levels are decimated to the triangle budgets in
+            lod_triangle_budgets. All levels are cached the first time a
+            level > 0 is requested.
+        :param simplify_tolerance: float, if given the polyline of each
+            section is simplified before meshing, removing points closer
+            than this distance to the simplified line. Branch points and
+            terminations are always kept.
+        :param kwargs: colors, see _parse_mesh_kwargs
+        :returns: dictionary with a mesh for each component and a mesh
+            of the whole neuron
+        """
+        if self.compact is None:
             logger.warning(
                 "No data loaded, you can use the 'load_from_file' "
                 "method to try to load the file."
@@ -204,8 +404,30 @@ class Neuron(NeuronCache):
                 "Invalid value for parameter soma_radius, "
                 "should be a float > 0"
             )
-        # prepare params dict for caching
-        _params = dict(neurite_radius=neurite_radius, soma_radius=soma_radius)
+        if mode not in self._mesh_modes:
+            raise ValueError(
+                f"Invalid value for parameter mode: {mode}, "
+                f"should be one of {self._mesh_modes}"
+            )
+        if lod not in range(len(self.lod_triangle_budgets) + 1):
+            raise ValueError(
+                f"Invalid value for parameter lod: {lod}, should be an "
+                f"integer between 0 and {len(self.lod_triangle_budgets)}"
+            )
+        if lod and mode != "tubes":
+            raise ValueError("Levels of detail are only available for tubes")
+        if simplify_tolerance is not None and (
+            not isinstance(simplify_tolerance, (int, float))
+            or simplify_tolerance < 0
+        ):
+            raise ValueError(
+                "Invalid value for parameter simplify_tolerance, "
+                "should be a float >= 0"
+            )
+
+        _params = self._mesh_params(
+            neurite_radius, soma_radius, mode, lod, simplify_tolerance
+        )
 
         # Check if cached files already exist
         if use_cache:
@@ -216,67 +438,229 @@ class Neuron(NeuronCache):
         # Render
         if neurites is not None:
             whole_neuron = neurites.pop("whole_neuron")
-            neurites["soma"].c(soma_color)
         else:
-            # Create soma actor
-            neurites = {}
-            if self.points["soma"] is not None:
-                coords = self.points["soma"].coords
-                if self.invert_dims:
-                    coords = coords[[2, 1, 0]]
-
-                soma = Sphere(
-                    pos=coords,
-                    r=self.points["soma"].radius * soma_radius,
-                    c=soma_color,
-                ).compute_normals()
-                neurites["soma"] = soma.clone().c(soma_color)
-
-            # Create neurites actors
-            for ntype in self._neurite_types:
-                actors = []
-                for neurite in self.points[ntype]:
-                    for section in iter_sections(neurite.component):
-                        for child in section.children:
-                            if not child.children:
-                                coords = child.points[:, COLS.XYZ]
-                                if self.invert_dims:
-                                    coords = coords[:, [2, 1, 0]]
-                                actors.append(Tube(coords, r=neurite_radius))
-                            else:
-                                for grandchild in child.children:
-                                    coords = grandchild.points[:, COLS.XYZ]
-                                    if self.invert_dims:
-                                        coords = coords[:, [2, 1, 0]]
-                                    actors.append(
-                                        Tube(coords, r=neurite_radius)
-                                    )
-
-                if actors:
-                    neurites[ntype] = merge(
-                        actors
-                    ).compute_normals()  # .smoothMLS2D(f=0.1)
+            # Only one process builds the meshes of the neuron with these
+            # parameters, the others wait and then load them from the cache
+            if use_cache:
+                lock = self.cache_lock(self.neuron_name, dict(_params, lod=0))
+            else:
+                lock = nullcontext(False)
+            with lock as waited:
+                if waited:
+                    neurites = self.load_cached_neuron(
+                        self.neuron_name, _params
+                    )
+                if neurites is not None:
+                    whole_neuron = neurites.pop("whole_neuron")
                 else:
-                    neurites[ntype] = None
+                    neurites, whole_neuron = self._render_meshes(
+                        _params, use_cache
+                    )
 
-            # Merge actors to get the entire neuron
-            actors = [
-                act.clone() for act in neurites.values() if act is not None
-            ]
-            whole_neuron = merge(actors).clean().compute_normals()
+        self._color_meshes(
+            neurites,
+            whole_neuron,
+            soma_color,
+            apical_dendrites_color,
+            basal_dendrites_color,
+            axon_color,
+            whole_neuron_color,
+        )
+        return neurites, whole_neuron
 
-            # Write to cache
-            to_write = neurites.copy()
-            to_write["whole_neuron"] = whole_neuron
-            self.write_neuron_to_cache(self.neuron_name, to_write, _params)
+    def _render_meshes(self, _params, use_cache=True):
+        """
+        Build the meshes of the neuron (or a decimated level of detail,
+        from the cached full resolution meshes if available) and write
+        them to the cache.
+        """
+        # Decimated levels are made from the full resolution meshes
+        lod = _params["lod"]
+        full_params = dict(_params, lod=0)
+        neurites = None
+        if lod and use_cache:
+            neurites = self.load_cached_neuron(self.neuron_name, full_params)
 
-        # Color actors
-        colors = [basal_dendrites_color, apical_dendrites_color, axon_color]
-        for n, key in enumerate(
-            ["basal_dendrites", "apical_dendrites", "axon"]
-        ):
-            if neurites[key] is not None:
-                neurites[key] = neurites[key].c(colors[n])
-        whole_neuron.c(whole_neuron_color)
+        if neurites is not None:
+            whole_neuron = neurites.pop("whole_neuron")
+        else:
+            neurites, whole_neuron = self._build_meshes(
+                _params["neurite_radius"],
+                _params["soma_radius"],
+                _params["mode"],
+                _params["simplify_tolerance"],
+            )
+            self._write_meshes_to_cache(neurites, whole_neuron, full_params)
 
+        if lod:
+            neurites, whole_neuron = self._build_lod_pyramid(
+                neurites, whole_neuron, full_params
+            )[lod - 1]
         return neurites, whole_neuron
+
+    def _source_hash(self):
+        """
+        Hash of the content of the data file, computed again only if its
+        size or modification time changed. Neurons without a data file
+        are hashed from their compact morphology.
+        """
+        try:
+            stat = self.data_file.stat()
+        except OSError:
+            digest = hashlib.blake2b(digest_size=16)
+            for array in (
+                self.compact.nodes,
+                self.compact.parents,
+                self.compact.types,
+            ):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            return digest.hexdigest()
+
+        file_id = (stat.st_size, stat.st_mtime_ns)
+        if getattr(self, "_source_hash_cache", (None,))[0] != file_id:
+            with open(self.data_file, "rb") as f:
+                digest = hashlib.file_digest(
+                    f, lambda: hashlib.blake2b(digest_size=16)
+                )
+            self._source_hash_cache = (file_id, digest.hexdigest())
+        return self._source_hash_cache[1]
+
+    def _mesh_params(
+        self,
+        neurite_radius=2,
+        soma_radius=4,
+        mode="tubes",
+        lod=0,
+        simplify_tolerance=None,
+    ):
+        """
+        Get the parameters the meshes of the neuron depend on, used to
+        key them in the cache (see NeuronCache.cache_key).
+        """
+        return dict(
+            source=self._source_hash(),
+            neurite_radius=float(neurite_radius),
+            soma_radius=float(soma_radius),
+            mode=mode,
+            lod=int(lod),
+            simplify_tolerance=(
+                float(simplify_tolerance) if simplify_tolerance else None
+            ),
+            invert_dims=bool(self.invert_dims),
+        )
+
+    def _build_meshes(
+        self, neurite_radius, soma_radius, mode, simplify_tolerance=None
+    ):
+        # Create soma actor
+        neurites = {}
+        soma = self.compact.soma
+        if soma is not None:
+            coords = soma[:3]
+            if self.invert_dims:
+                coords = coords[[2, 1, 0]]
+
+            neurites["soma"] = Sphere(
+                pos=coords,
+                r=soma[3] * soma_radius,
+            ).compute_normals()
+
+        # Create neurites actors, one tube filter per neurite type
+        n_points, n_simplified = 0, 0
+        for ntype in self._neurite_types:
+            points, offsets = self.sections[ntype]
+            if simplify_tolerance:
+                n_points += len(points) - (len(offsets) - 1)
+                points, offsets = simplify_sections(
+                    points, offsets, simplify_tolerance
+                )
+                n_simplified += len(points) - (len(offsets) - 1)
+
+            coords = points[:, :3]
+            if self.invert_dims:
+                coords = coords[:, [2, 1, 0]]
+
+            if mode == "tubes":
+                mesh = tube_mesh(coords, offsets, neurite_radius)
+            else:
+                mesh = lines_mesh(coords, offsets)
+            if mesh is not None:
+                neurites[ntype] = mesh.compute_normals()
+            else:
+                neurites[ntype] = None
+
+        if n_points:
+            # The number of triangles of each tube is proportional to the
+            # number of segments of its section
+            logger.info(
+                "Simplifying the sections of %s reduced the number of "
+                "segments from %s to %s and of neurite triangles by %.1f%%",
+                self.neuron_name,
+                n_points,
+                n_simplified,
+                100 * (1 - n_simplified / n_points),
+            )
+
+        return neurites, self._whole_neuron_mesh(neurites)
+
+    @staticmethod
+    def _whole_neuron_mesh(neurites):
+        # Concatenate the components like when loading them from the
+        # cache, so that the mesh is the same whichever path made it
+        return whole_neuron_mesh(
+            {
+                key: mesh_to_arrays(mesh)
+                for key, mesh in neurites.items()
+                if mesh is not None
+            }
+        )
+
+    def _write_meshes_to_cache(self, neurites, whole_neuron, _params):
+        to_write = neurites.copy()
+        to_write["whole_neuron"] = whole_neuron
+        self.write_neuron_to_cache(self.neuron_name, to_write, _params)
+
+    def _build_lod_pyramid(self, neurites, whole_neuron, _params):
+        """
+        Decimate the full resolution meshes to each triangle budget in
+        lod_triangle_budgets and write each level to the cache.
+        """
+        levels = []
+        n_triangles = max(whole_neuron.ncells, 1)
+        for lod, budget in enumerate(self.lod_triangle_budgets, start=1):
+            # The same fraction of triangles is kept for each component
+            fraction = budget / n_triangles
+            level = {
+                key: (
+                    decimate_mesh(mesh, fraction) if mesh is not None else None
+                )
+                for key, mesh in neurites.items()
+            }
+            level_whole_neuron = self._whole_neuron_mesh(level)
+
+            self._write_meshes_to_cache(
+                level, level_whole_neuron, dict(_params, lod=lod)
+            )
+            levels.append((level, level_whole_neuron))
+        return levels
+
+    @staticmethod
+    def _color_meshes(
+        neurites,
+        whole_neuron,
+        soma_color,
+        apical_dendrites_color,
+        basal_dendrites_color,
+        axon_color,
+        whole_neuron_color,
+    ):
+        colors = dict(
+            soma=soma_color,
+            basal_dendrites=basal_dendrites_color,
+            apical_dendrites=apical_dendrites_color,
+            axon=axon_color,
+        )
+        for key, color in colors.items():
+            if neurites.get(key) is not None:
+                neurites[key] = neurites[key].c(color)
+        whole_neuron.c(whole_neuron_color)
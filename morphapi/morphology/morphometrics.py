@@ -0,0 +1,170 @@
+"""
+Morphometrics of whole populations of neurons, computed with a few
+vectorized passes over the concatenated arrays of their compact
+morphologies instead of one NeuroM call per neuron.
+"""
+
+import numpy as np
+import pandas as pd
+
+from morphapi.morphology.compact import CompactMorphology
+from morphapi.morphology.morphology import Neuron
+from morphapi.morphology.swc import _pointer_jump, section_roots
+
+# SWC structure identifier of each neurite type
+_neurite_values = {
+    ntype: nclass.value for ntype, nclass in Neuron._neurite_types.items()
+}
+
+
+def _concatenate(compacts):
+    """
+    Concatenate the arrays of many compact morphologies, with node and
+    section indices shifted to index the concatenated arrays.
+
+    :returns: tuple with the (N, 4) nodes, and for each section its
+        neuron, first and last + 1 node, type and parent section
+    """
+    n_nodes = np.array([c.n_nodes for c in compacts], dtype=np.int64)
+    n_sections = np.array([c.n_sections for c in compacts], dtype=np.int64)
+    node_shift = np.repeat(np.cumsum(n_nodes) - n_nodes, n_sections)
+    section_shift = np.repeat(np.cumsum(n_sections) - n_sections, n_sections)
+
+    def concat(arrays, empty):
+        return np.concatenate(list(arrays) or [empty]).astype(empty.dtype)
+
+    nodes = concat((c.nodes for c in compacts), np.zeros((0, 4)))
+    int_empty = np.zeros(0, dtype=np.int64)
+    starts = concat((c.section_offsets[:-1] for c in compacts), int_empty)
+    ends = concat((c.section_offsets[1:] for c in compacts), int_empty)
+    types = concat((c.section_types for c in compacts), int_empty)
+    parents = concat((c.section_parents for c in compacts), int_empty)
+
+    return (
+        nodes,
+        np.repeat(np.arange(len(compacts)), n_sections),
+        starts + node_shift,
+        ends + node_shift,
+        types,
+        np.where(parents >= 0, parents + section_shift, -1),
+    )
+
+
+def population_morphometrics(neurons):
+    """
+    Compute morphometrics of many neurons at once.
+
+    For all neurites and for each neurite type (e.g. "axon_length") the
+    following columns are computed, with sections assigned to the type of
+    their neurite like in NeuroM:
+
+    - length: total length of the neurites
+    - n_sections: number of sections
+    - n_branch_points: number of sections with two or more children
+    - n_terminals: number of sections without children
+    - max_path_length: longest path from the start of a neurite to one
+      of its terminals
+
+    The bounding box of all nodes is given by the x_min, ..., z_max
+    columns.
+
+    :param neurons: list of Neuron instances (loaded from their file) or
+        CompactMorphology instances
+    :returns: pandas DataFrame with one row per neuron, indexed by the
+        neurons' names
+    """
+    names, compacts = [], []
+    for neuron in neurons:
+        if isinstance(neuron, CompactMorphology):
+            names.append(neuron.name)
+            compacts.append(neuron)
+        elif neuron.compact is None:
+            raise ValueError(
+                f"Neuron {neuron.neuron_name} has no morphology loaded"
+            )
+        else:
+            names.append(neuron.neuron_name)
+            compacts.append(neuron.compact)
+
+    n_neurons = len(compacts)
+    nodes, section_neuron, starts, ends, types, parents = _concatenate(
+        compacts
+    )
+    n_sections = len(types)
+    has_parent = parents >= 0
+
+    # Length of the segments between consecutive nodes of each section,
+    # including the segment from the parent section's last node
+    xyz = nodes[:, :3]
+    segment_lengths = np.zeros(len(nodes))
+    segment_lengths[1:] = np.linalg.norm(np.diff(xyz, axis=0), axis=1)
+    cumulative = np.cumsum(segment_lengths)
+    section_lengths = np.zeros(n_sections)
+    non_empty = ends > starts
+    section_lengths[non_empty] = (
+        cumulative[ends[non_empty] - 1] - cumulative[starts[non_empty]]
+    )
+    parent_ends = ends[np.where(has_parent, parents, 0)] - 1
+    connection = np.linalg.norm(
+        xyz[starts[has_parent]] - xyz[parent_ends[has_parent]], axis=1
+    )
+    section_lengths[has_parent] += connection
+
+    # Path length from the start of the neurite to the end of each section
+    links = np.where(has_parent, parents, np.arange(n_sections))
+    parent_lengths = np.where(
+        has_parent, section_lengths[np.where(has_parent, parents, 0)], 0
+    )
+    _, path_to_start = _pointer_jump(links, parent_lengths)
+    path_lengths = path_to_start + section_lengths
+
+    n_children = np.bincount(parents[has_parent], minlength=n_sections)
+    neurite_types = types[section_roots(parents)]
+
+    def per_neuron(values, mask, reduce="sum"):
+        if reduce == "sum":
+            return np.bincount(
+                section_neuron[mask], weights=values[mask], minlength=n_neurons
+            )
+        result = np.zeros(n_neurons)
+        np.maximum.at(result, section_neuron[mask], values[mask])
+        return result
+
+    columns, counts = {}, []
+    ones = np.ones(n_sections)
+    for prefix, type_mask in [("", np.ones(n_sections, dtype=bool))] + [
+        (f"{ntype}_", neurite_types == value)
+        for ntype, value in _neurite_values.items()
+    ]:
+        columns[f"{prefix}length"] = per_neuron(section_lengths, type_mask)
+        columns[f"{prefix}n_sections"] = per_neuron(ones, type_mask)
+        columns[f"{prefix}n_branch_points"] = per_neuron(
+            ones, type_mask & (n_children >= 2)
+        )
+        columns[f"{prefix}n_terminals"] = per_neuron(
+            ones, type_mask & (n_children == 0)
+        )
+        columns[f"{prefix}max_path_length"] = per_neuron(
+            path_lengths, type_mask & (n_children == 0), reduce="max"
+        )
+        counts += [
+            f"{prefix}{count}"
+            for count in ("n_sections", "n_branch_points", "n_terminals")
+        ]
+
+    # Bounding box of all nodes of each neuron
+    n_nodes = np.array([c.n_nodes for c in compacts], dtype=np.int64)
+    node_starts = np.cumsum(n_nodes) - n_nodes
+    has_nodes = n_nodes > 0
+    for i, axis in enumerate("xyz"):
+        for bound, ufunc in (("min", np.minimum), ("max", np.maximum)):
+            values = np.full(n_neurons, np.nan)
+            if len(nodes):
+                values[has_nodes] = ufunc.reduceat(
+                    xyz[:, i], node_starts[has_nodes]
+                )
+            columns[f"{axis}_{bound}"] = values
+
+    metrics = pd.DataFrame(columns, index=names)
+    metrics[counts] = metrics[counts].astype(np.int64)
+    return metrics
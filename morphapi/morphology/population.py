@@ -0,0 +1,146 @@
+"""
+Functions to render populations of neurons as a single mesh.
+"""
+
+import numpy as np
+from vedo import Mesh
+
+from morphapi.morphology.batch import create_meshes
+from morphapi.morphology.meshing import build_polydata, mesh_to_arrays
+from morphapi.morphology.swc import component_ids
+
+
+def _is_mesh_result(item):
+    # Check if item is the output of Neuron.create_mesh
+    return (
+        isinstance(item, tuple)
+        and len(item) == 2
+        and isinstance(item[0], dict)
+    )
+
+
+def merge_population(
+    neurons, color_by="neuron", cmap="viridis", workers=1, **mesh_kwargs
+):
+    """
+    Merge the meshes of many neurons into a single mesh, to render a whole
+    population with one actor.
+
+    The merged mesh has two cell arrays: "neuron_id", the index of
+    each cell's neuron in neurons, and "component", the structure
+    identifier of each cell's component (see component_ids). Coloring
+    is then a lookup of one of these arrays through a color map.
+
+    :param neurons: list of Neuron instances, paths to .swc files or
+        (neurites, whole_neuron) tuples returned by Neuron.create_mesh
+    :param color_by: "neuron" or "component" to color by one of the cell
+        arrays, a list with one scalar value per neuron (stored in the
+        "neuron_value" cell array), or None to skip coloring
+    :param cmap: str, name of the color map
+    :param workers: int, number of processes used to create the meshes
+        that are not given, see create_meshes
+    :param mesh_kwargs: keyword arguments passed to Neuron.create_mesh
+    :returns: vedo Mesh
+    """
+    if not isinstance(neurons, (list, tuple)) or _is_mesh_result(neurons):
+        neurons = [neurons]
+
+    # Check color_by before meshing the neurons, which can take long
+    if isinstance(color_by, str):
+        if color_by not in ("neuron", "component"):
+            raise ValueError(
+                "color_by should be 'neuron', 'component', None or a list "
+                f"with one value per neuron, not {color_by}"
+            )
+    elif color_by is not None:
+        values = np.asarray(color_by, dtype=float)
+        if values.shape != (len(neurons),):
+            raise ValueError(
+                "color_by should have one value per neuron, "
+                f"got {values.size} values for {len(neurons)} neurons"
+            )
+
+    # Create the meshes that were not given
+    results = list(neurons)
+    to_create = [
+        i for i, res in enumerate(results) if not _is_mesh_result(res)
+    ]
+    if to_create:
+        created = create_meshes(
+            [results[i] for i in to_create], workers=workers, **mesh_kwargs
+        )
+        for i, meshes in zip(to_create, created):
+            results[i] = meshes
+
+    # Collect the buffers of all components, with triangles and line
+    # segments kept apart
+    vertices, normals = [], []
+    cells = {2: [], 3: []}
+    cell_neuron = {2: [], 3: []}
+    cell_component = {2: [], 3: []}
+    n_vertices = 0
+    for neuron_id, meshes in enumerate(results):
+        if meshes is None:
+            continue
+
+        for key, mesh in meshes[0].items():
+            if mesh is None:
+                continue
+
+            mesh_vertices, faces, mesh_normals = mesh_to_arrays(mesh)
+            vertices.append(mesh_vertices)
+            normals.append(mesh_normals)
+
+            size = faces.shape[1]
+            cells[size].append(faces + n_vertices)
+            cell_neuron[size].append(
+                np.full(len(faces), neuron_id, dtype=np.int32)
+            )
+            cell_component[size].append(
+                np.full(len(faces), component_ids[key], dtype=np.uint8)
+            )
+            n_vertices += len(mesh_vertices)
+
+    if not vertices:
+        return Mesh()
+
+    def concatenate(arrays, shape, dtype):
+        if not arrays:
+            return np.zeros(shape, dtype=dtype)
+        return np.concatenate(arrays)
+
+    polydata = build_polydata(
+        np.concatenate(vertices),
+        triangles=concatenate(cells[3], (0, 3), np.int64),
+        lines=concatenate(cells[2], (0, 2), np.int64),
+        normals=np.concatenate(normals),
+    )
+    population = Mesh(polydata).phong()
+
+    # Lines come before triangles in the cells of a vtkPolyData
+    neuron_ids = concatenate(cell_neuron[2] + cell_neuron[3], 0, np.int32)
+    population.celldata["neuron_id"] = neuron_ids
+    population.celldata["component"] = concatenate(
+        cell_component[2] + cell_component[3], 0, np.uint8
+    )
+
+    # Color
+    if color_by is None:
+        return population
+
+    if isinstance(color_by, str):
+        limits = dict(
+            neuron=(0, len(results) - 1),
+            component=(
+                min(component_ids.values()),
+                max(component_ids.values()),
+            ),
+        )
+        vmin, vmax = limits[color_by]
+        array_name = "neuron_id" if color_by == "neuron" else "component"
+        population.cmap(cmap, array_name, on="cells", vmin=vmin, vmax=vmax)
+    else:
+        population.celldata["neuron_value"] = values[neuron_ids]
+        population.cmap(cmap, "neuron_value", on="cells")
+
+    return population
@@ -0,0 +1,160 @@
+"""
+Length of neurites in each region of a brain atlas, for populations of
+neurons.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+# Sparse (neurons x regions) matrix with the length of neurites in each
+# region, the names of the neurons (rows) and the IDs of the regions
+# (columns)
+projection = namedtuple("projection", "matrix neurons regions")
+
+
+def _sample_segments(points, offsets, step):
+    """
+    Split the segments of some polylines into pieces no longer than step.
+
+    :param points: (M, 3) array with the points of the polylines
+    :param offsets: (S + 1,) array of polyline offsets into points
+    :param step: float, maximum length of the pieces
+    :returns: tuple with the (K, 3) midpoints of the pieces and their
+        (K,) lengths
+    """
+    # Segments start at each point but the last one of each polyline
+    is_last = np.zeros(len(points), dtype=bool)
+    is_last[offsets[1:] - 1] = True
+    starts = np.flatnonzero(~is_last)
+
+    vectors = points[starts + 1] - points[starts]
+    lengths = np.linalg.norm(vectors, axis=1)
+    n_pieces = np.maximum(np.ceil(lengths / step), 1).astype(np.int64)
+
+    segment = np.repeat(np.arange(len(starts)), n_pieces)
+    first_piece = np.cumsum(n_pieces) - n_pieces
+    fraction = (np.arange(len(segment)) - first_piece[segment] + 0.5) / (
+        n_pieces[segment]
+    )
+    midpoints = points[starts[segment]] + vectors[segment] * fraction[:, None]
+    return midpoints, (lengths / n_pieces)[segment]
+
+
+def _ancestors_matrix(regions, structures):
+    """
+    Sparse (regions x regions) matrix with ones where the column region
+    is the row region or one of its ancestors.
+    """
+    rows, cols = [], []
+    for i, region in enumerate(regions):
+        path = structures[region]["structure_id_path"]
+        ancestors = np.searchsorted(regions, path)
+        rows += [i] * len(path)
+        cols += list(ancestors)
+    return sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(len(regions),) * 2
+    )
+
+
+def projection_matrix(
+    neurons,
+    atlas,
+    components=("axon",),
+    step=None,
+    rollup=False,
+    chunk_size=1_000_000,
+):
+    """
+    Compute the length of the neurites of each neuron in each region of
+    an atlas.
+
+    Segments are split in pieces no longer than step, and the midpoints
+    of the pieces are looked up in the atlas annotation volume with one
+    vectorized indexing operation per chunk of sections.
+    Points are in the same space as the neurons' meshes (i.e. after
+    invert_dims) and in microns.
+
+    :param neurons: iterable of Neuron instances, e.g. the iterator
+        returned by load_neurons(..., lazy=True) to process large
+        populations without loading all neurons at once
+    :param atlas: brainglobe_atlasapi.BrainGlobeAtlas
+    :param components: list of neurite types, e.g. ["axon",
+        "basal_dendrites"]
+    :param step: float, sampling step in microns. Defaults to half of the
+        atlas resolution.
+    :param rollup: bool, if True the length in each region includes the
+        length in all its subregions
+    :param chunk_size: int, number of section points processed at once,
+        to bound memory usage
+    :returns: projection, use e.g.
+        pandas.DataFrame.sparse.from_spmatrix(*projection) to get a
+        DataFrame
+    """
+    resolution = np.asarray(atlas.resolution, dtype=float)
+    if step is None:
+        step = resolution.min() / 2
+    annotation = atlas.annotation
+    shape = np.array(annotation.shape)
+    regions = np.array(sorted(atlas.structures.keys()), dtype=np.int64)
+
+    names, rows, cols, values = [], [], [], []
+    for row, neuron in enumerate(neurons):
+        names.append(neuron.neuron_name)
+        for component in components:
+            points, offsets = neuron.sections[component]
+            coords = points[:, :3].astype(float)
+            if neuron.invert_dims:
+                coords = coords[:, [2, 1, 0]]
+
+            # Process the sections in chunks of up to chunk_size points
+            # (one section at least)
+            section = 0
+            while section < len(offsets) - 1:
+                last = np.searchsorted(
+                    offsets, offsets[section] + chunk_size, side="right"
+                )
+                last = min(max(last - 1, section + 1), len(offsets) - 1)
+                chunk_offsets = offsets[section : last + 1]
+                midpoints, lengths = _sample_segments(
+                    coords[chunk_offsets[0] : chunk_offsets[-1]],
+                    chunk_offsets - chunk_offsets[0],
+                    step,
+                )
+                section = last
+
+                # Look up the region of each point, outside of the volume
+                # or of any region points are ignored
+                voxels = np.floor(midpoints / resolution).astype(np.int64)
+                inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+                ids = annotation[tuple(voxels[inside].T)].astype(np.int64)
+                column = np.searchsorted(regions, ids)
+                column = np.minimum(column, len(regions) - 1)
+                known = regions[column] == ids
+
+                per_region = np.bincount(
+                    column[known],
+                    weights=lengths[inside][known],
+                    minlength=len(regions),
+                )
+                nonzero = np.flatnonzero(per_region)
+                rows.append(np.full(len(nonzero), row))
+                cols.append(nonzero)
+                values.append(per_region[nonzero])
+
+    def concat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype)
+
+    # Duplicated entries are summed
+    matrix = sparse.csr_matrix(
+        (
+            concat(values, float),
+            (concat(rows, np.int64), concat(cols, np.int64)),
+        ),
+        shape=(len(names), len(regions)),
+    )
+    if rollup:
+        matrix = matrix @ _ancestors_matrix(regions, atlas.structures)
+
+    return projection(matrix=matrix.tocsr(), neurons=names, regions=regions)
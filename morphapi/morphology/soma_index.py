@@ -0,0 +1,240 @@
+"""
+Persisted table of the soma position of all neurons in some folders,
+built by reading only the soma line of each .swc file.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rich.progress import track
+
+from morphapi.morphology.swc import read_soma
+
+logger = logging.getLogger(__name__)
+
+
+class SomaIndex:
+    """
+    Table with the name, file, source folder, soma position and radius
+    and atlas region of many neurons, saved as one array per column in a
+    .npz file so that it loads in milliseconds.
+
+    update reads only the soma line of the files that are new or were
+    modified (by size and modification time) since the last update.
+    Positions are in the same space as the neurons' meshes (i.e. after
+    invert_dims). Region is the ID of the atlas region containing the
+    soma, 0 outside of the atlas, and -1 when no atlas was given or the
+    file has no soma (in which case the coordinates are NaN).
+    """
+
+    _columns = dict(
+        name=str,
+        file=str,
+        source=str,
+        x=float,
+        y=float,
+        z=float,
+        radius=float,
+        region=np.int64,
+        size=np.int64,
+        mtime_ns=np.int64,
+    )
+
+    def __init__(self, file_path):
+        """
+        :param file_path: path to the .npz file of the index, created by
+            update if it doesn't exist
+        """
+        self.file_path = Path(file_path)
+        if self.file_path.exists():
+            with np.load(self.file_path) as data:
+                columns = {
+                    column: data[f"column_{column}"]
+                    for column in self._columns
+                }
+        else:
+            columns = {
+                column: np.zeros(0, dtype=dtype)
+                for column, dtype in self._columns.items()
+            }
+        self.table = pd.DataFrame(columns)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return f"SomaIndex({str(self.file_path)!r}, {len(self)} neurons)"
+
+    def update(self, sources, atlas=None, invert_dims=False):
+        """
+        Add the .swc files that are new or were modified since the last
+        update, and remove the files that were deleted from the folders.
+
+        :param sources: list of folders (e.g. Paths().mouselight_cache)
+            and/or paths to .swc files
+        :param atlas: BrainGlobeAtlas or name of an atlas, used to find the
+            region of each soma. It's only loaded if some files are read.
+        :param invert_dims: bool, if True the x and z coordinates of the
+            files are swapped, like with Neuron(invert_dims=True)
+        :returns: int, number of files read
+        """
+        if isinstance(sources, (str, Path)):
+            sources = [sources]
+
+        files, folders = [], []
+        for source in map(Path, sources):
+            if source.is_dir():
+                folders.append(str(source.resolve()))
+                files.extend(sorted(source.glob("*.swc")))
+            else:
+                files.append(source)
+        files = [str(f.resolve()) for f in files]
+        stats = [os.stat(f) for f in files]
+
+        # Keep the rows of unchanged files, and of files outside of the
+        # sources unless they were deleted from one of the folders
+        table = self.table
+        known = dict(zip(table["file"], zip(table["size"], table["mtime_ns"])))
+        to_read = [
+            (file, stat)
+            for file, stat in zip(files, stats)
+            if known.get(file) != (stat.st_size, stat.st_mtime_ns)
+        ]
+        stale = {file for file, _ in to_read}
+        keep = np.array(
+            [
+                file not in stale
+                and (
+                    Path(file).exists()
+                    or str(Path(file).parent) not in folders
+                )
+                for file in table["file"]
+            ],
+            dtype=bool,
+        )
+        if not to_read and keep.all():
+            return 0
+
+        somata = np.full((len(to_read), 4), np.nan)
+        for i, (file, _) in enumerate(
+            track(to_read, description="Reading somata")
+        ):
+            try:
+                soma = read_soma(file)
+            except (OSError, ValueError) as exc:
+                logger.error("Could not read the soma of %s: %s", file, exc)
+                continue
+            if soma is not None:
+                somata[i] = soma
+        if invert_dims:
+            somata[:, :3] = somata[:, [2, 1, 0]]
+
+        regions = np.full(len(to_read), -1, dtype=np.int64)
+        if atlas is not None and to_read:
+            if isinstance(atlas, str):
+                # Imported here to keep importing morphapi.morphology fast
+                from brainglobe_atlasapi import BrainGlobeAtlas
+
+                atlas = BrainGlobeAtlas(atlas, print_authors=False)
+            regions = self._lookup_regions(somata[:, :3], atlas)
+
+        new_rows = pd.DataFrame(
+            dict(
+                name=[Path(file).stem for file, _ in to_read],
+                file=[file for file, _ in to_read],
+                source=[Path(file).parent.name for file, _ in to_read],
+                x=somata[:, 0],
+                y=somata[:, 1],
+                z=somata[:, 2],
+                radius=somata[:, 3],
+                region=regions,
+                size=[stat.st_size for _, stat in to_read],
+                mtime_ns=[stat.st_mtime_ns for _, stat in to_read],
+            )
+        )
+        self.table = pd.concat(
+            [table.loc[keep], new_rows], ignore_index=True
+        ).astype(self._columns)
+        self.save()
+        return len(to_read)
+
+    @staticmethod
+    def _lookup_regions(coords, atlas):
+        # Region of each point, 0 outside of the annotation volume and -1
+        # for NaN coordinates
+        regions = np.full(len(coords), -1, dtype=np.int64)
+        valid = ~np.isnan(coords).any(axis=1)
+        voxels = np.floor(coords[valid] / np.asarray(atlas.resolution))
+        voxels = voxels.astype(np.int64)
+        shape = np.asarray(atlas.annotation.shape)
+        inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+
+        found = np.zeros(len(voxels), dtype=np.int64)
+        found[inside] = atlas.annotation[tuple(voxels[inside].T)]
+        regions[valid] = found
+        return regions
+
+    def save(self):
+        """
+        Save the table to the index file.
+        """
+        # np.savez adds the .npz extension if missing, and its first
+        # argument is called file: keys are prefixed to avoid a clash
+        tmp_path = self.file_path.with_name(
+            f".{self.file_path.stem}.{os.getpid()}.npz"
+        )
+        np.savez(
+            tmp_path,
+            **{
+                f"column_{column}": self.table[column].to_numpy(dtype=dtype)
+                for column, dtype in self._columns.items()
+            },
+        )
+        os.replace(tmp_path, self.file_path)
+
+    def query_region(self, region, atlas=None):
+        """
+        Get the neurons whose soma is in a region.
+
+        :param region: int, region ID, or acronym if atlas is given
+        :param atlas: BrainGlobeAtlas, if given the neurons in the
+            subregions of region are included too
+        :returns: pandas DataFrame with the rows of the table
+        """
+        if atlas is None:
+            return self.table[self.table["region"] == region]
+
+        region = atlas.structures[region]["id"]
+        ids = [
+            structure_id
+            for structure_id, structure in atlas.structures.items()
+            if region in structure["structure_id_path"]
+        ]
+        return self.table[self.table["region"].isin(ids)]
+
+    def query_sphere(self, center, radius):
+        """
+        Get the neurons whose soma is within a distance from a point.
+
+        :param center: x, y, z coordinates
+        :param radius: float, distance
+        :returns: pandas DataFrame with the rows of the table
+        """
+        xyz = self.table[["x", "y", "z"]].to_numpy()
+        distances = np.linalg.norm(xyz - np.asarray(center), axis=1)
+        return self.table[distances <= radius]
+
+    def query_box(self, lower, upper):
+        """
+        Get the neurons whose soma is inside an axis-aligned box.
+
+        :param lower: x, y, z coordinates of the box's lower corner
+        :param upper: x, y, z coordinates of the box's upper corner
+        :returns: pandas DataFrame with the rows of the table
+        """
+        xyz = self.table[["x", "y", "z"]].to_numpy()
+        inside = np.all((xyz >= lower) & (xyz <= upper), axis=1)
+        return self.table[inside]
@@ -0,0 +1,422 @@
+"""
+Persistent spatial index over the nodes of many neurons, to find which
+neurons have nodes in a region of space without loading them.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from rich.progress import track
+from scipy.spatial import cKDTree
+
+from morphapi.morphology.compact import load_swc
+from morphapi.morphology.swc import component_ids
+
+logger = logging.getLogger(__name__)
+
+_component_names = {value: name for name, value in component_ids.items()}
+
+
+class SpatialIndex:
+    """
+    KD-trees over the nodes of all .swc files in some folders (e.g. the
+    cache folders of morphapi.paths_manager.Paths), with one tree per
+    component type (soma, axon, basal_dendrites, apical_dendrites).
+
+    The index is saved in a folder. Neurons are added in segments: each
+    call to update indexes the new and modified files in a new segment,
+    so that existing trees don't have to be rebuilt. Segments are merged
+    once there are more than max_segments of them.
+
+    Queries return the matching nodes as ranges of node indices into
+    the nodes of each neuron's CompactMorphology (which are in the order
+    of the file's neurite nodes, after the soma nodes).
+    Coordinates are those of the .swc files (invert_dims is not applied).
+    """
+
+    _index_file = "index.json"
+    _columns = dict(
+        name=object,
+        file=object,
+        size=np.int64,
+        mtime_ns=np.int64,
+        removed=bool,
+    )
+
+    def __init__(self, index_dir, max_segments=8):
+        """
+        :param index_dir: path to the folder where the index is saved
+        :param max_segments: int, number of segments above which all
+            segments are merged
+        """
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.max_segments = max_segments
+
+        # One row per indexed file, rows of modified or deleted files are
+        # flagged as removed until the segments are merged
+        self.neurons = pd.DataFrame(
+            {
+                column: pd.Series(dtype=dtype)
+                for column, dtype in self._columns.items()
+            }
+        )
+        self._segments = []
+        self._next_segment = 0
+
+        index_file = self.index_dir / self._index_file
+        if index_file.exists():
+            with open(index_file) as f:
+                index = json.load(f)
+            self.neurons = pd.DataFrame(index["neurons"]).astype(self._columns)
+            self._next_segment = index["next_segment"]
+            for segment in index["segments"]:
+                self._segments.append(
+                    (segment, self._load_segment(self.index_dir / segment))
+                )
+
+    def __len__(self):
+        return int((~self.neurons["removed"]).sum())
+
+    def __repr__(self):
+        return (
+            f"SpatialIndex({str(self.index_dir)!r}, {len(self)} neurons, "
+            f"{len(self._segments)} segments)"
+        )
+
+    def update(self, sources):
+        """
+        Index the .swc files that are new or were modified since they
+        were indexed, and drop the files that were deleted.
+
+        :param sources: list of folders and/or paths to .swc files
+        :returns: int, number of files indexed
+        """
+        if isinstance(sources, (str, Path)):
+            sources = [sources]
+
+        files = []
+        for source in map(Path, sources):
+            if source.is_dir():
+                files.extend(sorted(source.glob("*.swc")))
+            else:
+                files.append(source)
+        files = [str(f.resolve()) for f in files]
+
+        current = self.neurons[~self.neurons["removed"]]
+        indexed = {
+            row.file: (row.Index, row.size, row.mtime_ns)
+            for row in current.itertuples()
+        }
+
+        to_index, to_remove = [], []
+        for file in files:
+            stat = os.stat(file)
+            if file in indexed:
+                row, size, mtime_ns = indexed.pop(file)
+                if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                to_remove.append(row)
+            to_index.append((file, stat))
+
+        # Files under the sources which don't exist anymore
+        folders = [str(Path(s).resolve()) for s in sources if Path(s).is_dir()]
+        to_remove += [
+            row
+            for file, (row, _, _) in indexed.items()
+            if not Path(file).exists() and str(Path(file).parent) in folders
+        ]
+
+        if to_remove:
+            self.neurons.loc[to_remove, "removed"] = True
+        if to_index:
+            self._add_segment(to_index)
+        if len(self._segments) > self.max_segments:
+            self.merge()
+        else:
+            self._save_index()
+
+        return len(to_index)
+
+    def _add_segment(self, files):
+        first_row = len(self.neurons)
+        rows, arrays = [], dict(coords=[], neuron=[], node=[], types=[])
+        for file, stat in track(files, description="Indexing neurons"):
+            try:
+                compact = load_swc(file)
+            except Exception as exc:
+                logger.error("Could not index %s: %s", file, exc)
+                continue
+
+            neuron = first_row + len(rows)
+            rows.append(
+                dict(
+                    name=Path(file).stem,
+                    file=file,
+                    size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns,
+                    removed=False,
+                )
+            )
+            arrays["coords"].append(compact.nodes[:, :3])
+            arrays["neuron"].append(np.full(compact.n_nodes, neuron))
+            arrays["node"].append(np.arange(compact.n_nodes))
+            arrays["types"].append(compact.types)
+
+        if not rows:
+            return
+
+        rows = pd.DataFrame(rows).astype(self._columns)
+        if len(self.neurons):
+            rows = pd.concat([self.neurons, rows], ignore_index=True)
+        self.neurons = rows
+        self._write_segment(
+            **{key: np.concatenate(value) for key, value in arrays.items()}
+        )
+
+    @staticmethod
+    def _load_segment(file_path):
+        # The trees are rebuilt from the saved points, which is fast
+        segment = {}
+        with np.load(file_path) as data:
+            for component in component_ids:
+                if f"{component}_coords" not in data:
+                    continue
+                segment[component] = dict(
+                    tree=cKDTree(
+                        data[f"{component}_coords"].astype(np.float64)
+                    ),
+                    neuron=data[f"{component}_neuron"],
+                    node=data[f"{component}_node"],
+                )
+        return segment
+
+    def _write_segment(self, coords, neuron, node, types):
+        # One tree per component, with the neuron (row of self.neurons)
+        # and node index of each point. Coordinates come from float32
+        # nodes, so they're saved as float32 without loss.
+        name = f"segment_{self._next_segment}.npz"
+        self._next_segment += 1
+        arrays = {}
+        for component, value in component_ids.items():
+            select = types == value
+            if not select.any():
+                continue
+            arrays[f"{component}_coords"] = coords[select].astype(np.float32)
+            arrays[f"{component}_neuron"] = neuron[select].astype(np.int32)
+            arrays[f"{component}_node"] = node[select].astype(np.int32)
+
+        # np.savez adds the .npz extension if missing
+        tmp_path = self.index_dir / f".{name[:-4]}.{os.getpid()}.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.index_dir / name)
+        self._segments.append(
+            (name, self._load_segment(self.index_dir / name))
+        )
+
+    def _save_index(self):
+        index = dict(
+            neurons=self.neurons.to_dict(orient="list"),
+            segments=[name for name, _ in self._segments],
+            next_segment=self._next_segment,
+        )
+        tmp_path = self.index_dir / f".{self._index_file}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_dir / self._index_file)
+
+        # Remove the files of merged segments
+        for path in self.index_dir.glob("segment_*.npz"):
+            if path.name not in index["segments"]:
+                path.unlink()
+
+    def merge(self):
+        """
+        Merge all segments into one, dropping the nodes of removed files.
+        """
+        keep = ~self.neurons["removed"].to_numpy()
+        new_row = np.cumsum(keep) - 1
+
+        arrays = dict(coords=[], neuron=[], node=[], types=[])
+        for _, segment in self._segments:
+            for component, data in segment.items():
+                select = keep[data["neuron"]]
+                arrays["coords"].append(data["tree"].data[select])
+                arrays["neuron"].append(new_row[data["neuron"][select]])
+                arrays["node"].append(data["node"][select])
+                arrays["types"].append(
+                    np.full(select.sum(), component_ids[component])
+                )
+
+        self.neurons = self.neurons[keep].reset_index(drop=True)
+        self._segments = []
+        if arrays["coords"]:
+            self._write_segment(
+                **{key: np.concatenate(v) for key, v in arrays.items()}
+            )
+        self._save_index()
+
+    def _trees(self, components):
+        if components is None:
+            components = list(component_ids)
+        elif isinstance(components, str):
+            components = [components]
+
+        for component in components:
+            if component not in component_ids:
+                raise ValueError(
+                    f"Invalid component {component}, should be one of "
+                    f"{list(component_ids)}"
+                )
+
+        removed = self.neurons["removed"].to_numpy()
+        for _, segment in self._segments:
+            for component in components:
+                if component in segment:
+                    yield component, segment[component], removed
+
+    def _node_ranges(self, matches):
+        """
+        Group the matching nodes in ranges of consecutive nodes.
+
+        :param matches: list of (component, neuron rows, node indices)
+        :returns: pandas DataFrame with the name and file of the neuron,
+            the component and the start and stop node of each range
+        """
+        columns = ["name", "file", "component", "start", "stop"]
+        matches = [m for m in matches if len(m[1])]
+        if not matches:
+            return pd.DataFrame(columns=columns)
+
+        neuron = np.concatenate([m[1] for m in matches]).astype(np.int64)
+        node = np.concatenate([m[2] for m in matches]).astype(np.int64)
+        component = np.concatenate(
+            [np.full(len(m[1]), component_ids[m[0]]) for m in matches]
+        )
+
+        order = np.lexsort((node, neuron))
+        neuron, node, component = neuron[order], node[order], component[order]
+        starts = np.flatnonzero(
+            np.concatenate(
+                [
+                    [True],
+                    (neuron[1:] != neuron[:-1]) | (node[1:] != node[:-1] + 1),
+                ]
+            )
+        )
+        stops = np.append(starts[1:], len(node))
+
+        rows = self.neurons.iloc[neuron[starts]]
+        return pd.DataFrame(
+            dict(
+                name=rows["name"].to_numpy(),
+                file=rows["file"].to_numpy(),
+                component=[_component_names[c] for c in component[starts]],
+                start=node[starts],
+                stop=node[stops - 1] + 1,
+            )
+        )
+
+    def query_sphere(self, center, radius, components=None):
+        """
+        Find the nodes within a distance from a point.
+
+        :param center: x, y, z coordinates
+        :param radius: float, distance in the units of the .swc files
+        :param components: component name or list of names (e.g. "axon"),
+            all components are searched if None
+        :returns: pandas DataFrame with the name, file, component and
+            start and stop node of each range of matching nodes
+        """
+        matches = []
+        for component, data, removed in self._trees(components):
+            found = np.asarray(
+                data["tree"].query_ball_point(center, radius), dtype=np.int64
+            )
+            found = found[~removed[data["neuron"][found]]]
+            matches.append(
+                (component, data["neuron"][found], data["node"][found])
+            )
+        return self._node_ranges(matches)
+
+    def query_box(self, lower, upper, components=None):
+        """
+        Find the nodes inside an axis-aligned box.
+
+        :param lower: x, y, z coordinates of the box's lower corner
+        :param upper: x, y, z coordinates of the box's upper corner
+        :param components: component name or list of names (e.g. "axon"),
+            all components are searched if None
+        :returns: pandas DataFrame, see query_sphere
+        """
+        lower, upper = np.asarray(lower), np.asarray(upper)
+        center = (lower + upper) / 2
+        half_size = np.max(upper - lower) / 2
+
+        matches = []
+        for component, data, removed in self._trees(components):
+            # Search the cube enclosing the box, then crop it
+            found = np.asarray(
+                data["tree"].query_ball_point(center, half_size, p=np.inf),
+                dtype=np.int64,
+            )
+            coords = data["tree"].data[found]
+            inside = np.all((coords >= lower) & (coords <= upper), axis=1)
+            found = found[inside & ~removed[data["neuron"][found]]]
+            matches.append(
+                (component, data["neuron"][found], data["node"][found])
+            )
+        return self._node_ranges(matches)
+
+    def nearest(self, point, k=1, components=None):
+        """
+        Find the nodes nearest to a point.
+
+        :param point: x, y, z coordinates
+        :param k: int, number of nodes to return
+        :param components: component name or list of names (e.g. "axon"),
+            all components are searched if None
+        :returns: pandas DataFrame with the name, file, component, node
+            and distance of the k nearest nodes, sorted by distance
+        """
+        candidates = []
+        for component, data, removed in self._trees(components):
+            # Query more nodes until k of them belong to indexed neurons
+            n_query = min(k, len(data["neuron"]))
+            while True:
+                distances, found = data["tree"].query(point, k=n_query)
+                distances = np.atleast_1d(distances)
+                found = np.atleast_1d(found)
+                valid = ~removed[data["neuron"][found]]
+                if valid.sum() >= k or n_query == len(data["neuron"]):
+                    break
+                n_query = min(2 * n_query, len(data["neuron"]))
+
+            found, distances = found[valid][:k], distances[valid][:k]
+            rows = self.neurons.iloc[data["neuron"][found]]
+            candidates.append(
+                pd.DataFrame(
+                    dict(
+                        name=rows["name"].to_numpy(),
+                        file=rows["file"].to_numpy(),
+                        component=component,
+                        node=data["node"][found],
+                        distance=distances,
+                    )
+                )
+            )
+
+        if not candidates:
+            return pd.DataFrame(
+                columns=["name", "file", "component", "node", "distance"]
+            )
+        return (
+            pd.concat(candidates, ignore_index=True)
+            .sort_values("distance", kind="stable")
+            .head(k)
+            .reset_index(drop=True)
+        )
@@ -0,0 +1,298 @@
+"""
+Pack the morphologies of many neurons into a single memory-mappable file.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from morphapi.morphology.compact import CompactMorphology, load_swc
+from morphapi.morphology.morphology import Neuron
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MORPHAPI-STORE\x00\x00"
+ALIGNMENT = 64
+
+# Arrays of all neurons, concatenated
+_store_arrays = dict(
+    nodes=(np.float32, (4,)),
+    parents=(np.int32, ()),
+    types=(np.int8, ()),
+    section_offsets=(np.int32, ()),
+    section_types=(np.int8, ()),
+    section_parents=(np.int32, ()),
+)
+
+
+def _load_compact(swc_path):
+    # Use the binary cache of the file if available
+    try:
+        return load_swc(swc_path), None
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
+
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+class MorphologyStore:
+    """
+    Read-only collection of morphologies stored in a single file.
+
+    All nodes are stored in one (N, 4) float32 array (plus parents and
+    types arrays) and all sections in CSR arrays, memory-mapped when the
+    store is opened. An offset table gives the range of each neuron in
+    these arrays, so that reading a neuron is O(1) and doesn't load the
+    others: the arrays of the CompactMorphology returned are views of
+    the memory-mapped file.
+
+    Use MorphologyStore.build to create a store from folders of .swc
+    files, e.g. the cache folders of morphapi.paths_manager.Paths.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+
+        with open(self.file_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_path} is not a morphology store")
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size).decode("utf-8"))
+
+        data_start = _aligned(len(MAGIC) + 8 + header_size)
+        self._arrays = {
+            name: self._memmap(
+                spec["dtype"], spec["shape"], data_start + spec["offset"]
+            )
+            for name, spec in header["arrays"].items()
+        }
+        self.names = header["names"]
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.metadata = pd.DataFrame(header["metadata"], index=self.names)
+
+    def _memmap(self, dtype, shape, offset):
+        shape = tuple(shape)
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(
+            self.file_path, dtype=dtype, mode="r", offset=offset, shape=shape
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __repr__(self):
+        return f"MorphologyStore({str(self.file_path)!r}, {len(self)} neurons)"
+
+    def __getitem__(self, name):
+        """
+        Get the morphology of a neuron by name (or integer position).
+
+        :returns: CompactMorphology whose arrays are views of the file
+        """
+        i = name if isinstance(name, (int, np.integer)) else self._index[name]
+        arrays = self._arrays
+        node_start, node_end = arrays["node_table"][i : i + 2]
+        section_start, section_end = arrays["section_table"][i : i + 2]
+
+        return CompactMorphology(
+            nodes=arrays["nodes"][node_start:node_end],
+            parents=arrays["parents"][node_start:node_end],
+            types=arrays["types"][node_start:node_end],
+            # Each neuron has one more section offset than sections
+            section_offsets=arrays["section_offsets"][
+                section_start + i : section_end + i + 1
+            ],
+            section_types=arrays["section_types"][section_start:section_end],
+            section_parents=arrays["section_parents"][
+                section_start:section_end
+            ],
+            name=self.names[i],
+        )
+
+    def get_neuron(self, name, **kwargs):
+        """
+        Create a Neuron from the store, without reading its .swc file.
+
+        :param name: str, name of the neuron
+        :param kwargs: keyword arguments passed to Neuron
+        :returns: Neuron
+        """
+        kwargs.setdefault("neuron_name", name)
+        return Neuron.from_compact(
+            self[name], self.metadata.loc[name, "file"], **kwargs
+        )
+
+    @classmethod
+    def build(cls, file_path, sources, metadata=None, workers=1):
+        """
+        Create a store from .swc files.
+
+        :param file_path: path of the store file to create
+        :param sources: list of folders (e.g. Paths().mouselight_cache)
+            and/or paths to .swc files
+        :param metadata: optional pandas DataFrame indexed by neuron name
+            with additional metadata columns
+        :param workers: int, number of processes used to parse the files
+        :returns: MorphologyStore
+        """
+        if isinstance(sources, (str, Path)):
+            sources = [sources]
+
+        files = []
+        for source in map(Path, sources):
+            if source.is_dir():
+                files.extend(sorted(source.glob("*.swc")))
+            else:
+                files.append(source)
+
+        names = [f.stem for f in files]
+        if len(set(names)) != len(names):
+            raise ValueError(
+                "Neuron names (the .swc file names) must be unique in a "
+                "morphology store"
+            )
+
+        file_path = Path(file_path)
+        with tempfile.TemporaryDirectory(dir=file_path.parent) as tmpdir:
+            # Write each array to its own temporary file, one neuron at
+            # a time, so that memory usage doesn't grow with the dataset
+            buffers = {
+                name: open(Path(tmpdir) / name, "wb") for name in _store_arrays
+            }
+            node_table, section_table = [0], [0]
+            columns = {
+                column: []
+                for column in (
+                    "file",
+                    "n_nodes",
+                    "n_sections",
+                    "soma_x",
+                    "soma_y",
+                    "soma_z",
+                )
+            }
+            stored_names = []
+
+            if workers == 1:
+                parsed = map(_load_compact, files)
+                executor = None
+            else:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                parsed = executor.map(_load_compact, files, chunksize=16)
+
+            try:
+                for swc_path, name, (compact, error) in zip(
+                    files, names, parsed
+                ):
+                    if compact is None:
+                        logger.error("Could not parse %s: %s", swc_path, error)
+                        continue
+
+                    for array, (dtype, _) in _store_arrays.items():
+                        buffers[array].write(
+                            np.ascontiguousarray(
+                                getattr(compact, array), dtype=dtype
+                            ).tobytes()
+                        )
+
+                    stored_names.append(name)
+                    node_table.append(node_table[-1] + compact.n_nodes)
+                    section_table.append(
+                        section_table[-1] + compact.n_sections
+                    )
+                    soma = compact.soma
+                    if soma is None:
+                        soma = np.full(3, np.nan)
+                    columns["file"].append(str(swc_path))
+                    columns["n_nodes"].append(compact.n_nodes)
+                    columns["n_sections"].append(compact.n_sections)
+                    for axis, value in zip("xyz", soma[:3]):
+                        columns[f"soma_{axis}"].append(float(value))
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+                for buffer in buffers.values():
+                    buffer.close()
+
+            # Offset tables
+            for name, table in (
+                ("node_table", node_table),
+                ("section_table", section_table),
+            ):
+                np.asarray(table, dtype=np.int64).tofile(Path(tmpdir) / name)
+
+            if metadata is not None:
+                metadata = metadata.reindex(stored_names)
+                for column in metadata.columns:
+                    columns[column] = [
+                        None if pd.isna(v) else v
+                        for v in metadata[column].tolist()
+                    ]
+
+            cls._write(
+                file_path,
+                Path(tmpdir),
+                n_nodes=node_table[-1],
+                n_sections=section_table[-1],
+                names=stored_names,
+                metadata=columns,
+            )
+
+        return cls(file_path)
+
+    @staticmethod
+    def _write(file_path, tmpdir, n_nodes, n_sections, names, metadata):
+        n_neurons = len(names)
+        shapes = dict(
+            nodes=(n_nodes, 4),
+            parents=(n_nodes,),
+            types=(n_nodes,),
+            section_offsets=(n_sections + n_neurons,),
+            section_types=(n_sections,),
+            section_parents=(n_sections,),
+            node_table=(n_neurons + 1,),
+            section_table=(n_neurons + 1,),
+        )
+        dtypes = {name: dtype for name, (dtype, _) in _store_arrays.items()}
+        dtypes.update(node_table=np.int64, section_table=np.int64)
+
+        # Offsets of the arrays are relative to the end of the header
+        arrays, position = {}, 0
+        for name, shape in shapes.items():
+            dtype = np.dtype(dtypes[name])
+            arrays[name] = dict(dtype=dtype.str, shape=shape, offset=position)
+            position = _aligned(
+                position + int(np.prod(shape)) * dtype.itemsize
+            )
+
+        header = json.dumps(
+            dict(version=1, arrays=arrays, names=names, metadata=metadata)
+        ).encode("utf-8")
+        data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+        tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name, spec in arrays.items():
+                f.write(b"\0" * (data_start + spec["offset"] - f.tell()))
+                with open(tmpdir / name, "rb") as array_file:
+                    shutil.copyfileobj(array_file, f)
+        os.replace(tmp_path, file_path)
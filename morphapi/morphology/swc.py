@@ -0,0 +1,186 @@
+"""
+Read SWC files straight into NumPy arrays and split them into sections
+(unbranched runs of nodes) with vectorized code, without building a
+morphio or NeuroM morphology.
+
+The sections follow morphio's conventions: a new section starts at each
+node whose parent is the soma, a branching point or a node of a different
+type, and each section that doesn't start from the soma begins with a
+copy of its parent node.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+SOMA_TYPE = 1
+
+# Nodes of a SWC file: types (N,), points (N, 4) with x, y, z, radius and
+# parents (N,), the index of each node's parent (or -1)
+swc_nodes = namedtuple("swc_nodes", "types points parents")
+
+# Sections of a SWC file: nodes (M,) index of each section point into the
+# nodes arrays, offsets (S + 1,) of each section into nodes, types (S,)
+# and parents (S,), the index of each section's parent (or -1)
+swc_sections = namedtuple("swc_sections", "nodes offsets types parents")
+
+# SWC structure identifier of each component of a neuron
+component_ids = dict(
+    soma=SOMA_TYPE, basal_dendrites=3, apical_dendrites=4, axon=2
+)
+
+
+def read_swc(file_path):
+    """
+    Read the nodes of a SWC file.
+
+    :param file_path: path to a .swc file
+    :returns: swc_nodes
+    """
+    data = np.loadtxt(file_path, comments="#", usecols=range(7), ndmin=2)
+
+    ids = data[:, 0].astype(np.int64)
+    parent_ids = data[:, 6].astype(np.int64)
+
+    # Map node IDs to row indices
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    if np.any(sorted_ids[1:] == sorted_ids[:-1]):
+        raise ValueError(f"Duplicated node IDs in {file_path}")
+
+    has_parent = parent_ids >= 0
+    position = np.searchsorted(sorted_ids, parent_ids[has_parent])
+    position = np.minimum(position, len(ids) - 1)
+    if np.any(sorted_ids[position] != parent_ids[has_parent]):
+        raise ValueError(f"Some parent IDs are missing in {file_path}")
+
+    parents = np.full(len(ids), -1, dtype=np.int64)
+    parents[has_parent] = order[position]
+
+    return swc_nodes(
+        types=data[:, 1].astype(np.int16),
+        points=np.ascontiguousarray(data[:, 2:6]),
+        parents=parents,
+    )
+
+
+def read_soma(file_path):
+    """
+    Read the first soma node of a SWC file, without parsing the rest of
+    the file when the soma comes first (as it usually does).
+
+    :param file_path: path to a .swc file
+    :returns: (4,) array with x, y, z and radius, or None without soma
+    """
+    with open(file_path) as f:
+        for line in f:
+            values = line.split("#", 1)[0].split()
+            if len(values) >= 7 and int(float(values[1])) == SOMA_TYPE:
+                return np.array(values[2:6], dtype=float)
+    return None
+
+
+def _pointer_jump(links, weights):
+    """
+    Follow links until reaching nodes that link to themselves, summing
+    weights along the way. Runs in O(log(depth)) vectorized steps.
+
+    :returns: tuple with the final node reached from each node and the
+        sum of weights along the path
+    """
+    links = links.copy()
+    distance = weights.copy()
+    # Each step doubles the length of the paths followed, so 64 steps are
+    # enough for any tree that fits in memory
+    for _ in range(64):
+        next_links = links[links]
+        if np.array_equal(next_links, links):
+            return links, distance
+        distance += distance[links]
+        links = next_links
+    raise ValueError("The nodes parents contain a loop")
+
+
+def build_sections(nodes):
+    """
+    Split the neurite nodes of a SWC file into sections.
+
+    :param nodes: swc_nodes, as returned by read_swc
+    :returns: swc_sections
+    """
+    types, parents = nodes.types, nodes.parents
+    n_nodes = len(types)
+    index = np.arange(n_nodes)
+
+    neurite = types != SOMA_TYPE
+    has_parent = parents >= 0
+    parent = np.where(has_parent, parents, index)
+
+    # A node starts a section if its parent is the soma (or missing), has
+    # other children or is of a different type
+    n_children = np.bincount(parents[has_parent & neurite], minlength=n_nodes)
+    from_soma = ~has_parent | ~neurite[parent]
+    head = neurite & (
+        from_soma | (n_children[parent] > 1) | (types[parent] != types)
+    )
+
+    # Find the first node of each node's section and its position in it
+    first, position = _pointer_jump(
+        np.where(head | ~neurite, index, parent),
+        (~head & neurite).astype(np.int64),
+    )
+
+    # Sections are numbered in the order of their first node in the file
+    heads = np.flatnonzero(head)
+    section_of = np.full(n_nodes, -1, dtype=np.int64)
+    section_of[heads] = np.arange(len(heads))
+    section_of[neurite] = section_of[first[neurite]]
+
+    # Sections not starting from the soma begin with their parent node
+    starts_with_parent = ~from_soma[heads]
+    lengths = np.bincount(section_of[neurite], minlength=len(heads))
+    lengths += starts_with_parent
+
+    offsets = np.zeros(len(heads) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    section_nodes = np.empty(offsets[-1], dtype=np.int64)
+    neurite_nodes = np.flatnonzero(neurite)
+    sections = section_of[neurite_nodes]
+    section_nodes[
+        offsets[sections]
+        + starts_with_parent[sections]
+        + position[neurite_nodes]
+    ] = neurite_nodes
+    section_nodes[offsets[:-1][starts_with_parent]] = parent[
+        heads[starts_with_parent]
+    ]
+
+    section_parents = np.where(
+        starts_with_parent, section_of[parent[heads]], -1
+    )
+
+    return swc_sections(
+        nodes=section_nodes,
+        offsets=offsets,
+        types=types[heads],
+        parents=section_parents,
+    )
+
+
+def section_roots(section_parents):
+    """
+    Get the root section of the neurite each section belongs to.
+
+    :param section_parents: (S,) array with the parent of each section
+        (-1 for root sections)
+    :returns: (S,) array of section indices
+    """
+    section_parents = np.asarray(section_parents, dtype=np.int64)
+    index = np.arange(len(section_parents))
+    is_root = section_parents < 0
+    roots, _ = _pointer_jump(
+        np.where(is_root, index, section_parents),
+        np.zeros(len(index), dtype=np.int64),
+    )
+    return roots
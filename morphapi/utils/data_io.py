@@ -74,8 +74,11 @@ def connected_to_internet(url="https://www.google.com/", timeout=5):
     :param timeout:  timeout to wait for [in seconds] (Default value = 5)
     """
 
+    # Imported here as webqueries imports this module
+    from morphapi.utils.webqueries import session_manager
+
     try:
-        _ = requests.get(url, timeout=timeout)
+        _ = session_manager.get(url, timeout=timeout)
         return True
     except requests.ConnectionError:
         print("No internet connection available.")
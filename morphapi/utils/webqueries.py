@@ -1,8 +1,19 @@
+import os
 import ssl
+import threading
 import time
+from pathlib import Path
 
 import requests
 from requests.adapters import HTTPAdapter
+from rich.progress import (
+    BarColumn,
+    DownloadColumn,
+    Progress,
+    TextColumn,
+    TimeRemainingColumn,
+    TransferSpeedColumn,
+)
 from urllib3.util.ssl_ import create_urllib3_context
 
 from morphapi.utils.data_io import connected_to_internet
@@ -10,6 +21,13 @@ from morphapi.utils.data_io import connected_to_internet
 mouselight_base_url = "https://ml-neuronbrowser.janelia.org/"
 CIPHERS = ":HIGH:!DH:!aNULL"
 
+# Seconds to wait to connect to a server and between bytes of a response
+default_timeout = (10, 60)
+
+# Servers whose Diffie-Hellman parameters are rejected by OpenSSL, which
+# are sent requests with DH ciphers disabled (see NoDhAdapter)
+no_dh_urls = ("https://neuromorpho.org/",)
+
 
 class NoDhAdapter(HTTPAdapter):
     """A TransportAdapter that disables DH cipher in Requests."""
@@ -22,6 +40,140 @@ class NoDhAdapter(HTTPAdapter):
         return super(NoDhAdapter, self).init_poolmanager(*args, **kwargs)
 
 
+class SessionManager:
+    """
+    Thread-safe provider of the HTTP sessions of all the APIs, so that
+    connections to each server are kept alive and reused instead of doing
+    a TCP and TLS handshake for every request.
+
+    requests.Session is not thread-safe, so each thread gets its own
+    session. The sessions of a process share the same adapters, whose
+    connection pools (one per host) are thread-safe. Requests to the
+    servers in no_dh_urls go through a NoDhAdapter.
+    """
+
+    def __init__(
+        self, pool_connections=10, pool_maxsize=10, timeout=default_timeout
+    ):
+        """
+        :param pool_connections: int, number of hosts whose connections
+            are kept alive
+        :param pool_maxsize: int, maximum number of connections kept alive
+            to each host, i.e. of threads sending requests to the same
+            host concurrently without opening new connections
+        :param timeout: float or (connect, read) tuple, default timeout
+            of requests in seconds
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._adapters = None
+        self._pid = None
+        self._generation = 0
+
+    def _get_adapters(self):
+        with self._lock:
+            # Connections can't be shared with forked processes
+            if self._adapters is None or self._pid != os.getpid():
+                pool_kwargs = dict(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                self._adapters = {
+                    "https://": HTTPAdapter(**pool_kwargs),
+                    "http://": HTTPAdapter(**pool_kwargs),
+                }
+                for url in no_dh_urls:
+                    self._adapters[url] = NoDhAdapter(**pool_kwargs)
+                self._pid = os.getpid()
+                self._generation += 1
+            return self._adapters, self._generation
+
+    @property
+    def session(self):
+        """
+        requests.Session of the current thread.
+        """
+        adapters, generation = self._get_adapters()
+        session = getattr(self._local, "session", None)
+        if session is None or self._local.generation != generation:
+            session = requests.Session()
+            for prefix, adapter in adapters.items():
+                session.mount(prefix, adapter)
+            self._local.session = session
+            self._local.generation = generation
+        return session
+
+    def configure(
+        self, pool_connections=None, pool_maxsize=None, timeout=None
+    ):
+        """
+        Change the size of the connection pools and/or the default
+        timeout. New pools are used by the requests sent afterwards.
+
+        :param pool_connections: int, number of hosts whose connections
+            are kept alive
+        :param pool_maxsize: int, maximum number of connections kept alive
+            to each host
+        :param timeout: float or (connect, read) tuple, default timeout
+            of requests in seconds
+        """
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if timeout is not None:
+                self.timeout = timeout
+            self._close_adapters()
+
+    def close(self):
+        """
+        Close all the connections kept alive.
+        """
+        with self._lock:
+            self._close_adapters()
+
+    def _close_adapters(self):
+        # Connections in use by other threads are closed when they're
+        # released. Connections inherited from a parent process are left
+        # to it.
+        if self._adapters is not None and self._pid == os.getpid():
+            for adapter in self._adapters.values():
+                adapter.close()
+        self._adapters = None
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request with the session of the current thread.
+
+        :param method: str, HTTP method
+        :param url: str, url
+        :param kwargs: keyword arguments of requests.Session.request, the
+            timeout defaults to the one of the manager
+        :returns: requests.Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request, see request.
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Send a POST request, see request.
+        """
+        return self.request("POST", url, **kwargs)
+
+
+session_manager = SessionManager()
+
+
 def request(url, verify=True):
     """
     Sends a request to a url
@@ -34,9 +186,7 @@ def request(url, verify=True):
             "You need to have an internet connection to send requests."
         )
 
-    session = requests.Session()
-    session.mount("https://", NoDhAdapter())
-    response = session.get(url, verify=verify)
+    response = session_manager.get(url, verify=verify)
 
     if response.ok:
         return response
@@ -60,7 +210,7 @@ def query_mouselight(query):
     full_query = mouselight_base_url + query
 
     # send the query, package the return argument as a json tree
-    response = requests.get(full_query)
+    response = session_manager.get(full_query)
     if response.ok:
         json_tree = response.json()
         if json_tree["success"]:
@@ -99,10 +249,10 @@ def post_mouselight(url, query=None, clean=False, attempts=3):
             try:
                 if not clean:
                     time.sleep(0.01)  # avoid getting an error from server
-                    request = requests.post(url, json={"query": query})
+                    request = session_manager.post(url, json={"query": query})
                 else:
                     time.sleep(0.01)  # avoid getting an error from server
-                    request = requests.post(url, json=query)
+                    request = session_manager.post(url, json=query)
             except Exception as e:
                 exception = e
                 request = None
@@ -136,3 +286,38 @@ def post_mouselight(url, query=None, clean=False, attempts=3):
                 request.status_code, query, request.text
             )
         )
+
+
+def download_file(url, file_path):
+    """
+    Download a file with a progress bar. The file is written only if the
+    download completes.
+
+    :param url: str, url
+    :param file_path: path to save the file to
+    """
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}")
+    progress = Progress(
+        TextColumn("[bold]Downloading...", justify="right"),
+        BarColumn(bar_width=None),
+        "{task.percentage:>3.1f}%",
+        "•",
+        DownloadColumn(),
+        "• speed:",
+        TransferSpeedColumn(),
+        "• ETA:",
+        TimeRemainingColumn(),
+    )
+    try:
+        with session_manager.get(url, stream=True) as response:
+            response.raise_for_status()
+            total = int(response.headers.get("content-length", 0)) or None
+            with progress, open(tmp_path, "wb") as fout:
+                task_id = progress.add_task("download", total=total)
+                for chunk in response.iter_content(chunk_size=2**16):
+                    fout.write(chunk)
+                    progress.advance(task_id, len(chunk))
+        os.replace(tmp_path, file_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
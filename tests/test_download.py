@@ -1,4 +1,6 @@
 import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import numpy as np
@@ -7,6 +9,7 @@ import pytest
 from morphapi.api.allenmorphology import AllenMorphology
 from morphapi.api.mouselight import MouseLightAPI
 from morphapi.api.neuromorphorg import NeuroMorpOrgAPI
+from morphapi.utils.webqueries import NoDhAdapter, SessionManager
 
 
 def test_neuromorpho_download(tmpdir):
@@ -165,3 +168,69 @@ def test_allen_morphology_download(tmpdir):
 
     assert neurons[0].data_file.name == f"{np.iinfo(np.int64).min}.swc"
     assert neurons[0].points is None
+
+
+def test_session_manager():
+    clients = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            clients.append(self.client_address)
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    manager = SessionManager(pool_maxsize=2)
+    try:
+        # Connections are kept alive between requests
+        for _ in range(5):
+            assert manager.get(url).text == "ok"
+        assert len(set(clients)) == 1
+
+        # Each thread has its own session, sharing the connection pools
+        sessions = []
+
+        def send():
+            sessions.append(manager.session)
+            manager.get(url)
+
+        threads = [threading.Thread(target=send) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sessions[0] is not sessions[1]
+        assert sessions[0].adapters["http://"] is (
+            sessions[1].adapters["http://"]
+        )
+        assert len(set(clients)) <= 2
+
+        # Reconfiguring closes the previous connections
+        pools = sessions[0].adapters["http://"].poolmanager.pools
+        assert len(pools)
+        manager.configure(timeout=5)
+        assert len(pools) == 0
+        assert manager.session is not sessions[0]
+        assert manager.timeout == 5
+
+        # DH ciphers are only disabled for the servers that need it
+        session = manager.session
+        assert isinstance(
+            session.get_adapter("https://neuromorpho.org/api"), NoDhAdapter
+        )
+        assert not isinstance(
+            session.get_adapter("https://api.brain-map.org/api"), NoDhAdapter
+        )
+    finally:
+        manager.close()
+        server.shutdown()
+        server.server_close()
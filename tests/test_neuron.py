@@ -1,12 +1,49 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
 from random import choice
+from types import SimpleNamespace
 
+import neurom as nm
 import numpy as np
 import pytest
-from vedo import Mesh
+from vedo import Mesh, write
 
+from morphapi.cli import main
+from morphapi.morphology import (
+    DensityGrid,
+    MorphologyStore,
+    SomaIndex,
+    SpatialIndex,
+    cache_parsed_swcs,
+    create_meshes,
+    load_neurons,
+    merge_population,
+    population_morphometrics,
+    projection_matrix,
+    rasterize,
+    warm_cache,
+)
+from morphapi.morphology.cache import MeshMemoryCache
+from morphapi.morphology.compact import CompactMorphology, load_parsed_swc
+from morphapi.morphology.mesh_file import (
+    read_mesh_arrays,
+    read_mesh_header,
+    write_mesh_file,
+)
+from morphapi.morphology.meshing import (
+    select_sections,
+    simplify_sections,
+    tube_mesh,
+)
 from morphapi.morphology.morphology import Neuron
-from morphapi.utils.data_io import listdir
+from morphapi.morphology.swc import component_ids
+from morphapi.utils.data_io import listdir, save_yaml
 
 
 @pytest.fixture
@@ -75,3 +112,787 @@ def test_empty_neuron(caplog):
     caplog.clear()
     neuron.create_mesh()
     assert caplog.messages == []
+
+
+def test_tube_mesh_single_pass():
+    points = np.random.rand(10, 3)
+    offsets = np.array([0, 4, 10])
+
+    selected, new_offsets = select_sections(
+        points, offsets, np.array([False, True])
+    )
+    np.testing.assert_array_equal(selected, points[4:])
+    np.testing.assert_array_equal(new_offsets, [0, 6])
+
+    mesh = tube_mesh(points, offsets, radius=1, res=8)
+    assert isinstance(mesh, Mesh)
+    # One ring of `res` points per node, plus caps
+    assert mesh.npoints >= len(points) * 8
+    assert tube_mesh(points[:0], offsets[:1], radius=1) is None
+
+
+def test_create_meshes(tmpdir):
+    files = sorted(listdir("tests/data"))[:2]
+    neurons = [Neuron(files[0], base_dir=tmpdir), files[1], "missing.swc"]
+
+    meshes = create_meshes(neurons, workers=2, neurite_radius=3)
+
+    assert len(meshes) == 3
+    assert meshes[2] is None
+    for components, whole in meshes[:2]:
+        assert isinstance(whole, Mesh)
+        assert whole.npoints > 0
+        for ntp in Neuron._neurite_types:
+            assert ntp in components
+
+    # The worker wrote the mesh to the neuron's cache
+    assert neurons[0]._check_neuron_mesh_cached(
+        neurons[0].neuron_name, neurons[0]._mesh_params(neurite_radius=3)
+    )
+
+
+def test_create_mesh_lines(tmpdir):
+    neuron = Neuron(sorted(listdir("tests/data"))[0], base_dir=tmpdir)
+
+    for use_cache in (True, True, False):
+        components, whole = neuron.create_mesh(
+            mode="lines", use_cache=use_cache
+        )
+        assert components["axon"].dataset.GetNumberOfLines() > 0
+        assert components["axon"].dataset.GetNumberOfPolys() == 0
+        assert isinstance(whole, Mesh)
+
+    # Lines are cached next to, not instead of, the tubes
+    neuron.create_mesh()
+    name = neuron.neuron_name
+    assert neuron._check_neuron_mesh_cached(name, neuron._mesh_params())
+    assert neuron._check_neuron_mesh_cached(
+        name, neuron._mesh_params(mode="lines")
+    )
+
+    with pytest.raises(ValueError):
+        neuron.create_mesh(mode="points")
+
+
+def test_create_mesh_lod(tmpdir):
+    neuron = Neuron(sorted(listdir("tests/data"))[1], base_dir=tmpdir)
+
+    _, full = neuron.create_mesh()
+    for lod, budget in enumerate(neuron.lod_triangle_budgets, start=1):
+        components, whole = neuron.create_mesh(lod=lod)
+        assert whole.ncells <= min(budget * 1.01, full.ncells)
+        assert neuron._check_neuron_mesh_cached(
+            neuron.neuron_name, neuron._mesh_params(lod=lod)
+        )
+
+    # Cached levels are returned as they were written
+    _, cached = neuron.create_mesh(lod=1)
+    assert cached.ncells == neuron.create_mesh(lod=1)[1].ncells
+
+    with pytest.raises(ValueError):
+        neuron.create_mesh(lod=len(neuron.lod_triangle_budgets) + 1)
+    with pytest.raises(ValueError):
+        neuron.create_mesh(lod=1, mode="lines")
+
+
+def test_simplify_sections():
+    # A straight section with a single kink, followed by a 2 points section
+    points = np.array(
+        [[0, 0, 0], [1, 0.01, 0], [2, 0, 0], [3, 5, 0], [4, 0, 0], [5, 0, 0]]
+        + [[5, 0, 0], [6, 0, 0]],
+        dtype=float,
+    )
+    offsets = np.array([0, 6, 8])
+
+    simplified, new_offsets = simplify_sections(points, offsets, 0.1)
+    np.testing.assert_array_equal(new_offsets, [0, 5, 7])
+    np.testing.assert_array_equal(
+        simplified[[0, 4, 5, 6]], points[[0, 5, 6, 7]]
+    )
+
+    # Endpoints are kept even with a huge tolerance
+    simplified, new_offsets = simplify_sections(points, offsets, 100)
+    np.testing.assert_array_equal(simplified, points[[0, 5, 6, 7]])
+    np.testing.assert_array_equal(new_offsets, [0, 2, 4])
+
+
+def test_create_mesh_simplified(tmpdir):
+    neuron = Neuron(sorted(listdir("tests/data"))[1], base_dir=tmpdir)
+
+    _, full = neuron.create_mesh(use_cache=False)
+    _, simplified = neuron.create_mesh(simplify_tolerance=2)
+    assert simplified.ncells < full.ncells
+
+    with pytest.raises(ValueError):
+        neuron.create_mesh(simplify_tolerance=-1)
+
+
+def test_merge_population(tmpdir, monkeypatch):
+    files = sorted(listdir("tests/data"))[:2]
+    first = Neuron(files[0], base_dir=tmpdir)
+    components, _ = meshes = first.create_mesh()
+
+    population = merge_population(
+        [meshes, files[1], "missing.swc"], color_by="component"
+    )
+    n_cells = sum(m.ncells for m in components.values() if m is not None)
+
+    neuron_ids = population.celldata["neuron_id"]
+    assert set(np.unique(neuron_ids)) == {0, 1}
+    assert (neuron_ids == 0).sum() == n_cells
+    assert set(np.unique(population.celldata["component"])) <= set(
+        component_ids.values()
+    )
+
+    population = merge_population([first], color_by=[1.5], mode="lines")
+    assert population.dataset.GetNumberOfLines() > 0
+    np.testing.assert_array_equal(population.celldata["neuron_value"], 1.5)
+
+    with pytest.raises(ValueError):
+        merge_population([meshes], color_by=[1, 2])
+
+    # color_by is checked before meshing the neurons
+    def fail(*args, **kwargs):
+        raise AssertionError("Neurons were meshed")
+
+    monkeypatch.setattr("morphapi.morphology.population.create_meshes", fail)
+    for color_by in ("soma", [1, 2]):
+        with pytest.raises(ValueError):
+            merge_population(files[:1], color_by=color_by)
+
+
+@pytest.mark.parametrize("file", sorted(listdir("tests/data")))
+def test_fast_swc_reader(file):
+    fast = Neuron(file)
+    slow = Neuron(file, load_file=False)
+    slow.load_from_file(fast=False)
+
+    # The NeuroM morphology is only built when needed
+    assert fast._morphology is None
+    assert slow._morphology is not None
+
+    # Same sections as morphio
+    for ntype in Neuron._neurite_types:
+        fast_points, fast_offsets = fast.sections[ntype]
+        slow_points, slow_offsets = slow.sections[ntype]
+        np.testing.assert_array_equal(fast_offsets, slow_offsets)
+        np.testing.assert_allclose(fast_points, slow_points, atol=1e-3)
+        assert len(fast.points[ntype]) == len(slow.points[ntype])
+
+    np.testing.assert_allclose(
+        fast.points["soma"].coords, slow.points["soma"].coords, atol=1e-3
+    )
+
+    assert len(fast.morphology.neurites) == len(slow.morphology.neurites)
+
+
+def test_compact_morphology():
+    file = sorted(listdir("tests/data"))[0]
+    neuron = Neuron(file)
+    compact = CompactMorphology.from_swc(file, name="test")
+
+    assert not hasattr(compact, "__dict__")
+    assert compact.nodes.dtype == np.float32
+    assert compact.soma is not None
+    # 21 bytes per node (16 for the coordinates and radius) and 9 bytes
+    # per section
+    assert compact.nbytes == 21 * compact.n_nodes + 9 * compact.n_sections + 4
+
+    # Each node's parent comes before it, except for the root
+    assert compact.parents[0] == -1
+    assert np.all(compact.parents[1:] < np.arange(1, compact.n_nodes))
+
+    for ntype, nclass in Neuron._neurite_types.items():
+        points, offsets = compact.neurite_sections(nclass.value)
+        np.testing.assert_array_equal(points, neuron.sections[ntype][0])
+        np.testing.assert_array_equal(offsets, neuron.sections[ntype][1])
+
+
+def test_parsed_swc_cache(tmpdir):
+    for file in listdir("tests/data"):
+        shutil.copy(file, tmpdir)
+    swc_path = Path(tmpdir) / "example1.swc"
+
+    assert load_parsed_swc(swc_path) is None
+    assert cache_parsed_swcs(tmpdir, workers=2) == 3
+    assert cache_parsed_swcs(tmpdir, workers=1) == 0
+
+    cached = load_parsed_swc(swc_path)
+    parsed = CompactMorphology.from_swc(swc_path)
+    for attr in ("nodes", "parents", "types", "section_offsets"):
+        np.testing.assert_array_equal(
+            getattr(cached, attr), getattr(parsed, attr)
+        )
+
+    # The cache is used to load neurons
+    neuron = Neuron(swc_path)
+    np.testing.assert_array_equal(neuron.compact.nodes, parsed.nodes)
+
+    # And ignored once the file changes
+    os.utime(swc_path, ns=(0, 0))
+    assert load_parsed_swc(swc_path) is None
+
+
+def test_morphology_store(tmpdir):
+    files = sorted(listdir("tests/data"))
+    store_path = Path(tmpdir) / "neurons.store"
+    store = MorphologyStore.build(store_path, "tests/data")
+
+    assert len(store) == len(files)
+    assert list(store.metadata["n_nodes"] > 0) == [True] * len(files)
+
+    for file in files:
+        name = Path(file).stem
+        parsed = CompactMorphology.from_swc(file)
+        stored = store[name]
+        for attr in ("nodes", "parents", "types", "section_offsets"):
+            np.testing.assert_array_equal(
+                getattr(stored, attr), getattr(parsed, attr)
+            )
+        # The arrays are views of the memory-mapped file
+        assert isinstance(stored.nodes.base, np.memmap)
+
+        neuron = store.get_neuron(name)
+        assert neuron.neuron_name == name
+        # Nothing is copied out of the store until it's needed
+        assert neuron._points is None and neuron._sections is None
+        assert isinstance(neuron.compact.nodes.base, np.memmap)
+        assert len(neuron.points["axon"]) > 0
+        for ntype, (points, offsets) in Neuron(file).sections.items():
+            np.testing.assert_array_equal(neuron.sections[ntype][1], offsets)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_load_neurons(workers, monkeypatch):
+    files = sorted(listdir("tests/data"))
+    neurons = load_neurons(files + ["tests/data/missing.swc"], workers=workers)
+
+    assert neurons[-1] is None
+    for file, neuron in zip(files, neurons):
+        assert neuron.neuron_name == Path(file).name
+        expected = Neuron(file)
+        np.testing.assert_array_equal(
+            neuron.compact.nodes, expected.compact.nodes
+        )
+        for ntype, (points, offsets) in expected.sections.items():
+            np.testing.assert_array_equal(neuron.sections[ntype][0], points)
+
+    # Names and options of Neuron instances are kept
+    unloaded = Neuron(files[0], neuron_name="test", load_file=False)
+    (neuron,) = load_neurons([unloaded], workers=workers, lazy=True)
+    assert neuron.neuron_name == "test"
+
+    # Files rejected by the fast reader are loaded with NeuroM
+    def reject(swc_path, name=None):
+        raise ValueError(f"Duplicated node IDs in {swc_path}")
+
+    monkeypatch.setattr("morphapi.morphology.batch.load_swc", reject)
+    for file, neuron in zip(files, load_neurons(files, workers=workers)):
+        np.testing.assert_array_equal(
+            neuron.compact.nodes, Neuron(file).compact.nodes
+        )
+
+
+def test_population_morphometrics():
+    neurons = [Neuron(fp) for fp in sorted(listdir("tests/data"))]
+    metrics = population_morphometrics(neurons)
+
+    assert list(metrics.index) == [n.neuron_name for n in neurons]
+    for neuron in neurons:
+        row = metrics.loc[neuron.neuron_name]
+        for ntype, nclass in Neuron._neurite_types.items():
+            expected = dict(
+                length=nm.get(
+                    "total_length", neuron.morphology, neurite_type=nclass
+                ),
+                n_terminals=nm.get(
+                    "number_of_leaves", neuron.morphology, neurite_type=nclass
+                ),
+                n_branch_points=nm.get(
+                    "number_of_forking_points",
+                    neuron.morphology,
+                    neurite_type=nclass,
+                ),
+            )
+            for metric, value in expected.items():
+                assert row[f"{ntype}_{metric}"] == pytest.approx(
+                    value, rel=1e-5
+                )
+
+
+def test_spatial_index(tmpdir):
+    folder = Path(tmpdir) / "neurons"
+    folder.mkdir()
+    for file in listdir("tests/data"):
+        shutil.copy(file, folder)
+
+    index = SpatialIndex(Path(tmpdir) / "index")
+    assert index.update(folder) == 3
+    assert index.update(folder) == 0
+
+    compact = CompactMorphology.from_swc(folder / "example1.swc")
+    axon = compact.nodes[compact.types == 2, :3]
+    center, radius = axon[100], 200
+
+    # Sphere query matches a brute force search
+    found = index.query_sphere(center, radius, components="axon")
+    found = found[found["name"] == "example1"]
+    nodes = np.concatenate(
+        [np.arange(r.start, r.stop) for r in found.itertuples()]
+    )
+    distances = np.linalg.norm(compact.nodes[:, :3] - center, axis=1)
+    expected = np.flatnonzero((distances <= radius) & (compact.types == 2))
+    np.testing.assert_array_equal(np.sort(nodes), expected)
+
+    lower, upper = center - radius, center + radius / 2
+    found = index.query_box(lower, upper)
+    assert set(found["name"]) >= {"example1"}
+
+    nearest = index.nearest(center, k=3)
+    assert nearest["distance"].iloc[0] == pytest.approx(0, abs=1e-3)
+    assert len(nearest) == 3
+
+    # Modified files are re-indexed in a new segment, the index is
+    # persisted and the segments can be merged
+    before = index.query_sphere(center, radius, "axon")
+    os.utime(folder / "example1.swc", ns=(0, 0))
+    assert index.update(folder) == 1
+    index = SpatialIndex(Path(tmpdir) / "index")
+    assert len(index) == 3
+    after = index.query_sphere(center, radius, "axon")
+    assert len(after) == len(before)
+    index.merge()
+    assert len(index.neurons) == 3
+    assert index.nearest(center)["name"][0] == "example1"
+
+
+def test_projection_matrix():
+    neurons = [Neuron(fp) for fp in sorted(listdir("tests/data"))]
+
+    # Atlas with a root region split in two halves along the first axis
+    annotation = np.full((100, 100, 100), 2, dtype=np.uint16)
+    annotation[50:] = 3
+    atlas = SimpleNamespace(
+        annotation=annotation,
+        resolution=(100, 100, 100),
+        structures={
+            1: dict(structure_id_path=[1]),
+            2: dict(structure_id_path=[1, 2]),
+            3: dict(structure_id_path=[1, 3]),
+        },
+    )
+
+    result = projection_matrix(neurons, atlas, rollup=True)
+    assert result.matrix.shape == (3, 3)
+    np.testing.assert_array_equal(result.regions, [1, 2, 3])
+    assert result.neurons == [n.neuron_name for n in neurons]
+
+    matrix = result.matrix.toarray()
+    lengths = [
+        nm.get("total_length", n.morphology, neurite_type=nm.AXON)
+        for n in neurons
+    ]
+    np.testing.assert_allclose(matrix[:, 0], lengths, rtol=1e-4)
+    np.testing.assert_allclose(matrix[:, 0], matrix[:, 1] + matrix[:, 2])
+
+    # Chunking doesn't change the result
+    chunked = projection_matrix(neurons, atlas, rollup=True, chunk_size=100)
+    np.testing.assert_allclose(chunked.matrix.toarray(), matrix)
+
+
+def test_rasterize():
+    files = sorted(listdir("tests/data"))
+    neurons = [Neuron(fp) for fp in files]
+    atlas = SimpleNamespace(shape=(100, 100, 100), resolution=(100,) * 3)
+
+    density = rasterize(files, atlas)
+    assert density.n_neurons == 3
+    assert set(density.grids) == {"axon", "dendrites"}
+    assert density.grids["axon"].shape == atlas.shape
+    lengths = [
+        nm.get("total_length", n.morphology, neurite_type=nm.AXON)
+        for n in neurons
+    ]
+    assert density.grids["axon"].sum() == pytest.approx(sum(lengths), 1e-4)
+
+    # The voxels rasterized by several workers are summed
+    parallel = rasterize(files, atlas, workers=2)
+    assert parallel.n_neurons == 3
+    for name, grid in density.grids.items():
+        np.testing.assert_allclose(parallel.grids[name], grid, rtol=1e-5)
+
+    nodes = DensityGrid.from_atlas(atlas, measure="nodes", components=["axon"])
+    nodes.add(neurons[0])
+    assert nodes.grids["axon"].sum() == np.sum(neurons[0].compact.types == 2)
+
+
+def test_soma_index(tmpdir):
+    folder = Path(tmpdir) / "neurons"
+    folder.mkdir()
+    for file in listdir("tests/data"):
+        shutil.copy(file, folder)
+
+    annotation = np.zeros((100, 100, 100), dtype=np.uint16)
+    annotation[69] = 5
+    atlas = SimpleNamespace(annotation=annotation, resolution=(100,) * 3)
+
+    index_path = Path(tmpdir) / "somata.npz"
+    index = SomaIndex(index_path)
+    assert index.update(folder, atlas=atlas) == 3
+    assert index.update(folder, atlas=atlas) == 0
+
+    index = SomaIndex(index_path)
+    row = index.table.set_index("name").loc["example1"]
+    neuron = Neuron(folder / "example1.swc")
+    np.testing.assert_allclose(
+        row[["x", "y", "z", "radius"]].to_numpy(dtype=float),
+        neuron.compact.soma,
+        rtol=1e-6,
+    )
+    assert row["region"] == 5
+
+    assert list(index.query_region(5)["name"]) == ["example1"]
+    found = index.query_sphere(neuron.compact.soma[:3], 1)
+    assert list(found["name"]) == ["example1"]
+
+    # Deleted and modified files are updated
+    (folder / "example2.swc").unlink()
+    os.utime(folder / "example3.swc", ns=(0, 0))
+    assert index.update(folder) == 1
+    assert sorted(index.table["name"]) == ["example1", "example3"]
+
+
+def test_obj_cache(tmpdir):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    neurites, whole = neuron.create_mesh(use_cache=False)
+    _params = dict(neurite_radius=2, soma_radius=4)
+
+    # Write the meshes as OBJ files, like previous versions did
+    name = neuron.neuron_name
+    os.remove(neuron.get_cache_filename(name, neuron._mesh_params()))
+    assert neuron.rebuild_manifest() == 0
+    meshes = dict(neurites, whole_neuron=whole)
+    for part, file_name in zip(
+        [
+            "soma",
+            "axon",
+            "apical_dendrites",
+            "basal_dendrites",
+            "whole_neuron",
+        ],
+        neuron.get_cache_filenames(name),
+    ):
+        write(meshes[part] if meshes[part] is not None else Mesh(), file_name)
+    save_yaml(neuron.get_cache_params_filename(name), _params)
+
+    # They are not used, and can be deleted
+    assert neuron.load_cached_neuron(name, neuron._mesh_params()) is None
+    assert neuron.stats().n_files == 6
+    assert neuron.remove_obj_cache() > 0
+    assert neuron.stats().n_files == 0
+    assert neuron.remove_obj_cache() == 0
+
+
+def test_cache_keys(tmpdir):
+    data_file = str(tmpdir / "neuron.swc")
+    shutil.copyfile("tests/data/example1.swc", data_file)
+    neuron = Neuron(data_file, base_dir=str(tmpdir))
+    name = neuron.neuron_name
+
+    # Variants with different parameters are cached side by side
+    thin = neuron.create_mesh(neurite_radius=2)[0]["axon"].npoints
+    thick = neuron.create_mesh(neurite_radius=3)[0]["axon"].npoints
+    neuron.invert_dims = True
+    neuron.create_mesh(neurite_radius=2)
+    assert len(neuron.cached_variants(name)) == 3
+
+    neuron.invert_dims = False
+    _params = neuron._mesh_params(neurite_radius=2)
+    assert neuron.load_cached_neuron(name, _params)["axon"].npoints == thin
+    assert neuron.create_mesh(neurite_radius=3)[0]["axon"].npoints == thick
+
+    # Changing the data file changes the keys
+    with open(data_file, "a") as f:
+        f.write("# edited\n")
+    assert neuron._mesh_params(neurite_radius=2) != _params
+    assert neuron.load_cached_neuron(name, neuron._mesh_params()) is None
+
+
+def test_cache_budget(tmpdir, monkeypatch):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    name = neuron.neuron_name
+    for radius in (1, 2, 3):
+        neuron.create_mesh(neurite_radius=radius)
+
+    stats = neuron.stats()
+    assert stats.n_neurons == 1 and stats.n_files == 3
+    assert stats.max_size is None
+    file_size = stats.size // 3
+
+    # Reading a variant makes it the most recently used
+    time.sleep(0.01)
+    neuron.create_mesh(neurite_radius=1)
+    freed = neuron.prune(max_size=2.5 * file_size)
+    assert freed > 0 and neuron.stats().n_files == 2
+    radii = {p["neurite_radius"] for p in neuron.cached_variants(name)}
+    assert radii == {1.0, 3.0}
+
+    # Writes evict the least recently used files beyond the budget
+    bounded = Neuron(
+        "tests/data/example1.swc",
+        base_dir=str(tmpdir),
+        max_cache_size=1.5 * file_size,
+    )
+    bounded.create_mesh(neurite_radius=4)
+    assert bounded.stats().n_files == 1
+    assert bounded._check_neuron_mesh_cached(
+        name, bounded._mesh_params(neurite_radius=4)
+    )
+
+    # Files that can't be removed (e.g. memory-mapped on Windows) are
+    # skipped
+    def locked(path):
+        raise PermissionError(path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "remove", locked)
+        assert neuron.prune(max_age=0) == 0
+    assert neuron.stats().n_files == 1
+
+    assert neuron.prune(max_age=0) > 0
+    assert neuron.stats() == (0, 0, 0, None)
+
+    with pytest.raises(ValueError):
+        Neuron("tests/data/example1.swc", max_cache_size=0)
+
+
+def test_memory_cache(tmpdir):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    memory_cache = neuron.memory_cache
+    memory_cache.clear()
+
+    red, _ = neuron.create_mesh(axon_color=(1, 0, 0))
+    assert (memory_cache.hits, memory_cache.misses) == (0, 1)
+    blue, _ = neuron.create_mesh(axon_color=(0, 0, 1))
+    assert (memory_cache.hits, memory_cache.misses) == (1, 1)
+
+    # Copies share their vertices but not their colors
+    assert blue["axon"].npoints == red["axon"].npoints
+    np.testing.assert_allclose(red["axon"].color(), [1, 0, 0])
+    np.testing.assert_allclose(blue["axon"].color(), [0, 0, 1])
+
+    # Entries are evicted beyond the budget, least recently used first
+    small = MeshMemoryCache(max_bytes=red["axon"].vertices.nbytes * 2)
+    small.put("a", dict(axon=red["axon"]))
+    small.put("b", dict(axon=red["axon"]))
+    assert small.get("a") is not None
+    small.put("c", dict(axon=red["axon"]))
+    assert small.get("b") is None and small.get("a") is not None
+    assert len(small) == 2 and small.size <= small.max_bytes
+
+
+@pytest.mark.parametrize("lod", [0, 1])
+def test_cached_whole_neuron(tmpdir, lod):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    neuron.memory_cache.clear()
+
+    # Built, then served from memory and from disk
+    built = neuron.create_mesh(lod=lod)[1]
+    from_memory = neuron.create_mesh(lod=lod)[1]
+    assert neuron.memory_cache.hits == 1
+    neuron.memory_cache.clear()
+    from_disk = neuron.create_mesh(lod=lod)[1]
+    assert neuron.memory_cache.misses == 1
+
+    assert built.npoints == from_memory.npoints == from_disk.npoints
+    assert built.ncells == from_memory.ncells == from_disk.ncells
+    np.testing.assert_allclose(from_disk.vertices, built.vertices)
+
+
+def test_cache_lock(tmpdir, monkeypatch):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    name = neuron.neuron_name
+    _params = neuron._mesh_params()
+
+    # A second locker waits until the lock is released
+    waited = []
+
+    def lock():
+        with neuron.cache_lock(name, _params) as was_locked:
+            waited.append(was_locked)
+
+    with neuron.cache_lock(name, _params) as was_locked:
+        assert not was_locked
+        thread = threading.Thread(target=lock)
+        thread.start()
+        thread.join(0.2)
+        assert thread.is_alive()
+    thread.join()
+    assert waited == [True]
+
+    # Locks are refreshed while they're held, however long it takes
+    monkeypatch.setattr(neuron, "lock_timeout", 0.3)
+    monkeypatch.setattr(neuron, "lock_refresh_interval", 0.05)
+    with neuron.cache_lock(name, _params):
+        thread = threading.Thread(target=lock)
+        thread.start()
+        thread.join(0.6)
+        assert thread.is_alive()
+    thread.join()
+    assert waited == [True, True]
+
+    # Abandoned locks are broken
+    with neuron.cache_lock(name, _params):
+        monkeypatch.setattr(neuron, "lock_refresh_interval", 10)
+        monkeypatch.setattr(neuron, "lock_timeout", 0)
+        lock()
+    assert waited == [True, True, True]
+
+    if os.name == "posix":
+        # So are locks of processes that don't exist anymore
+        monkeypatch.setattr(neuron, "lock_timeout", 600)
+        child = subprocess.Popen([sys.executable, "-c", ""])
+        child.wait()
+        lock_file = Path(neuron.get_cache_filename(name, _params)).with_name(
+            f".{neuron.cache_key(_params)}.lock"
+        )
+        lock_file.write_text(f"{child.pid} {socket.gethostname()}")
+        lock()
+        assert waited == [True, True, True, True]
+
+    # Concurrent renders of the same mesh only build it once
+    neuron.memory_cache.clear()
+    n_builds = []
+    build_meshes = Neuron._build_meshes
+
+    def counted(self, *args, **kwargs):
+        n_builds.append(1)
+        time.sleep(0.2)
+        return build_meshes(self, *args, **kwargs)
+
+    monkeypatch.setattr(Neuron, "_build_meshes", counted)
+    threads = [
+        threading.Thread(
+            target=Neuron(
+                "tests/data/example1.swc", base_dir=str(tmpdir)
+            ).create_mesh
+        )
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(n_builds) == 1
+    assert neuron._check_neuron_mesh_cached(name, _params)
+
+
+def test_cache_manifest(tmpdir):
+    neuron = Neuron("tests/data/example1.swc", base_dir=str(tmpdir))
+    name = neuron.neuron_name
+    for radius in (2, 3):
+        neuron.create_mesh(neurite_radius=radius)
+
+    _params = neuron._mesh_params()
+    entry = neuron.manifest.lookup(neuron.cache_key(_params))
+    assert entry.params == _params
+    assert entry.size == os.path.getsize(
+        neuron.get_cache_filename(name, _params)
+    )
+    assert len(neuron.manifest) == 2
+
+    # Lookups don't probe the file system
+    neuron.memory_cache.clear()
+    isfile = os.path.isfile
+    try:
+        os.path.isfile = None
+        assert neuron.load_cached_neuron(name, _params) is not None
+    finally:
+        os.path.isfile = isfile
+
+    # Files deleted by hand are misses, and rebuild recovers the manifest
+    neuron.memory_cache.clear()
+    os.remove(neuron.get_cache_filename(name, _params))
+    assert neuron.load_cached_neuron(name, _params) is None
+    assert len(neuron.manifest) == 1
+    os.remove(neuron.manifest.file_path)
+    assert neuron.rebuild_manifest() == 1
+    assert neuron.cached_variants(name) == [
+        neuron._mesh_params(neurite_radius=3)
+    ]
+
+
+def test_encoded_mesh_file(tmpdir):
+    neuron = Neuron(
+        "tests/data/example2.swc",
+        base_dir=str(tmpdir),
+        cache_max_error=0.1,
+    )
+    neurites, _ = neuron.create_mesh(use_cache=False)
+
+    raw_file, encoded_file = tmpdir / "raw.mesh", tmpdir / "encoded.mesh"
+    write_mesh_file(raw_file, neurites)
+    write_mesh_file(encoded_file, neurites, max_error=0.1)
+    assert os.path.getsize(encoded_file) * 5 < os.path.getsize(raw_file)
+
+    raw, _ = read_mesh_arrays(raw_file)
+    encoded, _ = read_mesh_arrays(encoded_file)
+    for component, arrays in raw.items():
+        if arrays is None:
+            assert encoded[component] is None
+            continue
+        vertices, faces, normals = arrays
+        assert np.abs(encoded[component][0] - vertices).max() <= 0.1
+        np.testing.assert_array_equal(encoded[component][1], faces)
+        cosines = np.sum(encoded[component][2] * normals, axis=1)
+        assert np.all(cosines > np.cos(np.radians(1)))
+
+    # The cache uses the encoding of the neuron
+    neuron.memory_cache.clear()
+    loaded = neuron.load_cached_neuron(
+        neuron.neuron_name, neuron._mesh_params()
+    )
+    assert loaded["axon"].npoints == neurites["axon"].npoints
+    header, _ = read_mesh_header(
+        neuron.get_cache_filename(neuron.neuron_name, neuron._mesh_params())
+    )
+    assert header["arrays"]["axon/vertices"]["encoding"] == "quantized"
+
+
+def test_warm_cache(tmpdir, capsys):
+    folder = Path(tmpdir) / "neurons"
+    folder.mkdir()
+    for file in sorted(listdir("tests/data")):
+        shutil.copy(file, folder)
+    neurons = [
+        Neuron(file, base_dir=str(tmpdir), load_file=False)
+        for file in sorted(folder.glob("*.swc"))
+    ]
+
+    report = warm_cache(neurons, workers=2)
+    assert (report.n_neurons, report.n_meshed, report.n_failed) == (3, 3, 0)
+    assert report.n_triangles > 0
+    assert report.n_bytes == neurons[0].stats().size
+
+    # Cache hits in worker processes are recorded in the manifest
+    manifest = neurons[0].manifest
+    manifest._connection.execute("UPDATE meshes SET accessed_ns = 0")
+    report = warm_cache(neurons, workers=2)
+    assert report.n_cached == 3
+    assert (manifest.entries().accessed_ns > 0).all()
+    manifest._connection.execute("UPDATE meshes SET accessed_ns = 0")
+    assert None not in create_meshes(neurons, workers=2)
+    assert (manifest.entries().accessed_ns > 0).all()
+
+    # Meshes are found by the content of the files, under any name
+    renamed = folder / "renamed.swc"
+    shutil.copy(folder / "example1.swc", renamed)
+    neuron = Neuron(renamed, base_dir=str(tmpdir), load_file=False)
+    assert neuron._check_neuron_mesh_cached("renamed", neuron._mesh_params())
+
+    args = ["cache", "build", str(folder), "--base-dir", str(tmpdir)]
+    assert main(args + ["--workers", "1"]) == 0
+    assert "Meshed 0 of 4 neurons" in capsys.readouterr().out
+    # The copy is meshed once
+    assert main(args + ["--workers", "1", "--radius", "3"]) == 0
+    assert "Meshed 3 of 4 neurons" in capsys.readouterr().out